@@ -0,0 +1,24 @@
+"""Loads the modules under benchmark without importing the stonelegend package.
+Its __init__ imports the bot and the cogs, which need discord.py and read
+their config files (admins.json...) when they are imported."""
+
+from importlib import util
+from os import path
+import sys
+
+
+PACKAGE_DIR = path.join(path.dirname(path.dirname(path.abspath(__file__))), 'stonelegend')
+
+
+def load_module(name: str):
+    """Loads a module of the package which has no relative imports, e.g. `db.models`"""
+
+    full_name = 'stonelegend.' + name
+    if full_name in sys.modules:
+        return sys.modules[full_name]
+
+    spec = util.spec_from_file_location(full_name, path.join(PACKAGE_DIR, *name.split('.')) + '.py')
+    module = util.module_from_spec(spec)
+    sys.modules[full_name] = module
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,80 @@
+"""Compares the rows decoded by DictCursor with the slotted row models, for the
+memory they keep and the time taken to build them.
+
+Needs nothing besides the standard library. Run from the repository root:
+    python -m benchmarks.db_rows [rows]"""
+
+import sys
+import time
+import tracemalloc
+
+from ._standalone import load_module
+
+models = load_module('db.models')
+Poll, Giveaway, GuildSettings = models.Poll, models.Giveaway, models.GuildSettings
+
+
+def poll_rows(count):
+    return [(index, 700000000000000000 + index % 50, 710000000000000000 + index % 400,
+        720000000000000000 + index, 1600000000 + index, f'Question number {index}?',
+        '\N{thumbs up sign}', '\N{thumbs down sign}') for index in range(count)]
+
+
+def giveaway_rows(count):
+    return [(index, 700000000000000000 + index % 50, 710000000000000000 + index % 400,
+        720000000000000000 + index, 1600000000 + index, f'Prize {index}',
+        730000000000000000 + index % 1000) for index in range(count)]
+
+
+def measure(name, decode, rows, repeat=5):
+    """Prints the time to decode the rows, the best of `repeat` runs as single runs
+    are noisy, and the memory the decoded rows keep"""
+
+    elapsed = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        decode(rows)
+        elapsed = min(elapsed, time.perf_counter() - started)
+
+    tracemalloc.start()
+    decoded = decode(rows)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del decoded
+
+    print(f'{name:>24}: {elapsed / len(rows) * 1e6:6.2f} us per row, {size / len(rows):7.1f} bytes per row')
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+
+    for model, rows in ((Poll, poll_rows(count)), (Giveaway, giveaway_rows(count))):
+        # What DictCursor does for each row
+        measure(f'{model.__name__} dict', lambda rows: [dict(zip(model.COLUMNS, row)) for row in rows], rows)
+        measure(f'{model.__name__} model', lambda rows: [model(*row) for row in rows], rows)
+
+    names = GuildSettings.__slots__
+    rows = [(700000000000000000 + index, 710000000000000000 + index) for index in range(count)]
+
+    def settings_dicts(rows):
+        settings = {}
+        for name in names:
+            for guild_id, value in rows:
+                settings.setdefault(guild_id, {})[name] = value
+        return settings
+
+    def settings_models(rows):
+        settings = {}
+        for name in names:
+            for guild_id, value in rows:
+                if (guild_settings := settings.get(guild_id)) is None:
+                    guild_settings = settings[guild_id] = GuildSettings()
+                setattr(guild_settings, name, value)
+        return settings
+
+    measure('GuildSettings dict', settings_dicts, rows)
+    measure('GuildSettings model', settings_models, rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""Compares the welcome banner render engines.
+
+Needs Pillow, and CairoSVG for the SVG engine. Run from the repository root,
+where welcome_template.svg is:
+    python -m benchmarks.welcome_render [iterations]"""
+
+from importlib import util
+from io import BytesIO
+import sys
+import time
+
+from PIL import Image
+
+from ._standalone import load_module
+
+render = load_module('render')
+
+
+def sample_image(size, color) -> bytes:
+    data = BytesIO()
+    Image.new('RGB', size, color).save(data, format='PNG')
+    return data.getvalue()
+
+
+def bench(name, render, iterations):
+    render()  # warm-up
+    started = time.perf_counter()
+    for _ in range(iterations):
+        render()
+    elapsed = time.perf_counter() - started
+    print(f'{name:>8}: {elapsed / iterations * 1000:.2f} ms per banner')
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    pfp = sample_image((256, 256), (200, 80, 40))
+    bg = sample_image((500, 250), (20, 30, 90))
+    username = 'Steve#0001'
+
+    render.init_pillow_worker()
+    bench('pillow', lambda: render.render_pillow(pfp, bg, username), iterations)
+
+    if util.find_spec('cairosvg') is None:
+        print('     svg: skipped, CairoSVG is not installed')
+        return
+
+    with open('welcome_template.svg') as fp:
+        template_svg = fp.read()
+    bench('svg', lambda: render.render_svg(template_svg, pfp, bg, username), iterations)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,9 +5,11 @@ from .bot import StoneLegendBot
 from .cogs import all_extensions
 from .help import CustomHelpCommand
 from .db import Database
+from .config import load_config
 
 
 SQL_CONFIG_FILE = 'sql_config.json'
+BOT_CONFIG_FILE = 'bot_config.json'
 
 
 def run():
@@ -22,9 +24,10 @@ def run():
     with open(SQL_CONFIG_FILE) as fp:
         sql_config = json.load(fp)
 
-    bot = StoneLegendBot(sql_config)
+    bot = StoneLegendBot(sql_config, load_config(BOT_CONFIG_FILE))
 
+    # Loaded by name so that Admin can reload them in place
     for ext in all_extensions:
-        ext.setup(bot)
+        bot.load_extension(ext.__name__)
 
     bot.run(token)
\ No newline at end of file
@@ -0,0 +1,135 @@
+from typing import Dict, Iterable, List, Tuple
+
+from .ratelimit import IdleEvicting
+
+
+class Leaderboard:
+    """The top `size` members of a guild by message count.
+
+    Counts only grow, so the lowest count of a full board is cached and a member
+    below it is turned away without looking at the entries"""
+
+    __slots__ = ('size', 'entries', 'floor', 'loaded')
+
+    def __init__(self, size: int):
+        self.size = size
+        self.entries: Dict[int, int] = {}
+        # Lowest count on the board once full. May lag behind, which only costs a recount
+        self.floor = 0
+        self.loaded = False
+
+    def offer(self, user_id: int, count: int):
+        entries = self.entries
+        if user_id in entries or len(entries) < self.size:
+            entries[user_id] = max(count, entries.get(user_id, 0))
+            if len(entries) == self.size:
+                self.floor = min(entries.values())
+            return
+
+        if count <= self.floor:
+            return
+
+        lowest = min(entries, key=entries.__getitem__)
+        if count > entries[lowest]:
+            del entries[lowest]
+            entries[user_id] = count
+        self.floor = min(entries.values())
+
+    def top(self, limit: int) -> List[Tuple[int, int]]:
+        """Returns up to `limit` (user_id, count) pairs, highest first"""
+
+        return sorted(self.entries.items(), key=lambda entry: entry[1], reverse=True)[:limit]
+
+
+class ActivityCounters(IdleEvicting):
+    """Counts messages per (guild_id, user_id) in memory.
+
+    Increments are collected as pending deltas, to be written in batches with
+    `take_pending`. The total of a member is unknown until it is read back from
+    the db after their first flush, from then on it is kept up to date here and
+    offered to the guild's leaderboard. Members idle for `idle_after` seconds
+    are forgotten, apart from their leaderboard entry"""
+
+    def __init__(self, leaderboard_size: int = 50, idle_after: float = 3600.0):
+        super().__init__(idle_after)
+        self._leaderboard_size = leaderboard_size
+        self._pending: Dict[Tuple[int, int], int] = {}
+        # (guild_id, user_id) -> [total or -1 if unknown, last message time]
+        self._members: Dict[Tuple[int, int], List[int]] = {}
+        self._leaderboards: Dict[int, Leaderboard] = {}
+
+    def __len__(self) -> int:
+        return len(self._members)
+
+    def leaderboard(self, guild_id: int) -> Leaderboard:
+        board = self._leaderboards.get(guild_id)
+        if board is None:
+            board = self._leaderboards[guild_id] = Leaderboard(self._leaderboard_size)
+        return board
+
+    def record(self, guild_id: int, user_id: int, now: float):
+        """Counts a message"""
+
+        self._maybe_sweep(now)
+
+        key = (guild_id, user_id)
+        self._pending[key] = self._pending.get(key, 0) + 1
+
+        member = self._members.get(key)
+        if member is None:
+            self._members[key] = [-1, int(now)]
+            return
+
+        member[1] = int(now)
+        if member[0] >= 0:
+            member[0] += 1
+            self.leaderboard(guild_id).offer(user_id, member[0])
+
+    def take_pending(self) -> List[Tuple[int, int, int, int]]:
+        """Returns the counts since the last call as (guild_id, user_id, messages, last_active) rows"""
+
+        pending, self._pending = self._pending, {}
+        return [(guild_id, user_id, count, self._members[(guild_id, user_id)][1])
+            for (guild_id, user_id), count in pending.items()]
+
+    def restore_pending(self, rows: Iterable[Tuple[int, int, int, int]]):
+        """Puts back rows from `take_pending` which could not be written"""
+
+        for guild_id, user_id, count, _ in rows:
+            key = (guild_id, user_id)
+            self._pending[key] = self._pending.get(key, 0) + count
+            self._members.setdefault(key, [-1, 0])
+
+    def unknown_totals(self, rows: Iterable[Tuple[int, int, int, int]]) -> List[Tuple[int, int]]:
+        """Returns the (guild_id, user_id) of the rows whose total is not known yet"""
+
+        return [(guild_id, user_id) for guild_id, user_id, _, _ in rows
+            if self._members.get((guild_id, user_id), (0,))[0] < 0]
+
+    def set_totals(self, totals: Iterable[Tuple[int, int, int]]):
+        """Sets the totals read from the db as (guild_id, user_id, messages),
+        adding what was counted since they were written"""
+
+        for guild_id, user_id, messages in totals:
+            key = (guild_id, user_id)
+            member = self._members.get(key)
+            if member is not None and member[0] < 0:
+                member[0] = messages + self._pending.get(key, 0)
+                self.leaderboard(guild_id).offer(user_id, member[0])
+
+    def load_leaderboard(self, guild_id: int, rows: Iterable[Tuple[int, int]]):
+        """Fills the leaderboard of a guild with the top (user_id, messages) rows of the db"""
+
+        board = self.leaderboard(guild_id)
+        for user_id, messages in rows:
+            member = self._members.get((guild_id, user_id))
+            if member is not None and member[0] >= 0:
+                messages = member[0]
+            else:
+                messages += self._pending.get((guild_id, user_id), 0)
+            board.offer(user_id, messages)
+        board.loaded = True
+
+    def evict_idle(self, now: float):
+        self._members = {key: member for key, member in self._members.items()
+            if now - member[1] < self.idle_after or key in self._pending}
@@ -0,0 +1,164 @@
+"""Admission control for command invocations.
+
+Every invocation takes a token from the bucket of its user and of its guild,
+then a slot of its command. Commands have a limited number of slots so that a
+flood of one command (status checks, verifications, polls...) cannot take all
+the db connections, executor threads and REST buckets. An invocation finding
+no free slot waits in a short queue, and is shed when the queue is full or the
+wait is too long. Shed invocations raise `Overloaded`."""
+
+from collections import deque
+from discord.ext.commands import CommandError
+from typing import Any, Deque, Dict, Optional
+import asyncio
+import time
+
+from .ratelimit import TokenBuckets
+
+
+class Overloaded(CommandError):
+    """Raised when an invocation is turned away. `notify` tells whether the user
+    should be told, so that a flood does not get a reply for every message"""
+
+    MESSAGES = {
+        'user': "You're using commands too fast, slow down a bit!",
+        'guild': "This server is using commands too fast, try again in a bit.",
+        'busy': "I'm a bit overloaded right now, try again in a moment.",
+        'timeout': "I'm a bit overloaded right now, try again in a moment.",
+    }
+
+    def __init__(self, reason: str):
+        super().__init__(self.MESSAGES[reason])
+        self.reason = reason
+        self.notify = True
+
+
+class CommandSlots:
+    """A fixed number of slots for running a command, with a bounded queue of waiters.
+    A released slot is handed to the oldest waiter"""
+
+    __slots__ = ('limit', 'max_waiting', 'running', '_waiters')
+
+    def __init__(self, limit: int, max_waiting: int):
+        self.limit = limit
+        self.max_waiting = max_waiting
+        self.running = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    @property
+    def full(self) -> bool:
+        """Whether a new invocation would have to wait"""
+
+        return self.running >= self.limit or bool(self._waiters)
+
+    async def acquire(self, timeout: float):
+        """Takes a slot, waiting up to `timeout` seconds for one.
+        Raises Overloaded if the queue is full or the wait timed out"""
+
+        if not self.full:
+            self.running += 1
+            return
+
+        if len(self._waiters) >= self.max_waiting:
+            raise Overloaded('busy')
+
+        waiter = asyncio.get_event_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            raise Overloaded('timeout')
+        except asyncio.CancelledError:
+            # The slot may have been handed over just before the cancellation
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+        finally:
+            if not waiter.done() or waiter.cancelled():
+                try:
+                    self._waiters.remove(waiter)
+                except ValueError:
+                    pass
+
+    def release(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                # The slot goes to the waiter, so running stays the same
+                waiter.set_result(None)
+                return
+        self.running -= 1
+
+
+class AdmissionControl:
+    """Decides which invocations run, wait or are shed, and counts them"""
+
+    def __init__(self, user_rate: float = 0.5, user_burst: float = 5, guild_rate: float = 5.0,
+        guild_burst: float = 30, default_concurrency: int = 10, command_concurrency: Dict[str, int] = None,
+        max_queued: int = 20, queue_timeout: float = 10.0, notice_interval: float = 30.0):
+        self._user_rate = user_rate
+        self._user_burst = user_burst
+        self._guild_rate = guild_rate
+        self._guild_burst = guild_burst
+        self._default_concurrency = default_concurrency
+        self._command_concurrency = command_concurrency or {}
+        self._max_queued = max_queued
+        self._queue_timeout = queue_timeout
+        self._notice_interval = notice_interval
+
+        self._users = TokenBuckets()
+        self._guilds = TokenBuckets()
+        # One token per interval, for telling a user they are being turned away
+        self._notices = TokenBuckets(idle_after=notice_interval)
+        self._slots: Dict[str, CommandSlots] = {}
+
+        self.admitted = 0
+        self.queued = 0
+        self.shed: Dict[str, int] = dict.fromkeys(Overloaded.MESSAGES, 0)
+        self.shed_by_command: Dict[str, int] = {}
+
+    def slots(self, command_name: str) -> CommandSlots:
+        slots = self._slots.get(command_name)
+        if slots is None:
+            slots = self._slots[command_name] = CommandSlots(
+                self._command_concurrency.get(command_name, self._default_concurrency), self._max_queued)
+        return slots
+
+    async def acquire(self, command_name: str, user_id: int, guild_id: Optional[int]):
+        """Admits an invocation of a (top-level) command, waiting for a slot if needed.
+        Raises Overloaded if it is shed. A successful call must be paired with `release`"""
+
+        now = time.monotonic()
+        try:
+            if not self._users.consume(user_id, now, self._user_rate, self._user_burst):
+                raise Overloaded('user')
+            if guild_id is not None and not self._guilds.consume(guild_id, now, self._guild_rate, self._guild_burst):
+                raise Overloaded('guild')
+
+            slots = self.slots(command_name)
+            if slots.full and slots.waiting < slots.max_waiting:
+                self.queued += 1
+            await slots.acquire(self._queue_timeout)
+        except Overloaded as e:
+            e.notify = self._notices.consume(user_id, time.monotonic(), 1 / self._notice_interval, 1)
+            self.shed[e.reason] += 1
+            self.shed_by_command[command_name] = self.shed_by_command.get(command_name, 0) + 1
+            raise
+
+        self.admitted += 1
+
+    def release(self, command_name: str):
+        self._slots[command_name].release()
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns the counters and the commands which are running or queued"""
+
+        return dict(admitted=self.admitted, queued=self.queued, shed=dict(self.shed),
+            shed_by_command=dict(self.shed_by_command),
+            busy={name: f'{slots.running}/{slots.limit} running, {slots.waiting} waiting'
+                for name, slots in self._slots.items() if slots.running or slots.waiting},
+            tracked=dict(users=len(self._users), guilds=len(self._guilds)))
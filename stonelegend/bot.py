@@ -1,25 +1,210 @@
 from discord.ext.commands import Bot
-import aiohttp
+from discord import Guild, Member, NotFound
+from functools import wraps
+from typing import Any, Callable, Dict, Optional
+import sys
 
+from .admission import AdmissionControl, Overloaded
 from .help import CustomHelpCommand
 from .db import Database
+from .db.caselog import ModerationCaseLog
+from .rest import RequestScheduler
+from .converters.index import ResolutionIndex
+from .cache import LRUCache
+from .http import HTTPClient
+from .tracing import tracer
+from . import snapshot
+
+
+SNAPSHOT_FILE = 'cache_snapshot.json.gz'
 
 
 class StoneLegendBot(Bot):
     
-    def __init__(self, sql_config):
-        super().__init__(command_prefix='/', help_command=CustomHelpCommand())
+    def __init__(self, sql_config, config: Dict[str, Any]):
+        cache_config = config['cache']
+        super().__init__(command_prefix='/', help_command=CustomHelpCommand(),
+            max_messages=cache_config['max_messages'],
+            fetch_offline_members=cache_config['fetch_offline_members'])
         self.sql_config = sql_config
+        self.config = config
         self.db = None
-        self.worker_http_session = aiohttp.ClientSession()
+        self.case_log = None
+        self.http_client = HTTPClient(**config['http'])
+        self.rest_queue = RequestScheduler()
+        self.admission = AdmissionControl(**config['admission'])
+        self.help_index = None
+        self.resolver = ResolutionIndex()
+        self.resolver.register(self)
+        self.cache_snapshot = {}
+        # (guild_id, user_id) -> members fetched because they were not in the member cache
+        self.recent_members = LRUCache(cache_config['recent_members'])
+        # State owned by cogs which must outlive them, so that reloading an extension keeps it
+        self.cog_state: Dict[str, Any] = {}
+
+        tracer.configure(**config['tracing'])
+        if tracer.enabled:
+            self.before_invoke(self._trace_prepared)
+            self._trace_discord_requests()
+
+    @property
+    def worker_http_session(self):
+        """The raw aiohttp session, prefer `http_client`"""
+
+        return self.http_client.session
 
     # Overriden to make a db connection on start-up
     async def start(self, *args, **kwargs):
+        await self.http_client.start()
+
         self.db = Database(self.sql_config)
         await self.db.connect()
+
+        moderation_config = self.config['moderation']
+        self.case_log = ModerationCaseLog(self.db, moderation_config['case_flush_interval'],
+            moderation_config['case_batch_size'], moderation_config['case_max_pending'])
+        await self.case_log.start()
+
+        # Serve events from the last snapshot right away and refresh in the background
+        self.cache_snapshot = snapshot.load(SNAPSHOT_FILE) or {}
+        if 'db' in self.cache_snapshot:
+            self.db.import_cache(self.cache_snapshot['db'])
+        self.loop.create_task(self.db.reconcile_cache())
+
+        self.rest_queue.start()
         await super().start(*args, **kwargs)
 
+    # Overriden to rebuild the help index after commands change
+    def add_command(self, command):
+        super().add_command(command)
+        self.help_index = None
+
+    def remove_command(self, name):
+        command = super().remove_command(name)
+        self.help_index = None
+        return command
+
+    # Overriden to trace command invocations and apply admission control
+    async def invoke(self, ctx):
+        if ctx.command is None:
+            return await super().invoke(ctx)
+        if not tracer.enabled:
+            return await self._admit_and_invoke(ctx)
+
+        with tracer.trace('command ' + ctx.command.qualified_name,
+            guild_id=ctx.guild.id if ctx.guild is not None else None):
+            await self._admit_and_invoke(ctx)
+
+    async def _admit_and_invoke(self, ctx):
+        """Invokes the command once admitted, subcommands share the slots of their top-level command"""
+
+        name = (ctx.command.root_parent or ctx.command).qualified_name
+        try:
+            await self.admission.acquire(name, ctx.author.id, ctx.guild.id if ctx.guild is not None else None)
+        except Overloaded as e:
+            await ctx.command.dispatch_error(ctx, e)
+            return
+
+        try:
+            await super().invoke(ctx)
+        finally:
+            self.admission.release(name)
+
+    async def _trace_prepared(self, ctx):
+        """Records the checks and converters of the command as a span, as they
+        are done by the time the before invoke hooks run"""
+
+        if (command_span := tracer.current()) is not None:
+            tracer.finish(tracer.start_span('prepare', command_span,
+                start=command_span.start, start_time=command_span.start_time))
+
+    # Overriden to trace listeners, each event is handled in its own task
+    def _schedule_event(self, coro, event_name, *args, **kwargs):
+        if tracer.enabled:
+            listener = coro
+
+            @wraps(listener)
+            async def coro(*args, **kwargs):
+                with tracer.trace('event ' + event_name, listener=listener.__qualname__):
+                    await listener(*args, **kwargs)
+
+        return super()._schedule_event(coro, event_name, *args, **kwargs)
+
+    def _trace_discord_requests(self):
+        """Records the Discord REST calls as spans of the current trace"""
+
+        request = self.http.request
+
+        @wraps(request)
+        async def traced_request(route, **kwargs):
+            with tracer.span(f'discord {route.method} {route.path}'):
+                return await request(route, **kwargs)
+
+        self.http.request = traced_request
+
+    def get_cog_state(self, key: str, factory: Callable[[], Any]) -> Any:
+        """Returns the cog state kept under `key`, made with `factory` the first time.
+        The state stays on the bot when the extension of the cog is reloaded"""
+
+        state = self.cog_state.get(key)
+        if state is None:
+            state = self.cog_state[key] = factory()
+        return state
+
+    async def get_or_fetch_member(self, guild: Guild, user_id: int) -> Optional[Member]:
+        """Returns a member from the member cache, the recently fetched members or the API.
+        Returns None if the user is not a member of the guild"""
+
+        if (member := guild.get_member(user_id)) is not None:
+            return member
+        if (member := self.recent_members.get((guild.id, user_id))) is not None:
+            return member
+
+        try:
+            member = await guild.fetch_member(user_id)
+        except NotFound:
+            return None
+        self.recent_members.put((guild.id, user_id), member)
+        return member
+
+    async def ensure_chunked(self, guild: Guild):
+        """Fills the member cache of the guild, for commands which need every member.
+        Only needed when fetch_offline_members is disabled"""
+
+        if guild.large and not guild.chunked and not guild.unavailable:
+            await self.request_offline_members(guild)
+
+    async def on_member_remove(self, member: Member):
+        self.recent_members.pop((member.guild.id, member.id))
+
+    def write_snapshot(self):
+        """Writes the db caches and the state exported by cogs to the snapshot file"""
+
+        data = dict(db=self.db.export_cache())
+        for name, cog in self.cogs.items():
+            if (export := getattr(cog, 'export_snapshot', None)) is not None:
+                data[name] = export()
+        snapshot.dump(SNAPSHOT_FILE, data)
+
+    async def flush_cogs(self):
+        """Writes out what the cogs buffer for the db. Extensions are only unloaded
+        by Bot.close, once the db is closed, so the flushes of their loops come too late"""
+
+        for name, cog in tuple(self.cogs.items()):
+            if (flush := getattr(cog, 'flush', None)) is not None:
+                try:
+                    await flush()
+                except Exception as e:
+                    print(f'Could not flush {name} on close: {type(e).__name__}: {e}', file=sys.stderr)
+
     async def close(self, *args, **kwargs):
+        if self.db is not None:
+            self.write_snapshot()
+            await self.flush_cogs()
+        await self.rest_queue.close()
+        if self.case_log is not None:
+            await self.case_log.close()
         await self.db.close()
-        await self.worker_http_session.close()
-        await super().close()
\ No newline at end of file
+        await self.http_client.close()
+        await super().close()
+        tracer.close()
\ No newline at end of file
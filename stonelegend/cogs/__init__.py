@@ -1,5 +1,5 @@
 from . import(links, info, util, admin, moderation,
-    welcome, error, verification)
+    welcome, error, verification, raid, bridge, stats, activity)
 
 
 all_extensions = [
@@ -11,6 +11,10 @@ all_extensions = [
     welcome,
     error,
     verification,
+    raid,
+    bridge,
+    stats,
+    activity,
 ]
 
 __all__ = [
@@ -0,0 +1,91 @@
+from discord.ext.commands import Cog, Context, command, guild_only
+from discord.ext.tasks import loop
+from discord import Embed, Color, Message
+import aiomysql
+import time
+
+from ..bot import StoneLegendBot
+from ..activity import ActivityCounters
+
+
+class Activity(Cog):
+    """Message activity leaderboards"""
+
+    def __init__(self, bot: StoneLegendBot):
+        self.bot = bot
+
+        activity_config = bot.config['activity']
+        self.counters = bot.get_cog_state('Activity', lambda: ActivityCounters(
+            activity_config['leaderboard_size'], activity_config['idle_after']))
+
+        self.flusher.change_interval(seconds=activity_config['flush_interval'])
+        self.flusher.start()
+
+    def cog_unload(self):
+        self.flusher.cancel()
+
+    @Cog.listener('on_message')
+    async def count_message(self, message: Message):
+        if message.guild is None or message.author.bot:
+            return
+
+        self.counters.record(message.guild.id, message.author.id, time.time())
+
+    @loop(seconds=60)
+    async def flusher(self):
+        """Writes the counts in one batch and reads back the totals of new members"""
+
+        try:
+            await self.flush()
+        except aiomysql.MySQLError:
+            pass # Kept for the next flush
+
+    @flusher.before_loop
+    async def wait_for_ready(self):
+        await self.bot.wait_until_ready()
+
+    @flusher.after_loop
+    async def flush_on_stop(self):
+        """Flushes when the cog is reloaded. On close, the bot has flushed
+        before closing the db, see StoneLegendBot.flush_cogs"""
+
+        await self.flush()
+
+    async def flush(self):
+        rows = self.counters.take_pending()
+        if not rows:
+            return
+
+        try:
+            await self.bot.db.add_activity(rows)
+        except BaseException:
+            self.counters.restore_pending(rows)
+            raise
+
+        if unknown := self.counters.unknown_totals(rows):
+            self.counters.set_totals(await self.bot.db.get_activity_totals(unknown))
+
+    @guild_only()
+    @command(name='top', aliases=('leaderboard',))
+    async def leaderboard(self, ctx: Context, count: int = 10):
+        """Shows the most active members of the server"""
+
+        board = self.counters.leaderboard(ctx.guild.id)
+        count = max(1, min(count, board.size))
+        if not board.loaded:
+            self.counters.load_leaderboard(ctx.guild.id,
+                await self.bot.db.get_top_activity(ctx.guild.id, board.size))
+
+        top = board.top(count)
+        description = '\n'.join(f'**{rank}.** <@{user_id}> - {messages} messages'
+            for rank, (user_id, messages) in enumerate(top, start=1))
+
+        await ctx.send(embed=Embed(
+            title=f'Most active members of {ctx.guild.name}',
+            description=description or '*Nobody has talked yet*',
+            color=Color.green()
+        ))
+
+
+def setup(bot: StoneLegendBot):
+    bot.add_cog(Activity(bot))
@@ -1,8 +1,24 @@
-from discord.ext.commands import Cog, Context, check, command, errors
+from discord.ext.commands import Cog, Context, check, command, group, errors
+from discord import File
+from collections import Counter
+from itertools import chain, islice
+from typing import Iterable, List
+import asyncio
+import gc
 import json
+import os
+import sys
+import time
+import tracemalloc
+import types
 
 from ..bot import StoneLegendBot
 
+try:
+    import resource
+except ImportError:
+    resource = None # Windows, the peak RSS is not reported
+
 
 # A list of user IDs allowed to run admin commands
 with open('admins.json') as fp:
@@ -19,6 +35,93 @@ def requires_admin():
     return check(predicate)
 
 
+# Where the memory profiling commands write their reports
+MEMORY_REPORT_DIR = 'memory_reports'
+# Modules whose live objects are counted by `memprofile types`
+COUNTED_MODULES = ('stonelegend', 'aioscheduler')
+# Allocations of tracemalloc itself and of the import machinery are left out of the reports
+SNAPSHOT_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+    tracemalloc.Filter(False, '<unknown>'),
+)
+
+
+def format_statistics(statistics: list, limit: int) -> List[str]:
+    """Formats the biggest tracemalloc statistics (or differences), with their traceback
+    when more than one frame is kept"""
+
+    lines = []
+    for stat in statistics[:limit]:
+        lines.append(str(stat))
+        if len(stat.traceback) > 1:
+            lines.extend('    ' + line for line in stat.traceback.format())
+    return lines
+
+
+def count_objects() -> Counter:
+    """Counts the live objects of the classes of the bot, and its pending coroutines by function"""
+
+    counts = Counter()
+    for obj in gc.get_objects():
+        cls = type(obj)
+        module = getattr(cls, '__module__', None) or ''
+        if module.startswith(COUNTED_MODULES):
+            counts[f'{module}.{cls.__qualname__}'] += 1
+        elif cls is types.CoroutineType and 'stonelegend' in obj.cr_code.co_filename:
+            counts[f'coroutine {obj.__qualname__}'] += 1
+    return counts
+
+
+def write_report(kind: str, lines: List[str]) -> str:
+    """Writes the lines of a report to a new file in MEMORY_REPORT_DIR, returns its path"""
+
+    os.makedirs(MEMORY_REPORT_DIR, exist_ok=True)
+    path = os.path.join(MEMORY_REPORT_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{kind}.txt")
+    with open(path, 'w') as fp:
+        fp.write('\n'.join(lines) + '\n')
+    return path
+
+
+def estimate_size(objects: Iterable, count: int, sample: int = 100) -> int:
+    """Estimates the memory used by `count` objects from the shallow size of a sample.
+    The attributes are not counted, only the object and its __dict__ if it has one"""
+
+    sizes = [sys.getsizeof(obj) + (sys.getsizeof(obj.__dict__) if hasattr(obj, '__dict__') else 0)
+        for obj in islice(objects, sample)]
+    return sum(sizes) * count // len(sizes) if sizes else 0
+
+
+def with_dependents(extensions: dict, names: List[str]) -> List[str]:
+    """Returns `names` and the loaded extensions which import functions or classes
+    from one of them, directly or not, each after the extensions it imports from"""
+
+    imports = {name: {getattr(value, '__module__', None) for value in vars(module).values()} - {name}
+        for name, module in extensions.items()}
+
+    selected = set(names)
+    while (dependents := {name for name, imported in imports.items()
+        if name not in selected and imported & selected}):
+        selected |= dependents
+
+    ordered, seen = [], set()
+
+    def visit(name: str):
+        if name not in seen:
+            seen.add(name)
+            for imported in sorted(imports.get(name, set()) & selected):
+                visit(imported)
+            ordered.append(name)
+
+    for name in names:
+        visit(name)
+    for name in extensions:
+        if name in selected:
+            visit(name)
+    return ordered
+
+
 class Admin(Cog, command_attrs=dict(hidden=True)):
     """Admin commands"""
 
@@ -34,6 +137,215 @@ class Admin(Cog, command_attrs=dict(hidden=True)):
         await self.bot.db.init_database()
         await ctx.message.add_reaction('\U0001f44d')
 
+    @requires_admin()
+    @command(name='queue')
+    async def rest_queue_stats(self, ctx: Context):
+        """Shows the depth and counters of the outbound request queue"""
+
+        stats = self.bot.rest_queue.stats()
+        depth = ', '.join(f'{name}: {count}' for name, count in stats.pop('depth').items())
+        counters = '\n'.join(f'{name}: {value}' for name, value in stats.items())
+        await ctx.send(f'```\nDepth by priority: {depth}\n{counters}\n```')
+
+    @requires_admin()
+    @command(name='admission')
+    async def admission_stats(self, ctx: Context):
+        """Shows how many invocations were admitted, queued and shed, and the busy commands"""
+
+        stats = self.bot.admission.stats()
+        lines = [f"Admitted: {stats['admitted']}, queued: {stats['queued']}",
+            'Shed: ' + ', '.join(f'{reason}: {count}' for reason, count in stats['shed'].items()),
+            'Shed by command: ' + (', '.join(f'{name}: {count}' for name, count
+                in sorted(stats['shed_by_command'].items(), key=lambda item: -item[1])) or 'none'),
+            f"Tracked: {stats['tracked']['users']} users, {stats['tracked']['guilds']} guilds"]
+        lines.extend(f'{name}: {state}' for name, state in stats['busy'].items())
+        await ctx.send('```\n' + '\n'.join(lines) + '\n```')
+
+    @requires_admin()
+    @command(name='http')
+    async def http_stats(self, ctx: Context):
+        """Shows the request counts, errors and latencies of each external host"""
+
+        lines = [f'{host}: ' + ', '.join(f'{name}: {value}' for name, value in metrics.items())
+            for host, metrics in self.bot.http_client.stats().items()]
+        await ctx.send('```\n' + ('\n'.join(lines) or 'No requests yet') + '\n```')
+
+
+    @requires_admin()
+    @command(name='memory')
+    async def memory_usage(self, ctx: Context):
+        """Reports the approximate memory used by each cache, without what the
+        cached objects refer to"""
+
+        bot = self.bot
+        messages = bot.cached_messages
+        member_count = sum(len(guild.members) for guild in bot.guilds)
+        users = bot.users
+
+        caches = {
+            'messages': (len(messages), estimate_size(messages, len(messages))),
+            'members': (member_count, estimate_size(
+                chain.from_iterable(guild.members for guild in bot.guilds), member_count)),
+            'users': (len(users), estimate_size(users, len(users))),
+            'recent members': (len(bot.recent_members),
+                estimate_size(bot.recent_members.values(), len(bot.recent_members))),
+        }
+
+        lines = [f'{name}: {count} items, ~{size // 1024} KiB shallow' for name, (count, size) in caches.items()]
+        if resource is not None:
+            lines.append(f'Peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024} MiB')
+        await ctx.send('```\n' + '\n'.join(lines) + '\n```')
+
+    @requires_admin()
+    @command(name='reload')
+    async def reload_extensions(self, ctx: Context, *names: str):
+        """Reloads extensions in place, like `reload util moderation`, or all of them.
+        Extensions importing from a reloaded one, like moderation from admin and util,
+        are reloaded after it.
+        The connections, caches and the state the cogs keep on the bot are left as they are.
+        Only the cogs are reloaded: changes to the other modules (rest, db, ratelimit,
+        admission, activity...) need a restart"""
+
+        names = [name if name in self.bot.extensions else f'{__package__}.{name}' for name in names] \
+            or list(self.bot.extensions)
+        names = with_dependents(self.bot.extensions, names)
+
+        lines = []
+        started = time.perf_counter()
+        for name in names:
+            extension_started = time.perf_counter()
+            try:
+                self.bot.reload_extension(name)
+            except errors.ExtensionError as e:
+                lines.append(f'{name}: failed, {e.__cause__ or e}')
+            else:
+                lines.append(f'{name}: {(time.perf_counter() - extension_started) * 1000:.1f} ms')
+        lines.append(f'Total: {(time.perf_counter() - started) * 1000:.1f} ms')
+
+        await ctx.send('```\n' + '\n'.join(lines) + '\n```')
+
+    async def send_report(self, ctx: Context, kind: str, lines: List[str], summary_lines: int = 10):
+        """Writes a report to a file and sends its first lines along with the file"""
+
+        path = await self.bot.loop.run_in_executor(None, write_report, kind, lines)
+        summary = '\n'.join(lines[:summary_lines])[:1800]
+        await ctx.send(f'Written to `{path}`\n```\n{summary}\n```', file=File(path))
+
+    async def take_snapshot(self) -> tracemalloc.Snapshot:
+        """Takes a snapshot in the executor, copying and filtering the traces
+        takes a while on a large heap"""
+
+        return await self.bot.loop.run_in_executor(None,
+            lambda: tracemalloc.take_snapshot().filter_traces(SNAPSHOT_FILTERS))
+
+    @requires_admin()
+    @group(name='memprofile', aliases=('tracemalloc',), invoke_without_command=True)
+    async def memory_profile(self, ctx: Context):
+        """Profiles memory allocations with tracemalloc, which costs nothing until started.
+        memprofile start [frames] - starts tracing allocations, keeping that many frames of each
+        memprofile snapshot - takes the snapshot later diffs are made against
+        memprofile diff [limit] - shows what grew since the snapshot
+        memprofile top [limit] - shows the biggest allocation sites
+        memprofile types [limit] - counts the live objects of the classes of the bot
+        memprofile stop - stops tracing and drops the snapshot
+        Reports are also written to the memory_reports directory"""
+
+        if not tracemalloc.is_tracing():
+            await ctx.send('Tracing is off')
+            return
+
+        current, peak = tracemalloc.get_traced_memory()
+        await ctx.send(f'Tracing {tracemalloc.get_traceback_limit()} frames: '
+            + f'{current / 1024 / 1024:.1f} MiB traced, peak {peak / 1024 / 1024:.1f} MiB, '
+            + f'tracemalloc itself uses {tracemalloc.get_tracemalloc_memory() / 1024 / 1024:.1f} MiB'
+            + (', a snapshot is taken' if self.bot.cog_state.get('MemorySnapshot') is not None else ''))
+
+    @requires_admin()
+    @memory_profile.command(name='start')
+    async def memory_profile_start(self, ctx: Context, frames: int = 1):
+        """Starts tracing allocations. More frames tell where allocations come from but cost more"""
+
+        if tracemalloc.is_tracing():
+            await ctx.send('Already tracing, stop first to change the number of frames')
+            return
+
+        tracemalloc.start(frames)
+        await ctx.send(f'Tracing allocations with {frames} frames')
+
+    @requires_admin()
+    @memory_profile.command(name='stop')
+    async def memory_profile_stop(self, ctx: Context):
+        """Stops tracing allocations and frees the memory of the traces and the snapshot"""
+
+        tracemalloc.stop()
+        self.bot.cog_state.pop('MemorySnapshot', None)
+        await ctx.send('Stopped tracing')
+
+    @requires_admin()
+    @memory_profile.command(name='snapshot')
+    async def memory_profile_snapshot(self, ctx: Context, limit: int = 25):
+        """Takes the snapshot diffs are made against, replacing the previous one"""
+
+        if not tracemalloc.is_tracing():
+            await ctx.send('Tracing is off, use `memprofile start` first')
+            return
+
+        # Kept on the bot so that reloading this cog keeps it
+        snapshot = self.bot.cog_state['MemorySnapshot'] = await self.take_snapshot()
+        statistics = await self.bot.loop.run_in_executor(None, snapshot.statistics, 'traceback')
+        total = sum(stat.size for stat in statistics)
+        await self.send_report(ctx, 'snapshot', [f'Snapshot of {total / 1024 / 1024:.1f} MiB in '
+            + f'{sum(stat.count for stat in statistics)} blocks'] + format_statistics(statistics, limit))
+
+    @requires_admin()
+    @memory_profile.command(name='diff')
+    async def memory_profile_diff(self, ctx: Context, limit: int = 25):
+        """Shows the allocation sites which grew the most since the snapshot"""
+
+        baseline = self.bot.cog_state.get('MemorySnapshot')
+        if not tracemalloc.is_tracing() or baseline is None:
+            await ctx.send('Take a snapshot with `memprofile snapshot` first')
+            return
+
+        snapshot = await self.take_snapshot()
+        differences = await self.bot.loop.run_in_executor(None, snapshot.compare_to, baseline, 'traceback')
+        growth = sum(stat.size_diff for stat in differences)
+        await self.send_report(ctx, 'diff', [f'{growth / 1024 / 1024:+.2f} MiB since the snapshot']
+            + format_statistics(differences, limit))
+
+    @requires_admin()
+    @memory_profile.command(name='top')
+    async def memory_profile_top(self, ctx: Context, limit: int = 25):
+        """Shows the allocation sites holding the most memory"""
+
+        if not tracemalloc.is_tracing():
+            await ctx.send('Tracing is off, use `memprofile start` first')
+            return
+
+        snapshot = await self.take_snapshot()
+        statistics = await self.bot.loop.run_in_executor(None, snapshot.statistics, 'traceback')
+        await self.send_report(ctx, 'top', format_statistics(statistics, limit))
+
+    @requires_admin()
+    @memory_profile.command(name='types')
+    async def memory_profile_types(self, ctx: Context, limit: int = 40):
+        """Counts the live objects of the classes of the bot and the suspects of slow growth.
+        Works without tracing"""
+
+        bot = self.bot
+        # Walks every object tracked by the gc
+        counts = await bot.loop.run_in_executor(None, count_objects)
+        lines = [f'{name}: {count}' for name, count in counts.most_common(limit)]
+        lines += [
+            '',
+            f'cached messages: {len(bot.cached_messages)}',
+            f'asyncio tasks: {len(asyncio.all_tasks())}',
+            # Futures of pending wait_for calls, they only go away once their check passes or they time out
+            'wait_for listeners: ' + (', '.join(f'{event}: {len(listeners)}'
+                for event, listeners in bot._listeners.items() if listeners) or 'none'),
+        ]
+        await self.send_report(ctx, 'types', lines, summary_lines=len(lines))
+
 
 def setup(bot: StoneLegendBot):
     bot.add_cog(Admin(bot))
\ No newline at end of file
@@ -0,0 +1,69 @@
+from discord.ext.commands import Cog, Context, command
+from discord import AllowedMentions, HTTPException
+import asyncio
+
+from ..bot import StoneLegendBot
+from ..minecraft import Bridge, tail_file
+from ..rest import Priority
+from .admin import requires_admin
+
+
+# Chat is relayed as is, so nobody on the server can ping through the bridge
+NO_MENTIONS = AllowedMentions(everyone=False, users=False, roles=False)
+
+
+class MinecraftBridge(Cog, command_attrs=dict(hidden=True)):
+    """Relays the Minecraft server chat, joins and deaths to a channel"""
+
+    def __init__(self, bot: StoneLegendBot):
+        self.bot = bot
+
+        bridge_config = bot.config['bridge']
+        self._channel_id = bridge_config['channel_id']
+        self.bridge = Bridge(self.send, buffer_size=bridge_config['buffer_size'],
+            batch_window=bridge_config['batch_window'],
+            max_messages_per_batch=bridge_config['max_messages_per_batch'])
+
+        self._tasks = []
+        if bridge_config['enabled'] and self._channel_id is not None:
+            if bridge_config['log_file'] is not None:
+                self._tasks.append(asyncio.ensure_future(self.bridge.feed(
+                    tail_file(bridge_config['log_file'], bridge_config['poll_interval']))))
+            if bridge_config['socket_port'] is not None:
+                self._tasks.append(asyncio.ensure_future(self.bridge.serve(
+                    bridge_config['socket_host'], bridge_config['socket_port'])))
+            self._tasks.append(asyncio.ensure_future(self.bridge.run()))
+
+    def cog_unload(self):
+        for task in self._tasks:
+            task.cancel()
+
+    async def send(self, text: str):
+        """Posts a batch to the bridge channel, returning once it is sent"""
+
+        await self.bot.wait_until_ready()
+        channel = self.bot.get_channel(self._channel_id)
+        if channel is None:
+            return
+
+        future = self.bot.rest_queue.submit(lambda: channel.send(text, allowed_mentions=NO_MENTIONS),
+            priority=Priority.MESSAGE, bucket=('channel', channel.id))
+
+        # Batches which failed or were dropped from a full queue are not worth
+        # retrying, the chat has moved on
+        try:
+            await future
+        except HTTPException:
+            pass
+
+    @requires_admin()
+    @command(name='bridge')
+    async def bridge_stats(self, ctx: Context):
+        """Shows the counters of the Minecraft bridge"""
+
+        stats = '\n'.join(f'{name}: {value}' for name, value in self.bridge.stats().items())
+        await ctx.send(f'```\n{stats}\n```')
+
+
+def setup(bot: StoneLegendBot):
+    bot.add_cog(MinecraftBridge(bot))
@@ -2,6 +2,8 @@ from discord.ext.commands import(Cog, Context, CommandError,
     BadArgument, MissingRequiredArgument, CheckFailure, UserInputError, CommandNotFound)
 from discord import Embed, Color
 
+from ..admission import Overloaded
+
 
 class ErrorHandler(Cog):
     """Handles global command errors"""
@@ -13,6 +15,11 @@ class ErrorHandler(Cog):
             return Embed(title=title, description=str(error),
                 color=Color.red())
 
+        if isinstance(error, Overloaded):
+            if error.notify:
+                await ctx.send(embed=Embed(description=str(error), color=Color.orange()), delete_after=10)
+            return
+
         if isinstance(error, BadArgument):
             await ctx.send(embed=error_embed("Bad argument"))
             return
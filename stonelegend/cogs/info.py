@@ -1,14 +1,31 @@
 from discord.ext.commands import Cog, command, Context
 from discord import Embed, Color
+from aiohttp import ClientError
+import asyncio
 
 from ..bot import StoneLegendBot
 
 
+SERVER_STATUS_URL = "https://api.mcsrvstat.us/2/play.stonelegend.net:19145"
+
+
 class Info(Cog):
 
     def __init__(self, bot: StoneLegendBot) -> None:
         self.bot = bot
 
+    async def get_server_status(self, ctx: Context):
+        """Returns the server status from the status API, or None after telling the user it failed"""
+
+        try:
+            return await self.bot.http_client.get_json(SERVER_STATUS_URL)
+        except (ClientError, asyncio.TimeoutError, ValueError):
+            await ctx.send(embed=Embed(
+                description="Couldn't reach the server status service, try again later!",
+                color=Color.orange()
+            ))
+            return None
+
     @command(name='store', aliases=('shop', 'market'))
     async def store(self, ctx: Context):
         """Links to buycraft store"""
@@ -37,8 +54,9 @@ class Info(Cog):
             inline=False
         )
 
-        resp = await self.bot.worker_http_session.get("https://api.mcsrvstat.us/2/play.stonelegend.net:19145")
-        data = await resp.json()
+        data = await self.get_server_status(ctx)
+        if data is None:
+            return
 
         embed.add_field(
             name='**Status**',
@@ -59,8 +77,9 @@ class Info(Cog):
     async def players_list(self, ctx: Context):
         """Lists the online players in the MineCraft server"""
 
-        resp = await self.bot.worker_http_session.get("https://api.mcsrvstat.us/2/play.stonelegend.net:19145")
-        data = await resp.json()
+        data = await self.get_server_status(ctx)
+        if data is None:
+            return
 
         if not data['online']:
             await ctx.send(embed=Embed(
@@ -1,15 +1,31 @@
 from discord.ext.commands import(Context, Cog, command, has_permissions,
     BadArgument, RoleConverter, EmojiConverter, MissingRequiredArgument, CommandError,
     Converter, bot_has_permissions, group, CheckFailure)
+from discord.ext.tasks import loop
 from discord import(Role, Embed, Color, TextChannel, Reaction, User, Member, Emoji, NotFound,
-    Permissions, PermissionOverwrite)
+    Permissions, PermissionOverwrite, Guild, Object, HTTPException, Message)
 from discord import utils
-from datetime import datetime
-from typing import Tuple, Union
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Set, Tuple, Union
 from functools import wraps
+import asyncio
+import heapq
+import time
 
 from ..bot import StoneLegendBot
-from ..converters import SelfRolesListConverter
+from ..converters import SelfRolesListConverter, TimeDeltaConverter
+from ..rest import Priority
+from ..ratelimit import TokenBuckets, DuplicateTracker
+from .admin import requires_admin
+from .util import as_reaction
+
+
+# Thresholds used by `antispam on` until configured
+DEFAULT_ANTISPAM = dict(messages=6, per_seconds=5, duplicates=3, mute_seconds=600)
+# Sliding window for counting duplicate messages
+DUPLICATE_WINDOW = 30
+# Most users returned by a request for the users of a reaction
+REACTION_PAGE_SIZE = 100
 
 
 class Moderation(Cog):
@@ -18,6 +34,253 @@ class Moderation(Cog):
     def __init__(self, bot: StoneLegendBot):
         self.bot = bot
 
+        moderation_config = bot.config['moderation']
+        self._expiry_horizon = moderation_config['expiry_horizon']
+        self._expiry_batch_size = moderation_config['expiry_batch_size']
+        self._expiry_semaphore = asyncio.Semaphore(moderation_config['expiry_concurrency'])
+        self._broadcast_concurrency = moderation_config['broadcast_concurrency']
+        self._broadcast_attempts = moderation_config['broadcast_attempts']
+        self._rr_sync_concurrency = moderation_config['rr_sync_concurrency']
+        self._role_edit_window = moderation_config['role_edit_window']
+        # (guild_id, user_id) -> role changes from role menus waiting to be applied
+        self._pending_roles: Dict[Tuple[int, int], Dict[int, bool]] = {}
+        # (message_id, user_id, role_id) of the reactions on exclusive menus the bot is taking off
+        self._removing_reactions: Set[Tuple[int, int, int]] = set()
+        # Heap of (expires_at, id, guild_id, user_id, action) due within the horizon
+        self._expiries: List[Tuple[int, int, int, int, str]] = []
+        self._loaded_expiries: Set[int] = set()
+
+        first_load = 'Moderation' not in bot.cog_state
+
+        # Anti-spam state per (guild_id, user_id)
+        self._message_buckets: TokenBuckets
+        self._duplicates: DuplicateTracker
+        self._spam_muted: Set[Tuple[int, int]]
+        self._message_buckets, self._duplicates, self._spam_muted = bot.get_cog_state('Moderation',
+            lambda: (TokenBuckets(), DuplicateTracker(), set()))
+
+        self.expiry_loader.start()
+        self.expiry_sweeper.start()
+
+        self._startup_sync = None
+        if moderation_config['rr_sync_on_startup'] and first_load:
+            self._startup_sync = asyncio.ensure_future(self.sync_reaction_roles_on_startup())
+
+    def cog_unload(self):
+        self.expiry_loader.cancel()
+        self.expiry_sweeper.cancel()
+        if self._startup_sync is not None:
+            self._startup_sync.cancel()
+
+    def moderate(self, guild_id: int, factory):
+        """Sends a moderation request ahead of any cosmetic traffic"""
+
+        return self.bot.rest_queue.run(factory, priority=Priority.MODERATION, bucket=('guild', guild_id))
+
+    async def get_mute_role(self, guild: Guild) -> Role:
+        """Returns the Muted role of the guild, creating it if it does not exist"""
+
+        mute_role = utils.get(guild.roles, name="Muted")
+        if mute_role is None:
+            mute_role = await guild.create_role(name="Muted")
+            for channel in guild.channels:
+                overwrites = channel.overwrites
+                overwrites[mute_role] = PermissionOverwrite(send_messages=False,
+                    add_reactions=False)
+                await channel.edit(overwrites=overwrites)
+
+        return mute_role
+
+    def _push_expiry(self, expiry_id: int, expires_at: int, guild_id: int, user_id: int, action: str):
+        if expiry_id not in self._loaded_expiries:
+            self._loaded_expiries.add(expiry_id)
+            heapq.heappush(self._expiries, (expires_at, expiry_id, guild_id, user_id, action))
+
+    async def schedule_expiry(self, guild_id: int, user_id: int, action: str, duration: timedelta):
+        """Persists the expiry of a temporary mute or ban, keeping it in memory if it is imminent"""
+
+        expires_at = int(time.time() + duration.total_seconds())
+        expiry_id = await self.bot.db.insert_mod_expiry(guild_id, user_id, action, expires_at)
+        if expires_at <= time.time() + self._expiry_horizon:
+            self._push_expiry(expiry_id, expires_at, guild_id, user_id, action)
+
+    async def cancel_expiry(self, guild_id: int, user_id: int, action: str):
+        """Forgets the pending expiry of a user, if any"""
+
+        await self.bot.db.delete_mod_expiry_for_user(guild_id, user_id, action)
+
+        remaining = [entry for entry in self._expiries if entry[2:] != (guild_id, user_id, action)]
+        if len(remaining) != len(self._expiries):
+            self._loaded_expiries.difference_update(entry[1] for entry in self._expiries
+                if entry[2:] == (guild_id, user_id, action))
+            self._expiries = remaining
+            heapq.heapify(self._expiries)
+
+    @loop(seconds=60)
+    async def expiry_loader(self):
+        """Loads the expiries which are due within the horizon from the db"""
+
+        await self.bot.wait_until_ready()
+
+        rows = await self.bot.db.get_mod_expiries_before(int(time.time() + self._expiry_horizon),
+            self._expiry_batch_size * 10)
+        for expiry_id, guild_id, user_id, action, expires_at in rows:
+            self._push_expiry(expiry_id, expires_at, guild_id, user_id, action)
+
+    @loop(seconds=1)
+    async def expiry_sweeper(self):
+        """Reverts the temporary mutes and bans which are due, a batch at a time"""
+
+        await self.bot.wait_until_ready()
+
+        while self._expiries and self._expiries[0][0] <= time.time():
+            batch = []
+            while self._expiries and self._expiries[0][0] <= time.time() \
+                and len(batch) < self._expiry_batch_size:
+                batch.append(heapq.heappop(self._expiries))
+
+            # An unexpected error of one expiry must not stop the others nor the loop
+            results = await asyncio.gather(*(self._expire(guild_id, user_id, action)
+                for _, _, guild_id, user_id, action in batch), return_exceptions=True)
+
+            # Failed expiries stay in the db, and so do the others if the delete
+            # fails. The loader picks them up again, reverting twice is harmless
+            expiry_ids = [entry[1] for entry, result in zip(batch, results)
+                if not isinstance(result, BaseException)]
+            try:
+                await self.bot.db.delete_mod_expiries(expiry_ids)
+            except Exception:
+                pass
+            finally:
+                self._loaded_expiries.difference_update(entry[1] for entry in batch)
+
+    async def _expire(self, guild_id: int, user_id: int, action: str):
+        if (guild := self.bot.get_guild(guild_id)) is None:
+            return
+
+        async with self._expiry_semaphore:
+            try:
+                if action == 'mute':
+                    member = await self.bot.get_or_fetch_member(guild, user_id)
+                    mute_role = utils.get(guild.roles, name="Muted")
+                    if member is None or mute_role is None:
+                        return
+                    await self.moderate(guild_id,
+                        lambda: member.remove_roles(mute_role, reason='Temporary mute expired'))
+                    self.bot.case_log.record(guild_id, 'unmute', user_id, self.bot.user.id,
+                        'Temporary mute expired')
+                else:
+                    await self.moderate(guild_id,
+                        lambda: guild.unban(Object(id=user_id), reason='Temporary ban expired'))
+                    self.bot.case_log.record(guild_id, 'unban', user_id, self.bot.user.id,
+                        'Temporary ban expired')
+            except HTTPException:
+                pass # Already reverted or no longer permitted
+
+    @Cog.listener('on_message')
+    async def check_spam(self, message: Message):
+        """Mutes members who flood messages or repeat the same message"""
+
+        if not isinstance(message.author, Member) or message.author.bot:
+            return
+
+        settings = await self.bot.db.get_antispam(message.guild.id)
+        if settings is None or not settings['enabled']:
+            return
+
+        key = (message.guild.id, message.author.id)
+        if key in self._spam_muted:
+            return
+
+        now = time.monotonic()
+        flooding = not self._message_buckets.consume(key, now,
+            rate=settings['messages'] / settings['per_seconds'], capacity=settings['messages'])
+        repeats = self._duplicates.add(key, now, hash(message.content.strip().lower()), DUPLICATE_WINDOW) \
+            if message.content else 0
+
+        if flooding or repeats >= settings['duplicates']:
+            self._spam_muted.add(key)
+            try:
+                await self._mute_spammer(message.author, settings['mute_seconds'],
+                    'Flooding' if flooding else 'Repeating messages')
+            finally:
+                self._spam_muted.discard(key)
+                self._message_buckets.reset(key)
+                self._duplicates.reset(key)
+
+    async def _mute_spammer(self, member: Member, mute_seconds: int, reason: str):
+        guild = member.guild
+        if guild.me.top_role <= member.top_role or member.guild_permissions.manage_messages:
+            return # Out of reach, or a moderator
+
+        mute_role = await self.get_mute_role(guild)
+        if mute_role in member.roles:
+            return
+
+        try:
+            await self.moderate(guild.id, lambda: member.add_roles(mute_role, reason=f'Anti-spam: {reason}'))
+        except HTTPException:
+            return
+
+        await self.cancel_expiry(guild.id, member.id, 'mute')
+        await self.schedule_expiry(guild.id, member.id, 'mute', timedelta(seconds=mute_seconds))
+        self.bot.case_log.record(guild.id, 'mute', member.id, self.bot.user.id,
+            f'Anti-spam: {reason} (for {timedelta(seconds=mute_seconds)})')
+
+    @has_permissions(manage_guild=True)
+    @group(name='antispam', invoke_without_command=True)
+    async def antispam(self, ctx: Context):
+        """Shows the anti-spam settings of the server"""
+
+        settings = await self.bot.db.get_antispam(ctx.guild.id)
+        if settings is None:
+            await ctx.send(f'Anti-spam is not set up, use `{ctx.prefix}antispam on` to enable it')
+            return
+
+        await ctx.send(embed=Embed(
+            title='Anti-spam ' + ('enabled' if settings['enabled'] else 'disabled'),
+            description=f"Mutes members sending more than {settings['messages']} messages "
+                + f"in {settings['per_seconds']} seconds, or the same message {settings['duplicates']} "
+                + f"times in {DUPLICATE_WINDOW} seconds, for {timedelta(seconds=settings['mute_seconds'])}",
+            color=Color.green()
+        ))
+
+    async def _update_antispam(self, ctx: Context, **changes):
+        settings = dict(DEFAULT_ANTISPAM, enabled=True)
+        settings.update(await self.bot.db.get_antispam(ctx.guild.id) or {})
+        settings.update(changes)
+        await self.bot.db.update_antispam(ctx.guild.id, **settings)
+        await ctx.send('Updated.')
+
+    @has_permissions(manage_guild=True)
+    @antispam.command(name='on')
+    async def antispam_on(self, ctx: Context):
+        """Enables anti-spam"""
+
+        await self._update_antispam(ctx, enabled=True)
+
+    @has_permissions(manage_guild=True)
+    @antispam.command(name='off')
+    async def antispam_off(self, ctx: Context):
+        """Disables anti-spam"""
+
+        await self._update_antispam(ctx, enabled=False)
+
+    @has_permissions(manage_guild=True)
+    @antispam.command(name='set')
+    async def antispam_set(self, ctx: Context, messages: int, per_seconds: int, duplicates: int,
+        mute_duration: TimeDeltaConverter):
+        """Sets the anti-spam thresholds
+        Example: antispam set 6 5 3 10m
+        mutes for 10 minutes anyone sending more than 6 messages in 5 seconds
+        or the same message 3 times"""
+
+        if min(messages, per_seconds, duplicates) < 1 or mute_duration.total_seconds() < 1:
+            raise BadArgument('Thresholds must be positive')
+
+        await self._update_antispam(ctx, messages=messages, per_seconds=per_seconds,
+            duplicates=duplicates, mute_seconds=int(mute_duration.total_seconds()))
+
     @has_permissions(administrator=True)
     @command(name='announce', alias=('annoucement',))
     async def make_announcement(self, ctx: Context, *, announcement: str):
@@ -50,29 +313,152 @@ class Moderation(Cog):
         await self.bot.db.update_annouce_role(ctx.guild.id, role.id)
         await ctx.send('Updated.')
 
+    @has_permissions(administrator=True)
+    @command(name='announcechannel')
+    async def update_announce_channel(self, ctx: Context, channel: Optional[TextChannel] = None):
+        """Sets the channel receiving broadcast announcements, leave it out to stop receiving them"""
+
+        await self.bot.db.update_announce_channel(ctx.guild.id, channel.id if channel is not None else None)
+        await ctx.send('Updated.')
+
+    async def _broadcast_to(self, guild: Guild, channel: TextChannel, embed: Embed,
+        semaphore: asyncio.Semaphore) -> Optional[str]:
+        """Sends a broadcast announcement to one guild, retrying server errors.
+        Returns None on success, otherwise the reason it failed"""
+
+        role_id = await self.bot.db.get_announcement_role(guild.id)
+        role = guild.get_role(role_id) if role_id is not None else None
+
+        reason = None
+        async with semaphore:
+            for attempt in range(self._broadcast_attempts):
+                try:
+                    await self.bot.rest_queue.run(
+                        lambda: channel.send(role.mention if role is not None else None, embed=embed),
+                        priority=Priority.MESSAGE, bucket=('channel', channel.id))
+                    return None
+                except HTTPException as e:
+                    reason = e.text or str(e)
+                    if e.status < 500:
+                        # Missing permissions and the like won't go away by retrying
+                        return reason
+                except (asyncio.TimeoutError, OSError) as e:
+                    reason = str(e) or type(e).__name__
+
+                if attempt + 1 < self._broadcast_attempts:
+                    await asyncio.sleep(2 ** attempt)
+
+        return reason
+
+    @requires_admin()
+    @command(name='broadcast', aliases=('announceall',))
+    async def broadcast_announcement(self, ctx: Context, *, announcement: str):
+        """Posts an announcement in every server which set an announcement channel"""
+
+        targets = []
+        missing = []
+        for guild in self.bot.guilds:
+            channel_id = await self.bot.db.get_announce_channel(guild.id)
+            if channel_id is None:
+                continue
+            if (channel := guild.get_channel(channel_id)) is None:
+                missing.append(f'{guild.name}: announcement channel was deleted')
+            else:
+                targets.append((guild, channel))
+
+        embed = Embed(
+            title="Annoucement",
+            description=announcement,
+            timestamp=datetime.utcnow()
+        )
+        semaphore = asyncio.Semaphore(self._broadcast_concurrency)
+
+        started = time.monotonic()
+        results = await asyncio.gather(*(self._broadcast_to(guild, channel, embed, semaphore)
+            for guild, channel in targets), return_exceptions=True)
+        elapsed = time.monotonic() - started
+
+        # Errors _broadcast_to does not handle end up here as exceptions
+        failed = missing + [f'{guild.name}: ' + (type(reason).__name__ if isinstance(reason, BaseException) else reason)
+            for (guild, _), reason in zip(targets, results) if reason is not None]
+        sent = len(targets) + len(missing) - len(failed)
+
+        summary = Embed(
+            title='Broadcast',
+            description=f'Sent to {sent}/{len(targets) + len(missing)} servers in {elapsed:.1f}s',
+            color=Color.orange() if failed else Color.green()
+        )
+        if failed:
+            summary.add_field(name='Failed', value='\n'.join(failed)[:1024], inline=False)
+        await ctx.send(embed=summary)
+
     @Cog.listener()
     async def on_raw_reaction_add(self, payload):
 
         if payload.guild_id is None:
             return
 
-        guild = self.bot.get_guild(payload.guild_id)
-        member = guild.get_member(payload.user_id)
-        
-        # Skip bots
-        if member.bot:
-            return
-
         role_id = await self.bot.db.get_role_for_reaction(payload.guild_id,
             payload.channel_id, payload.message_id, str(payload.emoji))
         if role_id is None:
             return # Not a reaction role
 
+        guild = self.bot.get_guild(payload.guild_id)
+        member = payload.member or await self.bot.get_or_fetch_member(guild, payload.user_id)
+
+        # Skip bots
+        if member is None or member.bot:
+            return
+
         role = guild.get_role(role_id)
         if role is None:
-            guild.get_channel(payload.channel_id).send('Could not find that role!')
-        else:
-            await member.add_roles(role)
+            await guild.get_channel(payload.channel_id).send('Could not find that role!')
+            return
+
+        changes = {role_id: True}
+        group = await self.bot.db.get_exclusive_reaction_roles(payload.message_id)
+        if group is not None:
+            # Picking a role of an exclusive menu takes off the others, and the reaction
+            # of the role the member had (or is about to get)
+            pending = self._pending_roles.get((guild.id, member.id), {})
+            held = {role.id for role in member.roles} | {other_id for other_id, add in pending.items() if add}
+            for emoji_str, other_id in group.items():
+                if other_id == role_id:
+                    continue
+                changes[other_id] = False
+                if other_id in held:
+                    self._remove_menu_reaction(guild, payload.channel_id, payload.message_id, member.id,
+                        emoji_str, other_id)
+
+        self.queue_role_changes(member, changes)
+
+    def _has_picked(self, guild: Guild, user_id: int, role_id: int) -> bool:
+        """Whether the member holds or is about to get a role, as far as the bot knows"""
+
+        pending = self._pending_roles.get((guild.id, user_id))
+        if pending is not None and role_id in pending:
+            return pending[role_id]
+        member = guild.get_member(user_id)
+        return member is not None and utils.get(member.roles, id=role_id) is not None
+
+    def _remove_menu_reaction(self, guild: Guild, channel_id: int, message_id: int, user_id: int,
+        emoji_str: str, role_id: int):
+        """Takes off the reaction for a role the member gave up for another one of an
+        exclusive menu, unless they picked it again before the removal is sent"""
+
+        key = (message_id, user_id, role_id)
+
+        async def remove():
+            if self._has_picked(guild, user_id, role_id):
+                return
+            # The removal event is then ignored, the role change is already queued
+            self._removing_reactions.add(key)
+            try:
+                await self.bot.http.remove_reaction(channel_id, message_id, as_reaction(emoji_str), user_id)
+            except HTTPException:
+                self._removing_reactions.discard(key)
+
+        self.bot.rest_queue.submit(remove, priority=Priority.COSMETIC, bucket=('reaction', channel_id))
 
     @Cog.listener()
     async def on_raw_reaction_remove(self, payload):
@@ -80,46 +466,258 @@ class Moderation(Cog):
         if payload.guild_id is None:
             return
 
-        guild = self.bot.get_guild(payload.guild_id)
-        member = guild.get_member(payload.user_id)
-        
-        # Skip bots
-        if member.bot:
-            return
-
         role_id = await self.bot.db.get_role_for_reaction(payload.guild_id,
             payload.channel_id, payload.message_id, str(payload.emoji))
         if role_id is None:
             return # Not a reaction role
 
-        role = guild.get_role(role_id)
-        if role is not None:
-            await member.remove_roles(role)
+        key = (payload.message_id, payload.user_id, role_id)
+        if key in self._removing_reactions:
+            # Taken off by the bot for another pick of an exclusive menu
+            self._removing_reactions.discard(key)
+            return
+
+        guild = self.bot.get_guild(payload.guild_id)
+        member = await self.bot.get_or_fetch_member(guild, payload.user_id)
+
+        # Skip bots
+        if member is None or member.bot:
+            return
+
+        if guild.get_role(role_id) is not None:
+            self.queue_role_changes(member, {role_id: False})
+
+    def queue_role_changes(self, member: Member, changes: Dict[int, bool]):
+        """Merges role changes of a member ({role_id: True to add, False to remove}) with
+        the pending ones, so that a burst of clicks on role menus costs a single role edit"""
+
+        key = (member.guild.id, member.id)
+        pending = self._pending_roles.get(key)
+        if pending is None:
+            pending = self._pending_roles[key] = {}
+            asyncio.ensure_future(self._apply_role_changes(member))
+        pending.update(changes)
+
+    async def _apply_role_changes(self, member: Member):
+        """Applies the pending role changes of a member at the end of the window, then
+        the ones made while the edit was sent, until there are none left"""
+
+        guild = member.guild
+        key = (guild.id, member.id)
+        try:
+            while True:
+                await asyncio.sleep(self._role_edit_window)
+                changes = self._pending_roles[key]
+                if not changes:
+                    break
+                self._pending_roles[key] = {}
+
+                try:
+                    await self.moderate(guild.id, lambda: self._edit_roles(member, changes, 'Self roles'))
+                except HTTPException:
+                    pass
+        finally:
+            del self._pending_roles[key]
+            # A member fetched outside of the member cache now has outdated roles
+            if guild.get_member(member.id) is None:
+                self.bot.recent_members.pop(key)
+
+    async def _edit_roles(self, member: Member, changes: Dict[int, bool], reason: str):
+        """Applies role changes ({role_id: True to add, False to remove}) in a single edit.
+        The roles are read from the member cache when the request is sent, so that roles
+        given meanwhile, like a mute, are kept. The roles of a member outside of the cache
+        may be outdated, so only the changed ones are added and removed, one by one"""
+
+        guild = member.guild
+        cached = guild.get_member(member.id)
+        if cached is None:
+            add = [Object(id=role_id) for role_id, added in changes.items()
+                if added and guild.get_role(role_id) is not None]
+            remove = [Object(id=role_id) for role_id, added in changes.items() if not added]
+            if add:
+                await member.add_roles(*add, reason=reason)
+            if remove:
+                await member.remove_roles(*remove, reason=reason)
+            return
+
+        role_ids = [role.id for role in cached.roles if not role.is_default()]
+        new_role_ids = [role_id for role_id in role_ids if changes.get(role_id, True)] \
+            + [role_id for role_id, added in changes.items()
+                if added and role_id not in role_ids and guild.get_role(role_id) is not None]
+        if new_role_ids != role_ids:
+            await cached.edit(roles=[Object(id=role_id) for role_id in new_role_ids], reason=reason)
+
+    async def _read_reactors(self, channel_id: int, message_id: int, emoji_str: str,
+        semaphore: asyncio.Semaphore) -> Set[int]:
+        """Returns the ids of the users (bots excluded) who reacted with an emoji,
+        paging through the raw reaction users a hundred at a time"""
+
+        emoji = as_reaction(emoji_str)
+        reactors, after = set(), None
+        while True:
+            async with semaphore:
+                users = await self.bot.http.get_reaction_users(channel_id, message_id, emoji,
+                    REACTION_PAGE_SIZE, after=after)
+            reactors.update(int(user['id']) for user in users if not user.get('bot'))
+            if len(users) < REACTION_PAGE_SIZE:
+                return reactors
+            after = users[-1]['id']
+
+    async def sync_reaction_roles(self, guild: Guild) -> Dict[str, int]:
+        """Gives the menu roles to the members who reacted for them and takes them from
+        those who did not, fixing up the reactions missed while the bot was offline.
+        Returns the counts of what was done"""
+
+        menus = await self.bot.db.get_reaction_role_menus(guild.id)
+        counts = dict(menus=len(menus), unreadable=0, reactions=0, added=0, removed=0, failed=0)
+        semaphore = asyncio.Semaphore(self._rr_sync_concurrency)
+
+        # Users who reacted for each role, on any menu of the guild
+        reactors: Dict[int, Set[int]] = {}
+        # Roles of menus which could not be read, left alone rather than taken from everyone
+        unknown: Set[int] = set()
+        # Users left alone for each role, when they picked more than one role of an exclusive menu
+        conflicted: Dict[int, Set[int]] = {}
+
+        async def read_menu(message_id: int, channel_id: int, roles: Dict[str, int], exclusive: bool):
+            try:
+                results = await asyncio.gather(*(self._read_reactors(channel_id, message_id, emoji_str, semaphore)
+                    for emoji_str in roles))
+            except HTTPException:
+                # Deleted message or channel, or missing access
+                counts['unreadable'] += 1
+                unknown.update(roles.values())
+                return
+
+            for role_id, user_ids in zip(roles.values(), results):
+                counts['reactions'] += len(user_ids)
+                reactors.setdefault(role_id, set()).update(user_ids)
+
+            if exclusive:
+                seen, repeated = set(), set()
+                for user_ids in results:
+                    repeated |= seen & user_ids
+                    seen |= user_ids
+                for role_id in roles.values():
+                    conflicted.setdefault(role_id, set()).update(repeated)
+
+        await asyncio.gather(*(read_menu(message_id, channel_id, roles, exclusive)
+            for message_id, (channel_id, roles, exclusive) in menus.items()))
+
+        await self.bot.ensure_chunked(guild)
+
+        # user_id -> (roles to add, roles to remove)
+        changes: Dict[int, Tuple[List[Role], List[Role]]] = {}
+        for role_id, user_ids in reactors.items():
+            if role_id in unknown or (role := guild.get_role(role_id)) is None:
+                continue
+
+            holders = {member.id for member in role.members if not member.bot}
+            user_ids = user_ids - conflicted.get(role_id, set())
+            holders -= conflicted.get(role_id, set())
+            for user_id in user_ids - holders:
+                # Reactions of users who left the guild stay behind
+                if guild.get_member(user_id) is not None:
+                    changes.setdefault(user_id, ([], []))[0].append(role)
+            for user_id in holders - user_ids:
+                changes.setdefault(user_id, ([], []))[1].append(role)
+
+        async def apply(member: Member, add: List[Role], remove: List[Role]):
+            role_changes = dict.fromkeys((role.id for role in add), True)
+            role_changes.update(dict.fromkeys((role.id for role in remove), False))
+            async with semaphore:
+                try:
+                    # One edit per member, behind moderation and paced by the guild bucket
+                    await self.bot.rest_queue.run(
+                        lambda: self._edit_roles(member, role_changes, 'Reaction role sync'),
+                        priority=Priority.MESSAGE, bucket=('guild', guild.id))
+                    counts['added'] += len(add)
+                    counts['removed'] += len(remove)
+                except HTTPException:
+                    counts['failed'] += 1
+
+        # Errors other than HTTPException (which dropped requests are too) count as failed as well
+        results = await asyncio.gather(*(apply(guild.get_member(user_id), add, remove)
+            for user_id, (add, remove) in changes.items() if guild.get_member(user_id) is not None),
+            return_exceptions=True)
+        counts['failed'] += sum(1 for result in results if isinstance(result, BaseException))
+        return counts
+
+    async def sync_reaction_roles_on_startup(self):
+        """Syncs the reaction roles of every guild once the bot is ready"""
+
+        await self.bot.wait_until_ready()
+        for guild in self.bot.guilds:
+            try:
+                await self.sync_reaction_roles(guild)
+            except HTTPException:
+                pass
 
     @has_permissions(administrator=True)
-    @command(name='selfroles', aliases=('rr', 'reactionroles'))
+    @group(name='selfroles', aliases=('rr', 'reactionroles'), invoke_without_command=True)
     async def create_self_roles(self, ctx: Context, channel: TextChannel, *,
         entries: SelfRolesListConverter):
         """Creates a self roles message
         entries must be triplets of role, emoji, description separated by space
         Example: selfroles #RolesChannel @CoolRole \N{smiling face with sunglasses} A cool role
-        @Evil \N{smiling face with horns} Evil role"""
+        @Evil \N{smiling face with horns} Evil role
+        Use selfroles exclusive for a menu where only one role can be picked
+        Use selfroles sync to catch up with reactions changed while the bot was offline"""
+
+        await self.send_self_roles_menu(ctx, channel, entries, exclusive=False)
+
+    @has_permissions(administrator=True)
+    @create_self_roles.command(name='exclusive', aliases=('one',))
+    async def create_exclusive_self_roles(self, ctx: Context, channel: TextChannel, *,
+        entries: SelfRolesListConverter):
+        """Creates a self roles message where picking a role takes off the others of the menu.
+        entries are given like for selfroles"""
+
+        await self.send_self_roles_menu(ctx, channel, entries, exclusive=True)
+
+    async def send_self_roles_menu(self, ctx: Context, channel: TextChannel, entries, exclusive: bool):
+        """Posts a role menu with the (role, emoji, description) entries and registers its reactions"""
 
         # Build and send message
         roles_list = "\n\n".join(f"{reactable} {role.mention}\n{desc}" \
             for role, reactable, desc in entries)
         target_message = await channel.send(embed=Embed(title="Role Menu",
-            description=roles_list))
+            description=roles_list + ("\n\n*Pick one*" if exclusive else "")))
 
         await ctx.send('Creating...')
 
         for role, reactable, _ in entries:
             await self.bot.db.insert_reaction_role(ctx.guild.id,
-                target_message.channel.id, target_message.id, role.id, str(reactable))
+                target_message.channel.id, target_message.id, role.id, str(reactable), exclusive)
             await target_message.add_reaction(reactable)
 
         await ctx.send('Reaction roles set-up!')
 
+    @has_permissions(administrator=True)
+    @bot_has_permissions(manage_roles=True)
+    @create_self_roles.command(name='sync')
+    async def sync_self_roles(self, ctx: Context):
+        """Gives and takes the roles of the role menus in this server to match the reactions,
+        for reactions added or removed while the bot was offline"""
+
+        progress_msg = await ctx.send('Syncing reaction roles...')
+        started = time.monotonic()
+        counts = await self.sync_reaction_roles(ctx.guild)
+        elapsed = time.monotonic() - started
+
+        await progress_msg.delete()
+        await ctx.send(embed=Embed(
+            title='Reaction roles synced',
+            description=f"Menus: {counts['menus']}"
+                + (f" ({counts['unreadable']} could not be read)" if counts['unreadable'] else '') + '\n'
+                + f"Reactions: {counts['reactions']}\n"
+                + f"Roles added: {counts['added']}\n"
+                + f"Roles removed: {counts['removed']}\n"
+                + f"Failed: {counts['failed']}\n"
+                + f'Took {elapsed:.1f}s',
+            color=Color.orange() if counts['failed'] or counts['unreadable'] else Color.green()
+        ))
+
     @has_permissions(administrator=True)
     @command(name='welcome', aliases=('wc',))
     async def set_welcome_channel(self, ctx: Context, channel: TextChannel):
@@ -128,17 +726,22 @@ class Moderation(Cog):
         await self.bot.db.update_welcome_channel(ctx.guild.id, channel.id)
         await ctx.send('Updated')
 
-    async def delete_messages(self, ctx: Context, limit: int, check: callable = lambda message: True):
+    async def delete_messages(self, ctx: Context, limit: int, check: callable = lambda message: True,
+        user: Member = None):
         """Generalized function for purge commands. `check` is used as a filter on the messages"""
 
         progress_msg = await ctx.send('A purge is in progress...')
+        deleted = 0
         async for message in ctx.channel.history(limit=limit + 1, before=ctx.message):
             if message == ctx.message or (await utils.maybe_coroutine(check, message)):
                 try:
                     await message.delete()
+                    deleted += 1
                 except NotFound:
                     pass
         await progress_msg.delete()
+        self.bot.case_log.record(ctx.guild.id, 'purge', user.id if user else None, ctx.author.id,
+            f'{deleted} messages in #{ctx.channel}')
         await ctx.send("Purge complete.", delete_after=3)
 
     @has_permissions(manage_messages=True)
@@ -156,7 +759,7 @@ class Moderation(Cog):
     async def purge_user(self, ctx: Context, user: Member, limit: int = 10):
         """Delete messages from the specified user"""
 
-        await self.delete_messages(ctx, limit, lambda msg: msg.author == user)
+        await self.delete_messages(ctx, limit, lambda msg: msg.author == user, user)
 
     @has_permissions(manage_messages=True)
     @bot_has_permissions(manage_messages=True)
@@ -180,46 +783,58 @@ class Moderation(Cog):
         if user == ctx.bot.user:
             raise CheckFailure('Not gonna kick myself, sorry.')
 
-        await user.kick(reason=reason)
+        await self.moderate(ctx.guild.id, lambda: user.kick(reason=reason))
+        self.bot.case_log.record(ctx.guild.id, 'kick', user.id, ctx.author.id, reason)
         await ctx.channel.send(f'{user} has been kicked\nReason: {reason}')
 
     @has_permissions(ban_members=True)
     @bot_has_permissions(ban_members=True)
     @command(name='ban')
-    async def ban_user(self, ctx: Context, user: Member, *, reason: str = None):
+    async def ban_user(self, ctx: Context, user: Member, duration: Optional[TimeDeltaConverter] = None,
+        *, reason: str = None):
         """Kicks a member from the server.
-        You must have kick members permission"""
+        You must have kick members permission
+        Pass a duration (like 1d12h) to ban them temporarily"""
 
         if ctx.author.top_role <= user.top_role:
             raise CheckFailure('Your role is not high enough to ban that person!')
         if user == ctx.bot.user:
             raise CheckFailure('Not gonna ban myself, sorry.')
 
-        await user.ban(reason=reason)
-        await ctx.channel.send(f'{user} has been banned\nReason: {reason}')
+        await self.moderate(ctx.guild.id, lambda: user.ban(reason=reason))
+        await self.cancel_expiry(ctx.guild.id, user.id, 'ban')
+        if duration is not None:
+            await self.schedule_expiry(ctx.guild.id, user.id, 'ban', duration)
+
+        self.bot.case_log.record(ctx.guild.id, 'ban', user.id, ctx.author.id,
+            f'{reason} (for {duration})' if duration else reason)
+        await ctx.channel.send(f'{user} has been banned' + (f' for {duration}' if duration else '')
+            + f'\nReason: {reason}')
 
     @has_permissions(manage_messages=True)
     @bot_has_permissions(manage_roles=True)
     @command(name='mute')
-    async def mute_user(self, ctx: Context, user: Member, *, reason: str = None):
-        """Mutes a user"""
+    async def mute_user(self, ctx: Context, user: Member, duration: Optional[TimeDeltaConverter] = None,
+        *, reason: str = None):
+        """Mutes a user
+        Pass a duration (like 2h) to mute them temporarily"""
 
         if ctx.author.top_role <= user.top_role:
             raise CheckFailure('Your role is not high enough to mute that person!')
         if user == ctx.bot.user:
             raise CheckFailure('Not gonna mute myself, sorry.')
 
-        mute_role = utils.get(ctx.guild.roles, name="Muted")
-        if mute_role is None:
-            mute_role = await ctx.guild.create_role(name="Muted")
-            for channel in ctx.guild.channels:
-                overwrites = channel.overwrites
-                overwrites[mute_role] = PermissionOverwrite(send_messages=False,
-                    add_reactions=False)
-                await channel.edit(overwrites=overwrites)
+        mute_role = await self.get_mute_role(ctx.guild)
+
+        await self.moderate(ctx.guild.id, lambda: user.add_roles(mute_role))
+        await self.cancel_expiry(ctx.guild.id, user.id, 'mute')
+        if duration is not None:
+            await self.schedule_expiry(ctx.guild.id, user.id, 'mute', duration)
 
-        await user.add_roles(mute_role)
-        await ctx.channel.send(f'{user.mention} has been muted\nReason: {reason}')
+        self.bot.case_log.record(ctx.guild.id, 'mute', user.id, ctx.author.id,
+            f'{reason} (for {duration})' if duration else reason)
+        await ctx.channel.send(f'{user.mention} has been muted' + (f' for {duration}' if duration else '')
+            + f'\nReason: {reason}')
 
     @has_permissions(manage_messages=True)
     @bot_has_permissions(manage_roles=True)
@@ -234,8 +849,32 @@ class Moderation(Cog):
             or mute_role not in user.roles:
             raise CheckFailure(f"{user} doesn't seems mute.")
 
-        await user.remove_roles(mute_role)
+        await self.moderate(ctx.guild.id, lambda: user.remove_roles(mute_role))
+        await self.cancel_expiry(ctx.guild.id, user.id, 'mute')
+        self.bot.case_log.record(ctx.guild.id, 'unmute', user.id, ctx.author.id)
         await ctx.send(f"Unmuted {user}")
 
+    @has_permissions(manage_messages=True)
+    @command(name='cases', aliases=('history', 'modlog'))
+    async def show_cases(self, ctx: Context, user: Union[User, int], limit: int = 10):
+        """Shows the latest moderation cases of a user"""
+
+        user_id = user if isinstance(user, int) else user.id
+        cases = await self.bot.case_log.search(ctx.guild.id, user_id, min(limit, 25))
+
+        if not cases:
+            await ctx.send(embed=Embed(description=f'No cases for <@{user_id}>', color=Color.green()))
+            return
+
+        embed = Embed(title='Moderation cases', description=f'<@{user_id}>', color=Color.orange())
+        for _, case_number, action, _, moderator_id, reason, created_at in cases:
+            embed.add_field(
+                name=f"#{case_number or '?'} {action}",
+                value=f"By <@{moderator_id}> on {datetime.utcfromtimestamp(created_at):%Y-%m-%d %H:%M} UTC\n"
+                    + f"Reason: {reason}",
+                inline=False
+            )
+        await ctx.send(embed=embed)
+
 def setup(bot: StoneLegendBot):
     bot.add_cog(Moderation(bot))
\ No newline at end of file
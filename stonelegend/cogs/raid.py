@@ -0,0 +1,158 @@
+from discord.ext.commands import(Context, Cog, group, has_permissions, bot_has_permissions,
+    check_any, BadArgument)
+from discord import Embed, Color, Member, Object, HTTPException
+from datetime import datetime
+from typing import Callable, List, Union
+import asyncio
+import re
+
+from ..bot import StoneLegendBot
+from ..converters import TimeDeltaConverter
+from ..rest import Priority
+
+
+class Raid(Cog):
+    """Bulk moderation commands for cleaning up raids"""
+
+    def __init__(self, bot: StoneLegendBot):
+        self.bot = bot
+        self._concurrency = bot.config['moderation']['raid_concurrency']
+
+    async def select_targets(self, ctx: Context, selector: str, value: str) -> List[Union[Member, Object]]:
+        """Resolves the targets of a mass action from the member cache"""
+
+        guild = ctx.guild
+        await self.bot.ensure_chunked(guild)
+        selector = selector.lower()
+
+        if selector == 'ids':
+            try:
+                user_ids = {int(user_id) for user_id in value.replace(',', ' ').split()}
+            except ValueError:
+                raise BadArgument(f"{value} is not a list of user IDs")
+            return [guild.get_member(user_id) or Object(id=user_id) for user_id in user_ids]
+
+        if selector == 'joined':
+            since = datetime.utcnow() - await TimeDeltaConverter().convert(ctx, value)
+            check = lambda member: member.joined_at is not None and member.joined_at >= since
+        elif selector == 'age':
+            since = datetime.utcnow() - await TimeDeltaConverter().convert(ctx, value)
+            check = lambda member: member.created_at >= since
+        elif selector == 'name':
+            try:
+                pattern = re.compile(value, re.IGNORECASE)
+            except re.error as e:
+                raise BadArgument(f"{value} is not a valid regular expression: {e}")
+            check = lambda member: pattern.search(member.name) is not None \
+                or (member.nick is not None and pattern.search(member.nick) is not None)
+        else:
+            raise BadArgument(f"Unknown selector {selector}, use one of ids, joined, age or name")
+
+        return [member for member in guild.members if check(member)]
+
+    def _is_protected(self, ctx: Context, target: Union[Member, Object]) -> bool:
+        """Whether the target is out of reach of the moderator (or is the bot itself)"""
+
+        if target.id in (ctx.author.id, self.bot.user.id):
+            return True
+        return isinstance(target, Member) and (target.bot or ctx.author.top_role <= target.top_role)
+
+    async def mass_action(self, ctx: Context, action: str, targets: List[Union[Member, Object]],
+        apply: Callable[[Union[Member, Object]], object]):
+        """Applies `apply` to every target with bounded concurrency, streaming the
+        progress into one message and posting a summary at the end"""
+
+        guild = ctx.guild
+        total = len(targets)
+        skipped = [target for target in targets if self._is_protected(ctx, target)]
+        targets = [target for target in targets if not self._is_protected(ctx, target)]
+        done, failed = 0, []
+
+        progress_msg = await ctx.send(f'{action.capitalize()}: 0/{len(targets)}')
+        semaphore = asyncio.Semaphore(self._concurrency)
+
+        def report_progress():
+            content = f'{action.capitalize()}: {done}/{len(targets)}' \
+                + (f' ({len(failed)} failed)' if failed else '')
+            self.bot.rest_queue.submit(lambda: progress_msg.edit(content=content),
+                priority=Priority.COSMETIC, bucket=('channel', ctx.channel.id),
+                key=('raid-progress', progress_msg.id))
+
+        async def run(target):
+            nonlocal done
+            async with semaphore:
+                try:
+                    await self.bot.rest_queue.run(lambda: apply(target),
+                        priority=Priority.MODERATION, bucket=('guild', guild.id))
+                    self.bot.case_log.record(guild.id, action, target.id, ctx.author.id, 'Raid cleanup')
+                except HTTPException:
+                    failed.append(target)
+                done += 1
+                report_progress()
+
+        started = datetime.utcnow()
+        await asyncio.gather(*(run(target) for target in targets))
+        elapsed = (datetime.utcnow() - started).total_seconds()
+
+        report_progress()
+        await ctx.send(embed=Embed(
+            title=f'Raid cleanup: {action}',
+            description=f'Matched: {total}\n'
+                + f'Done: {done - len(failed)}\n'
+                + f'Failed: {len(failed)}\n'
+                + f'Skipped (protected): {len(skipped)}\n'
+                + f'Took {elapsed:.1f}s',
+            color=Color.orange() if failed else Color.green()
+        ))
+
+    @group(name='raid', invoke_without_command=True)
+    async def raid(self, ctx: Context):
+        """Bulk moderation commands for raids.
+        Targets are selected with one of:
+        ids <id> <id> ... - the given user IDs
+        joined <duration> - members who joined within the duration, like 15m
+        age <duration> - members whose account is younger than the duration, like 1d
+        name <regex> - members whose name matches the regular expression
+        Use raid preview first to check who is going to be affected.
+        Each subcommand requires the permission of its action"""
+
+        await ctx.send_help(ctx.command)
+
+    @check_any(has_permissions(ban_members=True), has_permissions(kick_members=True))
+    @raid.command(name='preview')
+    async def raid_preview(self, ctx: Context, selector: str, *, value: str):
+        """Shows who would be affected by a mass action, without doing anything"""
+
+        targets = await self.select_targets(ctx, selector, value)
+        sample = ', '.join(str(target) if isinstance(target, Member) else str(target.id)
+            for target in targets[:20])
+        await ctx.send(embed=Embed(
+            title=f'{len(targets)} targets',
+            description=(sample + (', ...' if len(targets) > 20 else '')) or '*Nobody*',
+            color=Color.orange()
+        ))
+
+    @has_permissions(ban_members=True)
+    @bot_has_permissions(ban_members=True)
+    @raid.command(name='ban')
+    async def raid_ban(self, ctx: Context, selector: str, *, value: str):
+        """Bans every selected user"""
+
+        targets = await self.select_targets(ctx, selector, value)
+        await self.mass_action(ctx, 'ban', targets,
+            lambda target: ctx.guild.ban(target, reason=f'Raid cleanup by {ctx.author}', delete_message_days=1))
+
+    @has_permissions(kick_members=True)
+    @bot_has_permissions(kick_members=True)
+    @raid.command(name='kick')
+    async def raid_kick(self, ctx: Context, selector: str, *, value: str):
+        """Kicks every selected member"""
+
+        targets = [target for target in await self.select_targets(ctx, selector, value)
+            if isinstance(target, Member)]
+        await self.mass_action(ctx, 'kick', targets,
+            lambda target: ctx.guild.kick(target, reason=f'Raid cleanup by {ctx.author}'))
+
+
+def setup(bot: StoneLegendBot):
+    bot.add_cog(Raid(bot))
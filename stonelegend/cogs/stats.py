@@ -0,0 +1,134 @@
+from discord.ext.commands import Cog, Context, command
+from discord.ext.tasks import loop
+from discord import Embed, Color, File
+from aiohttp import ClientError
+from datetime import timedelta
+from typing import List, Optional
+import aiomysql
+import asyncio
+import time
+
+from ..bot import StoneLegendBot
+from ..converters import TimeDeltaConverter
+from ..render import render_player_chart
+from ..timeseries import History
+from .info import SERVER_STATUS_URL
+
+
+class PlayerStats(Cog):
+    """Player count history of the MineCraft server"""
+
+    def __init__(self, bot: StoneLegendBot):
+        self.bot = bot
+
+        stats_config = bot.config['stats']
+        # A history kept from before a reload is newer than the db
+        self._history_loaded = 'PlayerStats' in bot.cog_state
+        self.history = bot.get_cog_state('PlayerStats', lambda: History({
+            60: stats_config['minute_capacity'],
+            3600: stats_config['hour_capacity'],
+            86400: stats_config['day_capacity'],
+        }))
+        # Buckets which failed to be written, retried with the next flush
+        self._unsaved: List[tuple] = []
+
+        self.sampler.change_interval(seconds=stats_config['sample_interval'])
+        self.flusher.change_interval(seconds=stats_config['flush_interval'])
+        self.sampler.start()
+        self.flusher.start()
+
+    def cog_unload(self):
+        self.sampler.cancel()
+        self.flusher.cancel()
+
+    @loop(seconds=60)
+    async def sampler(self):
+        """Records the current player count"""
+
+        try:
+            data = await self.bot.http_client.get_json(SERVER_STATUS_URL)
+        except (ClientError, asyncio.TimeoutError, ValueError):
+            return # Leaves a gap in the history
+
+        self.history.add(int(time.time()), data['players']['online'] if data.get('online') else 0)
+
+    @sampler.before_loop
+    async def load_history(self):
+        """Restores the history kept in the db before sampling"""
+
+        await self.bot.wait_until_ready()
+        if self._history_loaded:
+            return
+
+        now = int(time.time())
+        try:
+            for series in self.history.series:
+                rows = await self.bot.db.get_player_counts(series.resolution,
+                    now // series.resolution - series.capacity + 1)
+                self.history.load(rows)
+        except aiomysql.ProgrammingError:
+            pass # Table not created yet, see Admin.init_db
+
+    @loop(seconds=300)
+    async def flusher(self):
+        """Writes the buckets changed since the last flush in one batch and drops expired ones"""
+
+        try:
+            await self.flush()
+
+            now = int(time.time())
+            for series in self.history.series:
+                await self.bot.db.delete_player_counts_before(series.resolution,
+                    now // series.resolution - series.capacity + 1)
+        except aiomysql.MySQLError:
+            pass # Retried with the next flush
+
+    @flusher.before_loop
+    async def wait_for_history(self):
+        await self.bot.wait_until_ready()
+
+    @flusher.after_loop
+    async def flush_on_stop(self):
+        """Flushes when the cog is reloaded. On close, the bot has flushed
+        before closing the db, see StoneLegendBot.flush_cogs"""
+
+        await self.flush()
+
+    async def flush(self):
+        rows = self._unsaved + self.history.drain_dirty()
+        self._unsaved = []
+        if not rows:
+            return
+
+        try:
+            await self.bot.db.upsert_player_counts(rows)
+        except BaseException:
+            self._unsaved = rows
+            raise
+
+    @command(name='stats')
+    async def player_stats(self, ctx: Context, period: Optional[TimeDeltaConverter] = None):
+        """Shows a chart of the player count over the given period, like 7d (a day by default)"""
+
+        period = period or timedelta(days=1)
+        until = int(time.time())
+        resolution, points = self.history.query(until - int(period.total_seconds()), until)
+        if not points:
+            await ctx.send(embed=Embed(
+                description='No player count history for that period yet!',
+                color=Color.orange()
+            ))
+            return
+
+        chart = await self.bot.loop.run_in_executor(None, render_player_chart, points,
+            f'Players online, last {period} ({timedelta(seconds=resolution)} resolution)')
+
+        embed = Embed(title='MineCraft Server Players', color=Color.green())
+        embed.add_field(name='**Peak**', value=str(max(peak for _, _, peak in points)))
+        embed.add_field(name='**Average**', value=f'{sum(average for _, average, _ in points) / len(points):.1f}')
+        embed.set_image(url='attachment://players.png')
+        await ctx.send(embed=embed, file=File(chart, filename='players.png'))
+
+
+def setup(bot: StoneLegendBot):
+    bot.add_cog(PlayerStats(bot))
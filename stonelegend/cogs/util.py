@@ -1,72 +1,204 @@
 from discord.ext.commands import Context, command, Cog
 from discord.ext.tasks import loop
 from discord import(Embed, Color, Message, utils, NotFound,
-    Emoji, Reaction, User, Member, Forbidden)
+    Emoji, Forbidden, HTTPException, RawReactionActionEvent)
 from datetime import timedelta, datetime
 import aioscheduler
 import asyncio
-from typing import Union
+import inspect
+from typing import Dict, Optional, Tuple, Union
 import random
+import re
 
 from .. import StoneLegendBot
 from ..db import Database
+from ..db.models import Poll, Giveaway
 from ..converters import ReactableConverter, TimeDeltaConverter
+from ..converters.index import normalize_emoji
+from ..rest import Priority
+
+
+CUSTOM_EMOJI_PATTERN = re.compile(r"<a?:(?P<name>\w+):(?P<id>\d+)>")
+
+
+def as_reaction(emoji_str: str) -> str:
+    """Converts an emoji string as stored in the db to the form expected by
+    the reactions endpoint (`name:id` for custom emojis)"""
+
+    if (match := CUSTOM_EMOJI_PATTERN.fullmatch(emoji_str)) is not None:
+        return f"{match['name']}:{match['id']}"
+    return emoji_str
+
+
+class PollVoteTracker:
+    """Keeps track of the current choice of each user on every active poll
+    so that switching a vote costs exactly one reaction removal.
+
+    Choices are compared without variation selectors, a vote is kept in the
+    form it was reacted with so that it can be removed"""
+
+    def __init__(self):
+        self._polls: Dict[int, Tuple[int, str, str]] = {}
+        self._votes: Dict[int, Dict[int, str]] = {}
+
+    def track(self, channel_id: int, message_id: int, emoji1: str, emoji2: str):
+        """Registers a poll message. Votes are unknown until `seed` is called"""
+
+        self._polls[message_id] = (channel_id, normalize_emoji(str(emoji1)), normalize_emoji(str(emoji2)))
+
+    def untrack(self, message_id: int):
+        self._polls.pop(message_id, None)
+        self._votes.pop(message_id, None)
+
+    def get_poll(self, message_id: int) -> Optional[Tuple[int, str, str]]:
+        """Returns (channel_id, emoji1, emoji2) of the poll, with the emojis normalized,
+        or None if the message is not a poll"""
+
+        return self._polls.get(message_id)
+
+    def is_seeded(self, message_id: int) -> bool:
+        return message_id in self._votes
+
+    def seed(self, message_id: int, votes: Dict[int, str]):
+        """Sets the known votes of a poll, used for polls posted before a restart"""
+
+        self._votes[message_id] = votes
+
+    def vote(self, message_id: int, user_id: int, emoji_str: str) -> Optional[str]:
+        """Records a vote and returns the previous choice of the user which
+        should be removed, None if there is nothing to remove"""
+
+        votes = self._votes.setdefault(message_id, {})
+        previous = votes.get(user_id)
+        votes[user_id] = emoji_str
+        if previous is None or normalize_emoji(previous) == normalize_emoji(emoji_str):
+            return None
+        return previous
+
+    def unvote(self, message_id: int, user_id: int, emoji_str: str):
+        """Forgets a vote if it is still the current choice of the user"""
+
+        votes = self._votes.get(message_id)
+        if votes is None or user_id not in votes:
+            return
+        if normalize_emoji(votes[user_id]) == normalize_emoji(emoji_str):
+            del votes[user_id]
+
+
+class TimerState:
+    """The timers of the Utility cog, kept on the bot so reloading the cog does not reschedule them"""
+
+    __slots__ = ('scheduler', 'votes', 'timers', 'loaded')
+
+    def __init__(self):
+        self.scheduler = aioscheduler.TimedScheduler()
+        self.votes = PollVoteTracker()
+        # ('poll' | 'giveaway', row id) -> (row, scheduler task)
+        self.timers: Dict[Tuple[str, int], Tuple[Union[Poll, Giveaway], Optional[aioscheduler.task.Task]]] = {}
+        self.loaded = False
 
 
 class Utility(Cog):
 
     def __init__(self, bot: StoneLegendBot):
         self.bot = bot
-        self._scheduler = aioscheduler.TimedScheduler()
+        state = bot.get_cog_state('Utility', TimerState)
+        self._scheduler = state.scheduler
+        self._votes = state.votes
+        self._timers = state.timers
+        self._seed_locks: Dict[int, asyncio.Lock] = {}
         self.poll_countdown_updater.start()
         self.giveaway_countdown_updater.start()
-        asyncio.ensure_future(self.schedule_from_db())
 
-    async def _schedule_or_call(self, future, when):
-        """Schedules the future to run at given datetime, awaits right away if
-        when > currentdatetime"""
+        if not state.loaded:
+            state.loaded = True
+            asyncio.ensure_future(self.schedule_from_db())
+
+    def cog_unload(self):
+        self.poll_countdown_updater.cancel()
+        self.giveaway_countdown_updater.cancel()
+
+    async def _schedule_timer(self, kind: str, row: Union[Poll, Giveaway]):
+        """Schedules the poll or giveaway to finish at its finish time, unless it
+        is already scheduled"""
+
+        key = (kind, row.id)
+        if key in self._timers:
+            return
+
+        when = datetime.fromtimestamp(row.finish_time)
+        if kind == 'poll':
+            self._votes.track(row.channel_id, row.message_id, row.emoji1, row.emoji2)
 
         if datetime.utcnow() > when:
-            await future
+            # Finished apart like the scheduled timers, so that a poll whose
+            # channel is gone does not stop the timers restored after it
+            self._timers[key] = (row, None)
+            asyncio.ensure_future(self._finish_timer(kind, row))
         else:
-            self._scheduler.schedule(future, when)
+            self._timers[key] = (row, self._scheduler.schedule(self._finish_timer(kind, row), when))
 
-    @loop(seconds=5)
-    async def poll_countdown_updater(self):
-        """Updates countdown on all poll messages in the db"""
+    async def _finish_timer(self, kind: str, row: Union[Poll, Giveaway]):
+        """Finishes a poll or giveaway with the loaded cog, which is a newer one
+        if the extension was reloaded after the timer was scheduled"""
 
-        await self.bot.wait_until_ready()
+        cog = self.bot.get_cog(self.qualified_name) or self
+        await (cog.finish_poll if kind == 'poll' else cog.finish_giveaway)(row)
 
-        for poll_row in await self.bot.db.get_all_polls():
+    def _cancel_timer(self, key: Tuple[str, int]):
+        row, task = self._timers.pop(key)
+        # The scheduler cancels the timer itself if it is running, a timer which
+        # never started only has to be closed to not be reported as never awaited
+        if task is not None and self._scheduler.cancel(task) \
+            and inspect.getcoroutinestate(task.callback) == inspect.CORO_CREATED:
+            task.callback.close()
+        if key[0] == 'poll':
+            self._votes.untrack(row.message_id)
 
-            if datetime.utcnow().timestamp() > poll_row['finish_time']:
-                continue
+    def export_snapshot(self) -> Dict[str, list]:
+        """Returns the pending timers to be restored after a restart"""
+
+        return dict(timers=[[kind, row.to_list()] for (kind, _), (row, _) in self._timers.items()])
 
-            duration_delta = timedelta(seconds=round(poll_row['finish_time'] - datetime.utcnow().timestamp()))
+    def _queue_countdown_edit(self, channel_id: int, message_id: int, embed: Embed, on_missing):
+        """Queues a low priority edit of a countdown message. Pending edits of the
+        same message are coalesced so only the latest countdown gets sent"""
 
+        async def edit():
             try:
-                channel = await self.bot.fetch_channel(poll_row['channel_id'])
-                message = await channel.fetch_message(poll_row['message_id'])
+                await self.bot.http.edit_message(channel_id, message_id, embed=embed.to_dict())
             except NotFound:
                 # No longer relevent
-                await self.bot.db.delete_poll(poll_row['id'])
-                continue
+                await on_missing()
+            except HTTPException:
+                pass
 
-            emoji1, emoji2 = poll_row['emoji1'], poll_row['emoji2']
+        self.bot.rest_queue.submit(edit, priority=Priority.COSMETIC,
+            bucket=('channel', channel_id), key=('countdown', message_id))
+
+    @loop(seconds=5)
+    async def poll_countdown_updater(self):
+        """Updates countdown on all poll messages in the db"""
+
+        await self.bot.wait_until_ready()
+
+        now = round(datetime.utcnow().timestamp())
+        async for poll_row in self.bot.db.iter_polls(finishing_after=now):
+
+            duration_delta = timedelta(seconds=round(poll_row.finish_time - datetime.utcnow().timestamp()))
+            emoji1, emoji2 = poll_row.emoji1, poll_row.emoji2
 
             embed = Embed(
                 title="New Poll",
-                description=poll_row['question']
+                description=poll_row.question
                     + "\n\n"
                     + f"Time left: {duration_delta}"
                     + f"React with a {emoji1} or {emoji2}",
                 color=Color.green()
             )
 
-            try:
-                await message.edit(embed=embed)
-            except NotFound:
-                pass
+            self._queue_countdown_edit(poll_row.channel_id, poll_row.message_id, embed,
+                lambda poll_id=poll_row.id: self.bot.db.delete_poll(poll_id))
 
     @loop(seconds=5)
     async def giveaway_countdown_updater(self):
@@ -74,68 +206,147 @@ class Utility(Cog):
 
         await self.bot.wait_until_ready()
 
-        for giveaway_row in await self.bot.db.get_all_giveaways():
+        now = round(datetime.utcnow().timestamp())
+        async for giveaway_row in self.bot.db.iter_giveaways(finishing_after=now):
 
-            if datetime.utcnow().timestamp() > giveaway_row['finish_time']:
-                continue
-
-            try:
-                channel = await self.bot.fetch_channel(giveaway_row['channel_id'])
-                message = await channel.fetch_message(giveaway_row['message_id'])
-            except NotFound:
-                # No longer relevent
-                await self.bot.db.delete_giveaway(giveaway_row['id'])
-                continue
-
-            duration_delta = timedelta(seconds=round(giveaway_row['finish_time'] - datetime.utcnow().timestamp()))
+            duration_delta = timedelta(seconds=round(giveaway_row.finish_time - datetime.utcnow().timestamp()))
 
             embed = Embed(
                 title="Giveaway!",
-                description=f"{giveaway_row['prize']}\n\n"
+                description=f"{giveaway_row.prize}\n\n"
                     + f"*Time left: {duration_delta}*\n"
-                    + f"*Hosted by: <@{giveaway_row['author_id']}>*",
+                    + f"*Hosted by: <@{giveaway_row.author_id}>*",
                 color=Color.orange()
             ).set_footer(text="React with \N{party popper} to enter")
 
-            try:
-                await message.edit(embed=embed)
-            except NotFound:
-                pass
+            self._queue_countdown_edit(giveaway_row.channel_id, giveaway_row.message_id, embed,
+                lambda giveaway_id=giveaway_row.id: self.bot.db.delete_giveaway(giveaway_id))
+
+    async def _seed_votes(self, payload: RawReactionActionEvent, emoji1: str, emoji2: str):
+        """Loads the current votes of a poll the tracker has not seen yet (e.g. polls
+        posted before a restart). The other choice of the reacting user, if any,
+        is recorded as their previous vote so that it gets removed"""
 
+        channel = self.bot.get_channel(payload.channel_id) or await self.bot.fetch_channel(payload.channel_id)
+        message = await channel.fetch_message(payload.message_id)
+        votes = {}
+        previous = None
+
+        choice = normalize_emoji(str(payload.emoji))
+        for reaction in message.reactions:
+            emoji_str = str(reaction.emoji)
+            if normalize_emoji(emoji_str) not in (emoji1, emoji2):
+                continue
 
-    @Cog.listener('on_reaction_add')
-    async def on_reaction_add(self, reaction: Reaction, user: Union[User, Member]):
+            async for user in reaction.users():
+                if user.id == self.bot.user.id:
+                    continue
+                if user.id == payload.user_id:
+                    if normalize_emoji(emoji_str) != choice:
+                        previous = emoji_str
+                    continue
+                votes.setdefault(user.id, emoji_str)
+
+        if previous is not None:
+            votes[payload.user_id] = previous
+        self._votes.seed(payload.message_id, votes)
+
+    @Cog.listener('on_raw_reaction_add')
+    async def on_poll_vote(self, payload: RawReactionActionEvent):
         """Listens on reactions to remove multiple poll entries from same user"""
 
-        if user == self.bot.user:
+        if payload.user_id == self.bot.user.id:
             return
 
-        if await self.bot.db.is_poll(reaction.message.channel.id, reaction.message.id):
-            for other_reaction in reaction.message.reactions:
-                if other_reaction != reaction:
-                    await other_reaction.remove(user)
+        if (poll := self._votes.get_poll(payload.message_id)) is None:
+            return
+
+        _, emoji1, emoji2 = poll
+        emoji_str = str(payload.emoji)
+
+        if not self._votes.is_seeded(payload.message_id):
+            lock = self._seed_locks.setdefault(payload.message_id, asyncio.Lock())
+            try:
+                async with lock:
+                    if not self._votes.is_seeded(payload.message_id):
+                        await self._seed_votes(payload, emoji1, emoji2)
+            except (NotFound, Forbidden):
+                return # The poll is gone or out of reach, the next vote tries again
+            finally:
+                self._seed_locks.pop(payload.message_id, None)
+
+        if normalize_emoji(emoji_str) not in (emoji1, emoji2):
+            # Not a choice of this poll, just take it off
+            to_remove = emoji_str
+        else:
+            to_remove = self._votes.vote(payload.message_id, payload.user_id, emoji_str)
+
+        if to_remove is not None:
+            try:
+                await self.bot.rest_queue.run(
+                    lambda: self.bot.http.remove_reaction(payload.channel_id, payload.message_id,
+                        as_reaction(to_remove), payload.user_id),
+                    priority=Priority.MESSAGE, bucket=('reaction', payload.channel_id))
+            except (NotFound, Forbidden):
+                pass
+
+    @Cog.listener('on_raw_reaction_remove')
+    async def on_poll_unvote(self, payload: RawReactionActionEvent):
+        """Forgets the vote of the user when they take their reaction off"""
+
+        if self._votes.get_poll(payload.message_id) is not None:
+            self._votes.unvote(payload.message_id, payload.user_id, str(payload.emoji))
 
     async def schedule_from_db(self):
         self._scheduler.start() # Prepare scheduler
         await self.bot.wait_until_ready()
 
-        for poll_row in await self.bot.db.get_all_polls():
-            await self._schedule_or_call(
-                self.finish_poll(poll_row), datetime.fromtimestamp(poll_row['finish_time']))
-
-        for giveaway_row in await self.bot.db.get_all_giveaways():
-            await self._schedule_or_call(
-                self.finish_giveaway(giveaway_row), datetime.fromtimestamp(giveaway_row['finish_time']))
-
-    async def finish_poll(self, poll_row):
+        # Timers from the last run can be served before the db is read
+        restored = set()
+        for kind, values in self.bot.cache_snapshot.get(self.qualified_name, {}).get('timers', ()):
+            model = Poll if kind == 'poll' else Giveaway
+            try:
+                # Snapshots written before the row models hold dicts, the oldest ones without guild_id
+                row = model(**{'guild_id': None, **values}) if isinstance(values, dict) else model(*values)
+            except TypeError:
+                continue # Left to the db scan below
+            restored.add((kind, row.id))
+            await self._schedule_timer(kind, row)
+
+        # Rows are streamed, only the keys of restored timers and the overdue rows are kept around
+        unseen = set(restored)
+        overdue = []
+        now = round(datetime.utcnow().timestamp())
+        for kind, scan in (('poll', self.bot.db.iter_polls), ('giveaway', self.bot.db.iter_giveaways)):
+            async for row in scan():
+                unseen.discard((kind, row.id))
+                if row.finish_time > now:
+                    await self._schedule_timer(kind, row)
+                else:
+                    # Finishing sends a few requests, so it waits until the scan is over
+                    overdue.append((kind, row))
+
+        # Drop restored timers which have finished or were deleted meanwhile
+        for key in unseen:
+            if key in self._timers:
+                self._cancel_timer(key)
+
+        # Restored timers are already finishing, or done and not in _timers anymore
+        # while the scan still saw their row
+        for kind, row in overdue:
+            if (kind, row.id) not in restored:
+                await self._schedule_timer(kind, row)
+
+    async def finish_poll(self, poll_row: Poll):
         """Called when the poll finishes- i.e. when the poll time is up"""
 
         try:
-            channel = await self.bot.fetch_channel(poll_row['channel_id'])
-            message = await channel.fetch_message(poll_row['message_id'])
+            channel = await self.bot.fetch_channel(poll_row.channel_id)
+            message = await channel.fetch_message(poll_row.message_id)
 
+            choices = (normalize_emoji(poll_row.emoji1), normalize_emoji(poll_row.emoji2))
             reaction1, reaction2, *_ = filter(
-                lambda r: str(r.emoji) in (str(poll_row['emoji1']), str(poll_row['emoji2'])),
+                lambda r: normalize_emoji(str(r.emoji)) in choices,
                 message.reactions
             )
 
@@ -146,40 +357,43 @@ class Utility(Cog):
 
             await channel.send(embed=Embed(
                 title="Poll results",
-                description=f"**Question:** {poll_row['question']}\n\n"
+                description=f"**Question:** {poll_row.question}\n\n"
                     + f"{reaction1.count - 1} people reacted {reaction1.emoji}\n"
                     + f"{reaction2.count - 1} people reacted {reaction2.emoji}",
                 color=Color.orange()
             ))
         finally:
-            await self.bot.db.delete_poll(poll_row['id'])
+            self._timers.pop(('poll', poll_row.id), None)
+            self._votes.untrack(poll_row.message_id)
+            await self.bot.db.delete_poll(poll_row.id)
 
-    async def finish_giveaway(self, giveaway_row):
+    async def finish_giveaway(self, giveaway_row: Giveaway):
         """Called when the giveaway finishes- i.e. when the giveaway time is up"""
 
         try:
-            channel = await self.bot.fetch_channel(giveaway_row['channel_id'])
-            message = await channel.fetch_message(giveaway_row['message_id'])
+            channel = await self.bot.fetch_channel(giveaway_row.channel_id)
+            message = await channel.fetch_message(giveaway_row.message_id)
             reaction = utils.get(message.reactions, emoji='\N{party popper}')
 
             choices = tuple(user.mention for user in await reaction.users().flatten() if user != self.bot.user)
             if not choices:
-                await channel.send(f"Oh no! Looks like nobody wants {giveaway_row['prize']}")
+                await channel.send(f"Oh no! Looks like nobody wants {giveaway_row.prize}")
                 return
 
             winner = random.choice(choices)
-            await channel.send(f"\N{party popper} {winner} won {giveaway_row['prize']}!")
+            await channel.send(f"\N{party popper} {winner} won {giveaway_row.prize}!")
 
             await message.edit(embed=Embed(
                 title="Giveaway!",
-                description=f"{giveaway_row['prize']}\n\n"
+                description=f"{giveaway_row.prize}\n\n"
                     + f"Winner: {winner}\n"
-                    + f"Hosted by: <@{giveaway_row['author_id']}>",
+                    + f"Hosted by: <@{giveaway_row.author_id}>",
                 color=Color.green()
             ))
 
         finally:
-            await self.bot.db.delete_giveaway(giveaway_row['id'])
+            self._timers.pop(('giveaway', giveaway_row.id), None)
+            await self.bot.db.delete_giveaway(giveaway_row.id)
             
     @command(name='poll')
     async def poll(self, ctx: Context, duration: TimeDeltaConverter,
@@ -205,7 +419,9 @@ class Utility(Cog):
         await message.add_reaction(emoji1)
         await message.add_reaction(emoji2)
 
+        guild_id = ctx.guild.id if ctx.guild is not None else None
         poll_id = await self.bot.db.insert_poll(
+            guild_id,
             ctx.channel.id,
             message.id,
             round(finish_time.timestamp()),
@@ -213,17 +429,10 @@ class Utility(Cog):
             str(emoji1),
             str(emoji2)
         )
+        self._votes.seed(message.id, {})
 
-        future = self.finish_poll({
-            'id': poll_id,
-            'channel_id': ctx.channel.id,
-            'message_id': message.id,
-            'question': question,
-            'emoji1': emoji1,
-            'emoji2': emoji2
-        })
-
-        await self._schedule_or_call(future, finish_time)
+        await self._schedule_timer('poll', Poll(poll_id, guild_id, ctx.channel.id, message.id,
+            round(finish_time.timestamp()), question, str(emoji1), str(emoji2)))
 
     @command(name='giveaway', aliases=('gw',))
     async def start_giveaway(self, ctx: Context, duration: TimeDeltaConverter, *, prize: str):
@@ -242,18 +451,12 @@ class Utility(Cog):
         message = await ctx.send(embed=embed)
         await message.add_reaction('\N{party popper}')
 
-        giveaway_id = await self.bot.db.insert_giveaway(ctx.channel.id, message.id,
+        guild_id = ctx.guild.id if ctx.guild is not None else None
+        giveaway_id = await self.bot.db.insert_giveaway(guild_id, ctx.channel.id, message.id,
             prize, finish_time.timestamp(), ctx.author.id)
     
-        future = self.finish_giveaway({
-            'id': giveaway_id,
-            'channel_id': ctx.channel.id,
-            'message_id': message.id,
-            'author_id': ctx.author.id,
-            'prize': prize
-        })
-
-        await self._schedule_or_call(future, finish_time)
+        await self._schedule_timer('giveaway', Giveaway(giveaway_id, guild_id, ctx.channel.id, message.id,
+            finish_time.timestamp(), prize, ctx.author.id))
 
     @command(name='say', aliases=('echo',))
     async def say(self, ctx: Context, *, text: str):
@@ -1,12 +1,29 @@
 import discord
 from discord.ext import commands
+from discord.ext.tasks import loop
 from captcha.image import ImageCaptcha
+from typing import Dict, List, Tuple
 import os
 import string
 import random
-import asyncio
+import heapq
+import time
 
 from ..bot import StoneLegendBot
+from ..rest import Priority
+
+
+class VerificationSession:
+    """A pending captcha challenge of a member"""
+
+    __slots__ = ('member', 'role', 'challenge', 'attempts_left', 'expires_at')
+
+    def __init__(self, member: discord.Member, role: discord.Role, attempts: int):
+        self.member = member
+        self.role = role
+        self.challenge = None
+        self.attempts_left = attempts
+        self.expires_at = 0.0
 
 
 class Verification(commands.Cog):
@@ -20,6 +37,85 @@ class Verification(commands.Cog):
             for f in os.listdir('./fonts')]
         self._captcha_builder = ImageCaptcha(fonts=font_files)
 
+        verification_config = bot.config['verification']
+        self._timeout = verification_config['timeout']
+        self._attempts = verification_config['attempts']
+
+        # user_id -> pending session, and a heap of (expires_at, user_id) for the timeouts
+        self._sessions: Dict[int, VerificationSession]
+        self._deadlines: List[Tuple[float, int]]
+        self._sessions, self._deadlines = bot.get_cog_state('Verification', lambda: ({}, []))
+
+        self.session_expirer.start()
+
+    def cog_unload(self):
+        self.session_expirer.cancel()
+
+    def send_dm(self, member: discord.Member, *args, **kwargs):
+        return self.bot.rest_queue.run(lambda: member.send(*args, **kwargs),
+            priority=Priority.MESSAGE, bucket=('dm', member.id))
+
+    async def send_challenge(self, session: VerificationSession, text: str):
+        """Sends a new captcha to the member and restarts the session timeout"""
+
+        session.challenge = ''.join(random.sample(self.captcha_characters, 4))
+        session.expires_at = time.monotonic() + self._timeout
+        heapq.heappush(self._deadlines, (session.expires_at, session.member.id))
+
+        await self.send_dm(session.member, text,
+            file=discord.File(self._captcha_builder.generate(session.challenge), 'challenge.png'))
+
+    @loop(seconds=1)
+    async def session_expirer(self):
+        """Drops every session past its deadline in one go"""
+
+        now = time.monotonic()
+        expired = []
+        while self._deadlines and self._deadlines[0][0] <= now:
+            expires_at, user_id = heapq.heappop(self._deadlines)
+            session = self._sessions.get(user_id)
+            # Entries left behind by retries or finished sessions are skipped
+            if session is not None and session.expires_at == expires_at:
+                del self._sessions[user_id]
+                expired.append(session)
+
+        for session in expired:
+            self.bot.rest_queue.submit(lambda member=session.member: self._send_quietly(member, 'Timed out.'),
+                priority=Priority.COSMETIC, bucket=('dm', session.member.id))
+
+    async def _send_quietly(self, member: discord.Member, text: str):
+        try:
+            await member.send(text)
+        except discord.HTTPException:
+            pass
+
+    @commands.Cog.listener('on_message')
+    async def on_challenge_answer(self, message: discord.Message):
+        """Checks DM answers against the pending session of their author"""
+
+        if message.guild is not None or message.author.bot:
+            return
+
+        session = self._sessions.get(message.author.id)
+        if session is None:
+            return
+
+        if message.content == session.challenge:
+            del self._sessions[message.author.id]
+            await self.bot.rest_queue.run(lambda: session.member.add_roles(session.role),
+                priority=Priority.MODERATION, bucket=('guild', session.member.guild.id))
+            await self.send_dm(session.member, 'Verified')
+            return
+
+        session.attempts_left -= 1
+        if session.attempts_left <= 0:
+            del self._sessions[message.author.id]
+            await self.send_dm(session.member, "Incorrect captcha, can't verify you")
+            return
+
+        await self.send_challenge(session, "Incorrect captcha, try this one instead "
+            + f"({session.attempts_left} attempts left)")
+
     @commands.has_permissions(manage_guild=True)
     @commands.command('setup_verification', aliases=('setvr', 'verifrole'))
     async def select_role(self, ctx: commands.Context, role: discord.Role):
@@ -40,32 +136,20 @@ class Verification(commands.Cog):
             raise commands.CheckFailure("Verification role is not set."
                 + f"Please use `{ctx.prefix}setup_verification` command")
 
-        challenge = ''.join(random.sample(self.captcha_characters, 4))
+        if ctx.author.id in self._sessions:
+            await ctx.send(f"{ctx.author.mention} check your DMs, a captcha is already waiting for you",
+                delete_after=30)
+            return
+
+        session = self._sessions[ctx.author.id] = VerificationSession(ctx.author, target_role, self._attempts)
 
         try:
-            await ctx.author.send('Type the characters in the below image (case sensitive)',
-                file=discord.File(self._captcha_builder.generate(challenge), 'challenge.png'))
+            await self.send_challenge(session, 'Type the characters in the below image (case sensitive)')
         except discord.Forbidden:
+            self._sessions.pop(ctx.author.id, None)
             await ctx.send(f"{ctx.author.mention} I can't message you because your DMs are turned off\n" \
                 + f"Please enable DMs from this server and try again!",
                 delete_after=60)
-            return
-
-        def check(message: discord.Message):
-            return isinstance(message.channel, discord.DMChannel) and \
-                message.author == ctx.author
-
-        try:
-            message = await self.bot.wait_for("message", check=check, timeout=30)
-        except asyncio.TimeoutError:
-            await ctx.author.send('Timed out.')
-            return
-
-        if message.content == challenge:
-            await ctx.author.add_roles(target_role)
-            await ctx.author.send('Verified')
-        else:
-            await ctx.author.send("Incorrect captcha, can't verify you")
 
 def setup(bot: StoneLegendBot):
-    bot.add_cog(Verification(bot))
\ No newline at end of file
+    bot.add_cog(Verification(bot))
@@ -1,39 +1,75 @@
 from discord import Member, File
 from discord.ext.commands import Cog, Context
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
 from io import BytesIO
-from base64 import b64encode
-import cairosvg
+from typing import Optional
+import aiohttp
+import asyncio
+import time
 
 from .. import StoneLegendBot
+from ..rest import Priority
+from ..render import render_svg, render_pillow, init_pillow_worker, plain_image, BANNER_SIZE, AVATAR_BOX
+
+
+BACKGROUND_URL = "https://source.unsplash.com/500x250/?universe"
 
 
 class Welcome(Cog):
 
     def __init__(self, bot: StoneLegendBot):
         self.bot = bot
-        with open('welcome_template.svg') as fp:
-            self.template_svg = fp.read()
-
-        self.thread_pool = ThreadPoolExecutor(max_workers=3)
 
-    def __del__(self):
-        self.thread_pool.shutdown()
-
-    def _generate_welcome_image(self, pfp_data, bg_data, username):
-        svg = self.template_svg % dict(pfp=b64encode(pfp_data).decode('utf-8'),
-            bg=b64encode(bg_data).decode('utf-8'), username=username)
-        result = BytesIO()
-        cairosvg.svg2png(svg, write_to=result)
-        result.seek(0)
-        return result
+        welcome_config = bot.config['welcome']
+        self._background_ttl = welcome_config['background_ttl']
+        self._background: Optional[bytes] = None
+        self._background_fetched_at = 0.0
+
+        if welcome_config['renderer'] == 'pillow':
+            # Rendering is CPU bound, so it runs in other processes, each one
+            # preparing the static layers of the banner once
+            self.executor: Executor = ProcessPoolExecutor(max_workers=welcome_config['render_processes'],
+                initializer=init_pillow_worker, initargs=(welcome_config['font'],))
+            self._render = render_pillow
+        else:
+            with open('welcome_template.svg') as fp:
+                template_svg = fp.read()
+            self.executor = ThreadPoolExecutor(max_workers=3)
+            self._render = partial(render_svg, template_svg)
+
+    def cog_unload(self):
+        self.executor.shutdown(wait=False)
 
     async def generate_welcome_image(self, pfp_data: bytes, bg_data: bytes, username: str) -> BytesIO:
-        """Build and return the png image from svg template as BytesIO object"""
+        """Build and return the png image of the banner as BytesIO object"""
 
-        return await self.bot.loop.run_in_executor(self.thread_pool, self._generate_welcome_image,
+        return await self.bot.loop.run_in_executor(self.executor, self._render,
             pfp_data, bg_data, username)
 
+    async def fetch_image(self, url: str) -> Optional[bytes]:
+        """Downloads an image, returns None if the request failed or did not return an image"""
+
+        try:
+            response = await self.bot.http_client.get(url)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return None
+        if not response.ok or not response.headers.get('Content-Type', '').startswith('image/'):
+            return None
+        return response.body
+
+    async def get_background(self) -> bytes:
+        """Returns the banner background, downloading a new one once the current one is too old.
+        The old one is kept when the download fails, a plain one is used if there is none"""
+
+        if self._background is not None and time.monotonic() - self._background_fetched_at < self._background_ttl:
+            return self._background
+
+        if (background := await self.fetch_image(BACKGROUND_URL)) is not None:
+            self._background = background
+            self._background_fetched_at = time.monotonic()
+        return self._background or plain_image(BANNER_SIZE)
+
     @Cog.listener()
     async def on_member_join(self, member: Member):
         """Listens to member join event to welcome them"""
@@ -46,17 +82,20 @@ class Welcome(Cog):
         if target_channel is None:
             return
 
-        async with self.bot.worker_http_session.get(str(member.avatar_url_as(format='png'))) as resp:
-            pfp = await resp.content.read()
+        # The default avatar stands in for one which could not be downloaded
+        pfp = await self.fetch_image(str(member.avatar_url_as(format='png'))) \
+            or await self.fetch_image(str(member.default_avatar_url)) \
+            or plain_image((AVATAR_BOX[2] - AVATAR_BOX[0],) * 2)
 
-        async with self.bot.worker_http_session.get("https://source.unsplash.com/500x250/?universe") as resp:
-            bg = await resp.content.read()
+        bg = await self.get_background()
 
         image = await self.generate_welcome_image(pfp, bg, str(member))
         del pfp
 
-        await target_channel.send(member.mention, file=File(image, filename='welcome.png'))
+        await self.bot.rest_queue.run(
+            lambda: target_channel.send(member.mention, file=File(image, filename='welcome.png')),
+            priority=Priority.MESSAGE, bucket=('channel', target_channel.id))
 
 
 def setup(bot: StoneLegendBot):
-    bot.add_cog(Welcome(bot))
\ No newline at end of file
+    bot.add_cog(Welcome(bot))
@@ -0,0 +1,145 @@
+from copy import deepcopy
+from os import path
+from typing import Any, Dict
+import json
+
+
+# Every setting with its default value, bot_config.json only needs to list the overrides
+DEFAULT_CONFIG = {
+    'cache': {
+        # Size of the message cache, null disables it
+        'max_messages': 1000,
+        # Whether to request all members of large guilds on start-up. When disabled,
+        # members are fetched on demand and guilds are chunked only when needed
+        'fetch_offline_members': True,
+        # Number of members fetched on demand to keep around
+        'recent_members': 1000,
+    },
+    'moderation': {
+        # Moderation cases are written to the db in batches, whichever limit is hit first
+        'case_flush_interval': 5.0,
+        'case_batch_size': 50,
+        # Cases kept while the db cannot be written to, the oldest are dropped beyond it
+        'case_max_pending': 5000,
+        # Temporary mutes and bans expiring within this many seconds are kept in memory
+        'expiry_horizon': 600,
+        # Maximum number of expiries applied per sweep and how many run at once
+        'expiry_batch_size': 500,
+        'expiry_concurrency': 5,
+        # How many actions of a raid command run at once
+        'raid_concurrency': 5,
+        # How many guilds a broadcast announcement is sent to at once, and the tries per guild
+        'broadcast_concurrency': 10,
+        'broadcast_attempts': 3,
+        # How many reaction pages are read and members updated at once by a reaction role sync,
+        # and whether every guild is synced when the bot starts
+        'rr_sync_concurrency': 5,
+        'rr_sync_on_startup': False,
+        # Seconds the role changes from a member's clicks on role menus are gathered for,
+        # to be applied in a single role edit
+        'role_edit_window': 1.0,
+    },
+    'verification': {
+        # Seconds a member has to answer a captcha, and how many tries they get
+        'timeout': 30,
+        'attempts': 3,
+    },
+    'welcome': {
+        # Engine drawing the welcome banners: 'svg' (CairoSVG) or 'pillow'
+        'renderer': 'svg',
+        # Number of processes rendering banners with the pillow engine
+        'render_processes': 2,
+        # TrueType font of the pillow engine, null uses DejaVu Sans if available
+        'font': None,
+        # Seconds a downloaded background is reused for the following banners, 0 fetches one per join
+        'background_ttl': 300,
+    },
+    'http': {
+        # Connections open at once in total and to a single host
+        'limit': 100,
+        'limit_per_host': 10,
+        # Seconds resolved host names are kept
+        'dns_cache_ttl': 300,
+        # Seconds a whole request and its connection may take
+        'timeout': 15.0,
+        'connect_timeout': 5.0,
+        # Number of responses kept for Cache-Control/ETag caching and the largest body stored
+        'cache_size': 128,
+        'cache_max_body': 1048576,
+    },
+    'bridge': {
+        # Relays the Minecraft server chat to the channel, read from the log file and/or a local socket
+        'enabled': False,
+        'channel_id': None,
+        'log_file': 'logs/latest.log',
+        'poll_interval': 0.5,
+        'socket_host': '127.0.0.1',
+        'socket_port': None,
+        # Events buffered while Discord is slow, once full the log is read no further until there is room
+        'buffer_size': 5000,
+        # Seconds a burst of events gathers into one batch, and the messages a batch may take
+        'batch_window': 1.0,
+        'max_messages_per_batch': 3,
+    },
+    'stats': {
+        # Seconds between two samples of the player count, and between two writes to the db
+        'sample_interval': 60,
+        'flush_interval': 300,
+        # Number of minute, hour and day points kept: a week, 90 days and 5 years
+        'minute_capacity': 10080,
+        'hour_capacity': 2160,
+        'day_capacity': 1825,
+    },
+    'activity': {
+        # Seconds between two writes of the message counts to the db
+        'flush_interval': 60,
+        # Members kept on each leaderboard, the most /top can show
+        'leaderboard_size': 50,
+        # Seconds after which a quiet member's total is dropped from memory
+        'idle_after': 3600,
+    },
+    'admission': {
+        # Commands each user and each guild may run per second, and how many in a burst
+        'user_rate': 0.5,
+        'user_burst': 5,
+        'guild_rate': 5.0,
+        'guild_burst': 30,
+        # How many invocations of a top-level command run at once, by command name
+        'default_concurrency': 10,
+        'command_concurrency': {'status': 3, 'verify': 5, 'poll': 3, 'giveaway': 3, 'stats': 2},
+        # Invocations waiting for a free slot of a command before new ones are turned away,
+        # and how many seconds they wait at most
+        'max_queued': 20,
+        'queue_timeout': 10.0,
+        # Minimum seconds between two replies to a user whose commands are turned away
+        'notice_interval': 30.0,
+    },
+    'tracing': {
+        # Whether to record traces of commands and listeners, and the share of them recorded
+        'enabled': False,
+        'sample_rate': 0.05,
+        # JSON lines file the spans are written to, rotated once it reaches max_bytes
+        'file': 'traces.jsonl',
+        'max_bytes': 10485760,
+        'backup_count': 5,
+    },
+}
+
+
+def _merge(base: Dict[str, Any], overrides: Dict[str, Any]) -> Dict[str, Any]:
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(base.get(key), dict):
+            _merge(base[key], value)
+        else:
+            base[key] = value
+    return base
+
+
+def load_config(config_file: str) -> Dict[str, Any]:
+    """Returns the default config updated with the contents of `config_file`, if it exists"""
+
+    config = deepcopy(DEFAULT_CONFIG)
+    if path.exists(config_file):
+        with open(config_file) as fp:
+            _merge(config, json.load(fp))
+    return config
@@ -3,15 +3,49 @@ from discord.ext.commands import(Converter, Context, BadArgument,
 from discord import Emoji, Role
 from datetime import timedelta
 from typing import Union, Tuple
-import emoji
+import asyncio
 import re
 
+from .index import resolve_unicode_emoji
+
+
+TIME_DELTA_PATTERN = re.compile(r"^((?P<weeks>\d+)w)?((?P<days>\d+)d)?((?P<hours>\d+)h)?((?P<minutes>\d+)m)?((?P<seconds>\d+)s)?$", re.IGNORECASE)
+ROW_SEPARATOR_PATTERN = re.compile(' +')
+
+
+async def convert_to_emoji(ctx: Context, arg: str) -> Union[Emoji, str]:
+    """Resolves a custom emoji from the guild index or a unicode emoji"""
+
+    if ctx.guild is not None and (result := ctx.bot.resolver.get(ctx.guild).get_emoji(arg)) is not None:
+        return result
+
+    if (unicode_emoji := resolve_unicode_emoji(arg)) is not None:
+        return unicode_emoji
+
+    # Not in this guild, fall back to the global lookup
+    try:
+        return await EmojiConverter().convert(ctx, arg)
+    except BadArgument:
+        raise BadArgument(f"{arg} is not a valid emoji")
+
+
+async def convert_to_role(ctx: Context, arg: str) -> Role:
+    """Resolves a role from the guild index"""
+
+    if ctx.guild is not None and (result := ctx.bot.resolver.get(ctx.guild).get_role(arg)) is not None:
+        return result
+
+    try:
+        return await RoleConverter().convert(ctx, arg)
+    except BadArgument:
+        raise BadArgument(f"{arg} is not a valid role")
+
+
 class TimeDeltaConverter(Converter):
     """A converter to parse time durations"""
 
     async def convert(self, ctx: Context, arg: str) -> timedelta:
-        pattern = re.compile(r"^((?P<weeks>\d+)w)?((?P<days>\d+)d)?((?P<hours>\d+)h)?((?P<minutes>\d+)m)?((?P<seconds>\d+)s)?$", re.IGNORECASE)
-        match = pattern.match(arg)
+        match = TIME_DELTA_PATTERN.match(arg)
 
         if match is None:
             raise BadArgument(f"{arg} is not a valid time duration")
@@ -26,38 +60,19 @@ class ReactableConverter(Converter):
     """A converter for 'reactables' (Emoji objects or unicode emoji string)"""
 
     async def convert(self, ctx: Context, arg: str) -> Union[Emoji, str]:
-        try:
-            return await EmojiConverter().convert(ctx, arg)
-        except BadArgument:
-            if arg in emoji.UNICODE_EMOJI:
-                return arg
-        raise BadArgument(f"{arg} is not a valid emoji")
+        return await convert_to_emoji(ctx, arg)
 
 class SelfRolesListConverter(Converter):
     """Converter for list of self roles passed to `selfroles` command"""
 
     async def convert(self, ctx: Context, arg: str) -> Tuple[Tuple[Role, Union[str, Emoji], str], ...]:
 
-        async def convert_to_emoji(emoji_str) -> Union[Emoji, str]:
-            try:
-                return await EmojiConverter().convert(ctx, emoji_str)
-            except BadArgument:
-                if emoji_str in emoji.UNICODE_EMOJI:
-                    return emoji_str
-            raise BadArgument(f"{emoji_str} is not a valid emoji")
-
-        async def convert_to_role(role_str) -> Role:
-            try:
-                return await RoleConverter().convert(ctx, role_str)
-            except BadArgument:
-                raise BadArgument(f"{role_str} is not a valid role")
-
         async def parse_row(line):
-            row = re.split(' +', line.strip(), maxsplit=2)
+            row = ROW_SEPARATOR_PATTERN.split(line.strip(), maxsplit=2)
             try:
                 role_str, emoji_str, desc = row
             except ValueError:
                 raise BadArgument(f"{' '.join(row)} is not a valid pair of role-emoji-description")
-            return (await convert_to_role(role_str), await convert_to_emoji(emoji_str), desc)
+            return (await convert_to_role(ctx, role_str), await convert_to_emoji(ctx, emoji_str), desc)
 
-        return tuple([await parse_row(line) for line in arg.splitlines() if line])
\ No newline at end of file
+        return tuple(await asyncio.gather(*(parse_row(line) for line in arg.splitlines() if line)))
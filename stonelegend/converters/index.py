@@ -0,0 +1,135 @@
+from discord import Emoji, Guild, Role
+from typing import Dict, Optional, Tuple
+import emoji
+import re
+
+
+ID_PATTERN = re.compile(r"([0-9]{15,21})$")
+ROLE_MENTION_PATTERN = re.compile(r"<@&([0-9]{15,21})>$")
+CUSTOM_EMOJI_PATTERN = re.compile(r"<a?:[a-zA-Z0-9_]+:([0-9]{15,21})>$")
+
+# Text and emoji presentation selectors, clients are not consistent about sending them
+VARIATION_SELECTORS = dict.fromkeys(map(ord, '\ufe0e\ufe0f'))
+
+
+def normalize_emoji(emoji_str: str) -> str:
+    """Strips variation selectors from a unicode emoji"""
+
+    return emoji_str.translate(VARIATION_SELECTORS)
+
+
+def _build_unicode_emoji_map() -> Dict[str, str]:
+    # Prefer the longest (fully qualified) form of each emoji
+    result = {}
+    for emoji_str in emoji.UNICODE_EMOJI:
+        key = normalize_emoji(emoji_str)
+        if len(emoji_str) > len(result.get(key, '')):
+            result[key] = emoji_str
+    return result
+
+
+# Normalized unicode emoji -> fully qualified form
+UNICODE_EMOJI = _build_unicode_emoji_map()
+
+
+def resolve_unicode_emoji(emoji_str: str) -> Optional[str]:
+    """Returns the fully qualified form of a unicode emoji, None if it is not one"""
+
+    return UNICODE_EMOJI.get(normalize_emoji(emoji_str))
+
+
+class GuildIndex:
+    """Name and ID lookup tables for the roles and emojis of a guild.
+    Each table is built on first use and dropped when the guild changes."""
+
+    __slots__ = ('guild', '_roles', '_emojis')
+
+    def __init__(self, guild: Guild):
+        self.guild = guild
+        self._roles: Optional[Tuple[Dict[int, Role], Dict[str, Role]]] = None
+        self._emojis: Optional[Tuple[Dict[int, Emoji], Dict[str, Emoji]]] = None
+
+    def _role_maps(self) -> Tuple[Dict[int, Role], Dict[str, Role]]:
+        if self._roles is None:
+            by_name = {}
+            for role in self.guild.roles:
+                by_name.setdefault(role.name, role)
+            self._roles = ({role.id: role for role in self.guild.roles}, by_name)
+        return self._roles
+
+    def _emoji_maps(self) -> Tuple[Dict[int, Emoji], Dict[str, Emoji]]:
+        if self._emojis is None:
+            by_name = {}
+            for guild_emoji in self.guild.emojis:
+                by_name.setdefault(guild_emoji.name, guild_emoji)
+            self._emojis = ({e.id: e for e in self.guild.emojis}, by_name)
+        return self._emojis
+
+    def invalidate_roles(self):
+        self._roles = None
+
+    def invalidate_emojis(self):
+        self._emojis = None
+
+    def get_role(self, arg: str) -> Optional[Role]:
+        """Looks up a role by ID, mention or name"""
+
+        by_id, by_name = self._role_maps()
+        if (match := ID_PATTERN.match(arg) or ROLE_MENTION_PATTERN.match(arg)) is not None:
+            return by_id.get(int(match.group(1)))
+        return by_name.get(arg)
+
+    def get_emoji(self, arg: str) -> Optional[Emoji]:
+        """Looks up a custom emoji by ID, its string form or name"""
+
+        by_id, by_name = self._emoji_maps()
+        if (match := ID_PATTERN.match(arg) or CUSTOM_EMOJI_PATTERN.match(arg)) is not None:
+            return by_id.get(int(match.group(1)))
+        return by_name.get(arg)
+
+
+class ResolutionIndex:
+    """Keeps a GuildIndex per guild, kept up to date from gateway events"""
+
+    def __init__(self):
+        self._guilds: Dict[int, GuildIndex] = {}
+
+    def register(self, bot):
+        """Adds the listeners keeping the index in sync to the bot"""
+
+        bot.add_listener(self.on_guild_role_create)
+        bot.add_listener(self.on_guild_role_delete)
+        bot.add_listener(self.on_guild_role_update)
+        bot.add_listener(self.on_guild_emojis_update)
+        bot.add_listener(self.on_guild_update)
+        bot.add_listener(self.on_guild_remove)
+
+    def get(self, guild: Guild) -> GuildIndex:
+        index = self._guilds.get(guild.id)
+        if index is None or index.guild is not guild:
+            index = self._guilds[guild.id] = GuildIndex(guild)
+        return index
+
+    def _invalidate_roles(self, guild: Guild):
+        if (index := self._guilds.get(guild.id)) is not None:
+            index.invalidate_roles()
+
+    async def on_guild_role_create(self, role: Role):
+        self._invalidate_roles(role.guild)
+
+    async def on_guild_role_delete(self, role: Role):
+        self._invalidate_roles(role.guild)
+
+    async def on_guild_role_update(self, before: Role, after: Role):
+        if before.name != after.name:
+            self._invalidate_roles(after.guild)
+
+    async def on_guild_emojis_update(self, guild: Guild, before, after):
+        if (index := self._guilds.get(guild.id)) is not None:
+            index.invalidate_emojis()
+
+    async def on_guild_update(self, before: Guild, after: Guild):
+        self._guilds.pop(after.id, None)
+
+    async def on_guild_remove(self, guild: Guild):
+        self._guilds.pop(guild.id, None)
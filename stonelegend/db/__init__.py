@@ -1,28 +1,38 @@
 import aiomysql
+import asyncio
+import sys
 from functools import wraps
-from typing import Dict, Iterable, Optional
+from typing import Any, AsyncIterator, Dict, Iterable, Optional, Set, Tuple
+
+from ..converters.index import normalize_emoji, resolve_unicode_emoji
+from ..tracing import tracer
+from .models import Poll, Giveaway, GuildSettings, UNSET
 
 
 SQL_CREATE_TABLE_POLLS = """
 CREATE TABLE IF NOT EXISTS polls(
     id INTEGER AUTO_INCREMENT PRIMARY KEY,
+    guild_id BIGINT,
     channel_id BIGINT NOT NULL,
     message_id BIGINT NOT NULL,
     finish_time BIGINT NOT NULL,
     question VARCHAR(150) NOT NULL,
     emoji1 VARCHAR(35) NOT NULL,
-    emoji2 VARCHAR(35) NOT NULL
+    emoji2 VARCHAR(35) NOT NULL,
+    INDEX polls_by_finish_time (finish_time),
+    INDEX polls_by_guild (guild_id, finish_time)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE utf8mb4_general_ci;
 """
 
 SQL_INSERT_POLL = """
-INSERT INTO polls(channel_id, message_id, finish_time, question, emoji1, emoji2)
-VALUES(%s, %s, %s, %s, %s, %s)
+INSERT INTO polls(guild_id, channel_id, message_id, finish_time, question, emoji1, emoji2)
+VALUES(%s, %s, %s, %s, %s, %s, %s)
 """
 
-SQL_SELECT_ALL_POLLS = """
-SELECT id, channel_id, message_id, finish_time, question, emoji1, emoji2
+SQL_SELECT_POLLS = """
+SELECT id, guild_id, channel_id, message_id, finish_time, question, emoji1, emoji2
 FROM polls
+{}
 """
 
 SQL_DELETE_POLL = """
@@ -30,24 +40,23 @@ DELETE FROM polls
 WHERE id = %s
 """
 
-SQL_CHECK_POLL = """
-SELECT EXISTS (SELECT * FROM polls WHERE channel_id = %s AND message_id = %s) AS result
-"""
-
 SQL_CREATE_TABLE_GIVEAWAYS = """
 CREATE TABLE IF NOT EXISTS giveaways(
     id INTEGER AUTO_INCREMENT PRIMARY KEY,
+    guild_id BIGINT,
     channel_id BIGINT NOT NULL,
     message_id BIGINT NOT NULL,
     prize VARCHAR(250) NOT NULL,
     finish_time BIGINT NOT NULL,
-    author_id BIGINT NOT NULL
+    author_id BIGINT NOT NULL,
+    INDEX giveaways_by_finish_time (finish_time),
+    INDEX giveaways_by_guild (guild_id, finish_time)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE utf8mb4_general_ci;
 """
 
 SQL_INSERT_GIVEAWAY = """
-INSERT INTO giveaways(channel_id, message_id, prize, finish_time, author_id)
-VALUES(%s, %s, %s, %s, %s)
+INSERT INTO giveaways(guild_id, channel_id, message_id, prize, finish_time, author_id)
+VALUES(%s, %s, %s, %s, %s, %s)
 """
 
 SQL_DELETE_GIVEAWAY = """
@@ -55,11 +64,28 @@ DELETE FROM giveaways
 WHERE id = %s
 """
 
-SQL_SELECT_ALL_GIVEAWAYS = """
-SELECT id, channel_id, message_id, finish_time, prize, author_id
+SQL_SELECT_GIVEAWAYS = """
+SELECT id, guild_id, channel_id, message_id, finish_time, prize, author_id
 FROM giveaways
+{}
 """
 
+# Brings tables created by older versions up to date. Statements failing because
+# the column or index already exists are skipped
+SQL_MIGRATIONS = (
+    "ALTER TABLE polls ADD COLUMN guild_id BIGINT AFTER id",
+    "ALTER TABLE polls ADD INDEX polls_by_finish_time (finish_time)",
+    "ALTER TABLE polls ADD INDEX polls_by_guild (guild_id, finish_time)",
+    "ALTER TABLE giveaways ADD COLUMN guild_id BIGINT AFTER id",
+    "ALTER TABLE giveaways ADD INDEX giveaways_by_finish_time (finish_time)",
+    "ALTER TABLE giveaways ADD INDEX giveaways_by_guild (guild_id, finish_time)",
+    "ALTER TABLE reactroles ADD COLUMN exclusive BOOLEAN NOT NULL DEFAULT FALSE",
+)
+
+# MySQL error codes for a duplicate column and a duplicate index
+ER_DUP_FIELDNAME = 1060
+ER_DUP_KEYNAME = 1061
+
 SQL_CREATE_TABLE_ANNOUNCE_ROLES = """
 CREATE TABLE IF NOT EXISTS annouceroles(
     guild_id BIGINT PRIMARY KEY,
@@ -67,6 +93,10 @@ CREATE TABLE IF NOT EXISTS annouceroles(
 )
 """
 
+SQL_SELECT_ALL_ANNOUNCE_ROLES = """
+SELECT guild_id, role_id FROM annouceroles
+"""
+
 SQL_SELECT_ANNOUNCE_ROLE = """
 SELECT role_id FROM annouceroles
 WHERE guild_id = %s
@@ -78,6 +108,33 @@ VALUES(%(guild_id)s, %(role_id)s)
 ON DUPLICATE KEY UPDATE role_id = %(role_id)s
 """
 
+SQL_CREATE_TABLE_ANNOUNCE_TARGETS = """
+CREATE TABLE IF NOT EXISTS announcetargets(
+    guild_id BIGINT PRIMARY KEY,
+    channel_id BIGINT NOT NULL
+)
+"""
+
+SQL_SELECT_ALL_ANNOUNCE_TARGETS = """
+SELECT guild_id, channel_id FROM announcetargets
+"""
+
+SQL_SELECT_ANNOUNCE_TARGET = """
+SELECT channel_id FROM announcetargets
+WHERE guild_id = %s
+"""
+
+SQL_UPDATE_ANNOUNCE_TARGET = """
+INSERT INTO announcetargets(guild_id, channel_id)
+VALUES(%(guild_id)s, %(channel_id)s)
+ON DUPLICATE KEY UPDATE channel_id = %(channel_id)s
+"""
+
+SQL_DELETE_ANNOUNCE_TARGET = """
+DELETE FROM announcetargets
+WHERE guild_id = %s
+"""
+
 SQL_CREATE_TABLE_REACT_ROLES = """
 CREATE TABLE IF NOT EXISTS reactroles(
     id INTEGER AUTO_INCREMENT PRIMARY KEY,
@@ -85,18 +142,24 @@ CREATE TABLE IF NOT EXISTS reactroles(
     channel_id BIGINT NOT NULL,
     message_id BIGINT NOT NULL,
     role_id BIGINT NOT NULL,
-    emoji VARCHAR(40) COLLATE utf8mb4_unicode_ci NOT NULL
+    emoji VARCHAR(40) COLLATE utf8mb4_unicode_ci NOT NULL,
+    exclusive BOOLEAN NOT NULL DEFAULT FALSE
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE utf8mb4_general_ci
 """
 
 SQL_INSERT_REACT_ROLE = """
-INSERT INTO reactroles(guild_id, channel_id, message_id, role_id, emoji)
-VALUES(%s, %s, %s, %s, %s)
+INSERT INTO reactroles(guild_id, channel_id, message_id, role_id, emoji, exclusive)
+VALUES(%s, %s, %s, %s, %s, %s)
+"""
+
+SQL_SELECT_ALL_REACT_ROLES = """
+SELECT guild_id, channel_id, message_id, role_id, emoji, exclusive FROM reactroles
 """
 
 SQL_SELECT_ROLE_ID_FOR_REACTION = """
 SELECT role_id FROM reactroles
-WHERE guild_id = %s AND channel_id = %s AND message_id = %s AND emoji = %s COLLATE utf8mb4_bin
+WHERE guild_id = %s AND channel_id = %s AND message_id = %s
+    AND REPLACE(REPLACE(emoji, '\ufe0e', ''), '\ufe0f', '') = %s COLLATE utf8mb4_bin
 """
 
 SQL_CREATE_TABLE_WELCOME_CHANNELS = """
@@ -112,6 +175,10 @@ VALUES(%(guild_id)s, %(channel_id)s)
 ON DUPLICATE KEY UPDATE channel_id = %(channel_id)s
 """
 
+SQL_SELECT_ALL_WELCOME_CHANNELS = """
+SELECT guild_id, channel_id FROM welcomechannels
+"""
+
 SQL_SELECT_WELCOME_CHANNEL = """
 SELECT channel_id FROM welcomechannels WHERE guild_id = %s
 """
@@ -129,33 +196,248 @@ VALUES(%(guild_id)s, %(role_id)s)
 ON DUPLICATE KEY UPDATE role_id = %(role_id)s
 """
 
+SQL_SELECT_ALL_VERIFICATION_ROLES = """
+SELECT guild_id, role_id FROM verificationroles
+"""
+
 SQL_SELECT_VERIFICATION_ROLE = """
 SELECT role_id FROM verificationroles
 WHERE guild_id = %s
 LIMIT 1
 """
 
+SQL_CREATE_TABLE_MOD_CASES = """
+CREATE TABLE IF NOT EXISTS modcases(
+    guild_id BIGINT NOT NULL,
+    case_number INTEGER NOT NULL,
+    action VARCHAR(16) NOT NULL,
+    user_id BIGINT,
+    moderator_id BIGINT NOT NULL,
+    reason VARCHAR(512),
+    created_at BIGINT NOT NULL,
+    PRIMARY KEY (guild_id, case_number),
+    INDEX modcases_by_user (guild_id, user_id, case_number)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE utf8mb4_general_ci
+"""
+
+SQL_INSERT_MOD_CASE = """
+INSERT INTO modcases(guild_id, case_number, action, user_id, moderator_id, reason, created_at)
+VALUES(%s, %s, %s, %s, %s, %s, %s)
+"""
+
+SQL_SELECT_LAST_CASE_NUMBERS = """
+SELECT guild_id, MAX(case_number) AS case_number FROM modcases
+GROUP BY guild_id
+"""
+
+SQL_SELECT_MOD_CASES_FOR_USER = """
+SELECT guild_id, case_number, action, user_id, moderator_id, reason, created_at
+FROM modcases
+WHERE guild_id = %s AND user_id = %s
+ORDER BY case_number DESC
+LIMIT %s
+"""
+
+SQL_CREATE_TABLE_MOD_EXPIRIES = """
+CREATE TABLE IF NOT EXISTS modexpiries(
+    id INTEGER AUTO_INCREMENT PRIMARY KEY,
+    guild_id BIGINT NOT NULL,
+    user_id BIGINT NOT NULL,
+    action VARCHAR(16) NOT NULL,
+    expires_at BIGINT NOT NULL,
+    INDEX modexpiries_by_time (expires_at),
+    INDEX modexpiries_by_user (guild_id, user_id, action)
+)
+"""
+
+SQL_INSERT_MOD_EXPIRY = """
+INSERT INTO modexpiries(guild_id, user_id, action, expires_at)
+VALUES(%s, %s, %s, %s)
+"""
+
+SQL_SELECT_MOD_EXPIRIES_BEFORE = """
+SELECT id, guild_id, user_id, action, expires_at FROM modexpiries
+WHERE expires_at <= %s
+ORDER BY expires_at
+LIMIT %s
+"""
+
+SQL_DELETE_MOD_EXPIRIES = """
+DELETE FROM modexpiries
+WHERE id IN ({})
+"""
+
+SQL_DELETE_MOD_EXPIRY_FOR_USER = """
+DELETE FROM modexpiries
+WHERE guild_id = %s AND user_id = %s AND action = %s
+"""
+
 def requires_connection(decorated):
-    """A decorator for Database methods which should not be called before calling Database.connect"""
+    """A decorator for Database methods which should not be called before calling Database.connect.
+    Calls of coroutine methods are recorded as spans of the current trace"""
 
-    @wraps(decorated)
-    def f(self, *args, **kwargs):
+    def check_connection(self):
         if self._pool is None:
             raise ValueError("Tried to access database before connecting.\n"
                 + "Please call Database.connect() before performing any DB operations"
             )
 
+    if asyncio.iscoroutinefunction(decorated):
+        span_name = 'db ' + decorated.__name__
+
+        @wraps(decorated)
+        async def traced(self, *args, **kwargs):
+            check_connection(self)
+            with tracer.span(span_name):
+                return await decorated(self, *args, **kwargs)
+
+        return traced
+
+    @wraps(decorated)
+    def f(self, *args, **kwargs):
+        check_connection(self)
         return decorated(self, *args, **kwargs)
 
     return f
 
 
+def scan_filters(finishing_before: Optional[int] = None, finishing_after: Optional[int] = None,
+    guild_id: Optional[int] = None) -> Tuple[str, tuple]:
+    """Builds the WHERE clause and its parameters for scans of polls or giveaways"""
+
+    conditions, params = [], []
+    if finishing_before is not None:
+        conditions.append('finish_time < %s')
+        params.append(finishing_before)
+    if finishing_after is not None:
+        conditions.append('finish_time >= %s')
+        params.append(finishing_after)
+    if guild_id is not None:
+        conditions.append('guild_id = %s')
+        params.append(guild_id)
+
+    return ('WHERE ' + ' AND '.join(conditions) if conditions else ''), tuple(params)
+
+
+def _display_roles(roles: Dict[str, int]) -> Dict[str, int]:
+    """Turns the normalized emojis of a reaction role menu back into the fully
+    qualified form they are stored and reacted with"""
+
+    return {resolve_unicode_emoji(emoji_str) or emoji_str: role_id for emoji_str, role_id in roles.items()}
+
+
+
+SQL_CREATE_TABLE_PLAYER_COUNTS = """
+CREATE TABLE IF NOT EXISTS playercounts(
+    resolution INTEGER NOT NULL,
+    bucket BIGINT NOT NULL,
+    average FLOAT NOT NULL,
+    peak SMALLINT UNSIGNED NOT NULL,
+    samples SMALLINT UNSIGNED NOT NULL,
+    PRIMARY KEY (resolution, bucket)
+)
+"""
+
+SQL_UPSERT_PLAYER_COUNT = """
+INSERT INTO playercounts(resolution, bucket, average, peak, samples)
+VALUES(%s, %s, %s, %s, %s)
+ON DUPLICATE KEY UPDATE average = VALUES(average), peak = VALUES(peak), samples = VALUES(samples)
+"""
+
+SQL_SELECT_PLAYER_COUNTS_SINCE = """
+SELECT resolution, bucket, average, peak, samples FROM playercounts
+WHERE resolution = %s AND bucket >= %s
+"""
+
+SQL_DELETE_PLAYER_COUNTS_BEFORE = """
+DELETE FROM playercounts
+WHERE resolution = %s AND bucket < %s
+"""
+
+SQL_CREATE_TABLE_ACTIVITY = """
+CREATE TABLE IF NOT EXISTS activity(
+    guild_id BIGINT NOT NULL,
+    user_id BIGINT NOT NULL,
+    messages BIGINT NOT NULL,
+    last_active BIGINT NOT NULL,
+    PRIMARY KEY (guild_id, user_id),
+    INDEX activity_by_messages (guild_id, messages)
+)
+"""
+
+SQL_ADD_ACTIVITY = """
+INSERT INTO activity(guild_id, user_id, messages, last_active)
+VALUES(%s, %s, %s, %s)
+ON DUPLICATE KEY UPDATE messages = messages + VALUES(messages), last_active = VALUES(last_active)
+"""
+
+SQL_SELECT_ACTIVITY_TOTALS = """
+SELECT guild_id, user_id, messages FROM activity
+WHERE (guild_id, user_id) IN ({})
+"""
+
+SQL_SELECT_TOP_ACTIVITY = """
+SELECT user_id, messages FROM activity
+WHERE guild_id = %s
+ORDER BY messages DESC
+LIMIT %s
+"""
+
+SQL_CREATE_TABLE_ANTISPAM = """
+CREATE TABLE IF NOT EXISTS antispam(
+    guild_id BIGINT PRIMARY KEY,
+    enabled BOOLEAN NOT NULL DEFAULT TRUE,
+    messages INTEGER NOT NULL,
+    per_seconds INTEGER NOT NULL,
+    duplicates INTEGER NOT NULL,
+    mute_seconds INTEGER NOT NULL
+)
+"""
+
+SQL_UPDATE_ANTISPAM = """
+INSERT INTO antispam(guild_id, enabled, messages, per_seconds, duplicates, mute_seconds)
+VALUES(%(guild_id)s, %(enabled)s, %(messages)s, %(per_seconds)s, %(duplicates)s, %(mute_seconds)s)
+ON DUPLICATE KEY UPDATE enabled = %(enabled)s, messages = %(messages)s, per_seconds = %(per_seconds)s,
+    duplicates = %(duplicates)s, mute_seconds = %(mute_seconds)s
+"""
+
+SQL_SELECT_ANTISPAM = """
+SELECT enabled, messages, per_seconds, duplicates, mute_seconds FROM antispam
+WHERE guild_id = %s
+"""
+
+SQL_SELECT_ALL_ANTISPAM = """
+SELECT guild_id, enabled, messages, per_seconds, duplicates, mute_seconds FROM antispam
+"""
+
+# Guild settings cached by Database, mapped to the query loading all of their rows.
+# Each one is a slot of GuildSettings
+GUILD_SETTINGS = {
+    'announce_role': SQL_SELECT_ALL_ANNOUNCE_ROLES,
+    'announce_channel': SQL_SELECT_ALL_ANNOUNCE_TARGETS,
+    'welcome_channel': SQL_SELECT_ALL_WELCOME_CHANNELS,
+    'verification_role': SQL_SELECT_ALL_VERIFICATION_ROLES,
+    'antispam': SQL_SELECT_ALL_ANTISPAM,
+}
+
+
 class Database:
 
     def __init__(self, sql_config: Dict[str, str]):
         self._pool = None
         self._config = sql_config
 
+        # message_id -> (guild_id, channel_id, {emoji: role_id}, exclusive), None until loaded.
+        # Emojis are normalized, clients don't agree on sending variation selectors
+        # Members may only pick one role of an exclusive menu
+        self._reaction_roles: Optional[Dict[int, Tuple[int, int, Dict[str, int], bool]]] = None
+        # guild_id -> {setting name: value}
+        self._guild_settings: Dict[int, GuildSettings] = {}
+        # Whether _guild_settings holds every row, so a miss means the setting is not set
+        self._settings_complete = False
+        # (guild_id, setting name) set while reconcile_cache reads the settings, kept over what it read
+        self._settings_written: Set[Tuple[int, str]] = set()
+
     def __del__(self):
         """Closes the connection
         Note: Do not rely on this and call Database.close instead"""
@@ -167,8 +449,9 @@ class Database:
         """Aquire a connection pool to the database.
         This should be called before any database operation is performed."""
 
+        # Rows are tuples, decoded into models or unpacked by the callers
         self._pool = await aiomysql.create_pool(
-            cursorclass=aiomysql.cursors.DictCursor,
+            cursorclass=aiomysql.Cursor,
             **self._config
         )
 
@@ -181,9 +464,22 @@ class Database:
                 await cur.execute(SQL_CREATE_TABLE_POLLS)
                 await cur.execute(SQL_CREATE_TABLE_GIVEAWAYS)
                 await cur.execute(SQL_CREATE_TABLE_ANNOUNCE_ROLES)
+                await cur.execute(SQL_CREATE_TABLE_ANNOUNCE_TARGETS)
                 await cur.execute(SQL_CREATE_TABLE_REACT_ROLES)
                 await cur.execute(SQL_CREATE_TABLE_WELCOME_CHANNELS)
                 await cur.execute(SQL_CREATE_TABLE_VERIFICATION_ROLES)
+                await cur.execute(SQL_CREATE_TABLE_MOD_CASES)
+                await cur.execute(SQL_CREATE_TABLE_MOD_EXPIRIES)
+                await cur.execute(SQL_CREATE_TABLE_ANTISPAM)
+                await cur.execute(SQL_CREATE_TABLE_PLAYER_COUNTS)
+                await cur.execute(SQL_CREATE_TABLE_ACTIVITY)
+
+                for migration in SQL_MIGRATIONS:
+                    try:
+                        await cur.execute(migration)
+                    except aiomysql.MySQLError as e:
+                        if e.args[0] not in (ER_DUP_FIELDNAME, ER_DUP_KEYNAME):
+                            raise
                 await conn.commit()
 
     async def close(self) -> None:
@@ -193,8 +489,147 @@ class Database:
             self._pool.close()
             await self._pool.wait_closed()
 
+    def export_cache(self) -> Dict[str, Any]:
+        """Returns the cached reaction roles and guild settings in a JSON friendly form"""
+
+        reaction_roles = None
+        if self._reaction_roles is not None:
+            reaction_roles = [[message_id, guild_id, channel_id, list(roles.items()), exclusive]
+                for message_id, (guild_id, channel_id, roles, exclusive) in self._reaction_roles.items()]
+
+        return dict(
+            reaction_roles=reaction_roles,
+            guild_settings=[[guild_id, settings.to_dict()] for guild_id, settings in self._guild_settings.items()]
+        )
+
+    def import_cache(self, data: Dict[str, Any]):
+        """Restores caches exported with `export_cache`.
+        Entries may be stale, call `reconcile_cache` to refresh them"""
+
+        if data.get('reaction_roles') is not None:
+            # Snapshots written before exclusive menus have no flag
+            self._reaction_roles = {message_id: (guild_id, channel_id,
+                    {normalize_emoji(emoji_str): role_id for emoji_str, role_id in roles}, bool(exclusive and exclusive[0]))
+                for message_id, guild_id, channel_id, roles, *exclusive in data['reaction_roles']}
+
+        self._guild_settings = {guild_id: GuildSettings.from_dict(settings)
+            for guild_id, settings in data.get('guild_settings', ())}
+
     @requires_connection
-    async def insert_poll(self, channel_id: int, message_id: int,
+    async def reconcile_cache(self):
+        """Reloads the reaction role index and every guild setting from the db.
+        Runs as a task of its own, so errors are printed rather than raised"""
+
+        try:
+            await self.load_reaction_roles()
+        except aiomysql.MySQLError as e:
+            # Looked up in the db until loaded, see get_role_for_reaction
+            print(f'Could not load the reaction roles: {type(e).__name__}: {e}', file=sys.stderr)
+
+        self._settings_written.clear()
+        settings: Dict[int, GuildSettings] = {}
+        try:
+            await self._read_guild_settings(settings)
+        except aiomysql.MySQLError as e:
+            print(f'Could not load the guild settings: {type(e).__name__}: {e}', file=sys.stderr)
+            return
+
+        # Settings updated during the read may be newer than what was read
+        for guild_id, name in self._settings_written:
+            if (guild_settings := settings.get(guild_id)) is None:
+                guild_settings = settings[guild_id] = GuildSettings()
+            guild_settings.set(name, self._guild_settings[guild_id].get(name))
+
+        # Fill in unset values so lookups don't hit the db for them
+        for guild_settings in settings.values():
+            guild_settings.fill_unset()
+
+        self._guild_settings = settings
+        self._settings_complete = True
+
+    async def _read_guild_settings(self, settings: Dict[int, GuildSettings]):
+        """Reads the rows of every guild setting into `settings`"""
+
+        async with self._pool.acquire() as conn:
+            async with conn.cursor(aiomysql.Cursor) as cur:
+                for name, query in GUILD_SETTINGS.items():
+                    try:
+                        await cur.execute(query)
+                    except aiomysql.ProgrammingError:
+                        continue # Table not created yet, see Admin.init_db
+
+                    # The guild_id comes first. Single column settings are stored
+                    # as plain values, others as the row
+                    columns = [column[0] for column in cur.description[1:]]
+                    for guild_id, *values in await cur.fetchall():
+                        if (guild_settings := settings.get(guild_id)) is None:
+                            guild_settings = settings[guild_id] = GuildSettings()
+                        # setattr rather than GuildSettings.set, a method call per row doubles the decode time
+                        setattr(guild_settings, name, values[0] if len(values) == 1 else dict(zip(columns, values)))
+
+    @requires_connection
+    async def load_reaction_roles(self):
+        """Loads all the reaction roles into memory so reaction events don't query the db"""
+
+        reaction_roles = {}
+        async with self._pool.acquire() as conn:
+            async with conn.cursor(aiomysql.Cursor) as cur:
+                await cur.execute(SQL_SELECT_ALL_REACT_ROLES)
+                for guild_id, channel_id, message_id, role_id, emoji_str, exclusive in await cur.fetchall():
+                    menu = reaction_roles.setdefault(message_id, (guild_id, channel_id, {}, bool(exclusive)))
+                    menu[2][normalize_emoji(emoji_str)] = role_id
+
+        self._reaction_roles = reaction_roles
+
+    async def _get_guild_setting(self, guild_id: int, name: str, query: str, column: Optional[str] = None):
+        """Returns a guild setting from the cache, querying the db on a miss.
+        If `column` is None, the whole row is the setting"""
+
+        settings = self._guild_settings.get(guild_id)
+        if settings is not None and (value := settings.get(name)) is not UNSET:
+            return value
+        if self._settings_complete:
+            return None
+
+        async with self._pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(query, (guild_id,))
+                row = None if cur.rowcount < 1 else await cur.fetchone()
+                value = None
+                if row is not None:
+                    columns = [description[0] for description in cur.description]
+                    value = dict(zip(columns, row)) if column is None else row[columns.index(column)]
+
+        self._set_guild_setting(guild_id, name, value)
+        return value
+
+    def _set_guild_setting(self, guild_id: int, name: str, value):
+        settings = self._guild_settings.get(guild_id)
+        if settings is None:
+            settings = self._guild_settings[guild_id] = GuildSettings()
+        settings.set(name, value)
+        self._settings_written.add((guild_id, name))
+
+    async def _stream(self, name: str, query: str, params: tuple, chunk_size: int, model) -> AsyncIterator[Any]:
+        """Yields the rows of a query as `model` objects through a server side cursor,
+        fetching `chunk_size` rows at a time instead of the whole result"""
+
+        # Not made the active span, the rows are consumed in the caller's context
+        span = tracer.start_span('db ' + name)
+        count = 0
+        try:
+            async with self._pool.acquire() as conn:
+                async with conn.cursor(aiomysql.SSCursor) as cur:
+                    await cur.execute(query, params)
+                    while rows := await cur.fetchmany(chunk_size):
+                        count += len(rows)
+                        for row in rows:
+                            yield model(*row)
+        finally:
+            tracer.finish(span, rows=count)
+
+    @requires_connection
+    async def insert_poll(self, guild_id: Optional[int], channel_id: int, message_id: int,
         finish_time: int, question: str,
         emoji1: str, emoji2: str) -> int:
         """Insert a poll into DB and return the row id inserted to"""
@@ -202,6 +637,7 @@ class Database:
         async with self._pool.acquire() as conn:
             async with conn.cursor() as cur:
                 await cur.execute(SQL_INSERT_POLL, (
+                    guild_id,
                     channel_id,
                     message_id,
                     finish_time,
@@ -215,24 +651,13 @@ class Database:
         return cur.lastrowid
 
     @requires_connection
-    async def is_poll(self, channel_id, message_id):
-        """Returns True if the message of given ID in the given channel is a poll,
-        False otherwise"""
-
-        async with self._pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(SQL_CHECK_POLL, (channel_id, message_id))
-                return bool((await cur.fetchone())['result'])
-
-
-    @requires_connection
-    async def get_all_polls(self):
-        """Fetches and returns all active polls from db"""
+    def iter_polls(self, *, finishing_before: Optional[int] = None, finishing_after: Optional[int] = None,
+        guild_id: Optional[int] = None, chunk_size: int = 100) -> AsyncIterator[Poll]:
+        """Iterates over the polls matching the filters without loading them all at once.
+        The iteration should be run to the end, the connection is held until then"""
 
-        async with self._pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(SQL_SELECT_ALL_POLLS)
-                return await cur.fetchall()
+        where, params = scan_filters(finishing_before, finishing_after, guild_id)
+        return self._stream('iter_polls', SQL_SELECT_POLLS.format(where), params, chunk_size, Poll)
 
     @requires_connection
     async def delete_poll(self, poll_id):
@@ -244,24 +669,24 @@ class Database:
                 await conn.commit()
 
     @requires_connection
-    async def insert_giveaway(self, channel_id, message_id, prize, finish_time, author_id):
+    async def insert_giveaway(self, guild_id, channel_id, message_id, prize, finish_time, author_id):
         """Inserts giveaway to the db"""
 
         async with self._pool.acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute(SQL_INSERT_GIVEAWAY, (channel_id, message_id, prize, finish_time, author_id))
+                await cur.execute(SQL_INSERT_GIVEAWAY, (guild_id, channel_id, message_id, prize, finish_time, author_id))
                 await conn.commit()
 
         return cur.lastrowid
 
     @requires_connection
-    async def get_all_giveaways(self):
-        """Fetches and returns all active giveaways from db"""
+    def iter_giveaways(self, *, finishing_before: Optional[int] = None, finishing_after: Optional[int] = None,
+        guild_id: Optional[int] = None, chunk_size: int = 100) -> AsyncIterator[Giveaway]:
+        """Iterates over the giveaways matching the filters without loading them all at once.
+        The iteration should be run to the end, the connection is held until then"""
 
-        async with self._pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(SQL_SELECT_ALL_GIVEAWAYS)
-                return await cur.fetchall()
+        where, params = scan_filters(finishing_before, finishing_after, guild_id)
+        return self._stream('iter_giveaways', SQL_SELECT_GIVEAWAYS.format(where), params, chunk_size, Giveaway)
 
     @requires_connection
     async def delete_giveaway(self, giveaway_id):
@@ -282,36 +707,84 @@ class Database:
                     dict(guild_id=guild_id, role_id=role_id))
                 await conn.commit()
 
+        self._set_guild_setting(guild_id, 'announce_role', role_id)
+
     @requires_connection
     async def get_announcement_role(self, guild_id):
         """Fetches and returns the annoucement role ID for given guild ID"""
 
+        return await self._get_guild_setting(guild_id, 'announce_role', SQL_SELECT_ANNOUNCE_ROLE, 'role_id')
+
+    @requires_connection
+    async def update_announce_channel(self, guild_id: int, channel_id: Optional[int]):
+        """Sets the channel receiving broadcast announcements in the guild, None removes it"""
+
         async with self._pool.acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute(SQL_SELECT_ANNOUNCE_ROLE, (guild_id,))
-                return None if cur.rowcount < 1 else (await cur.fetchone())['role_id']
+                if channel_id is None:
+                    await cur.execute(SQL_DELETE_ANNOUNCE_TARGET, (guild_id,))
+                else:
+                    await cur.execute(SQL_UPDATE_ANNOUNCE_TARGET, dict(guild_id=guild_id, channel_id=channel_id))
+                await conn.commit()
+
+        self._set_guild_setting(guild_id, 'announce_channel', channel_id)
+
+    @requires_connection
+    async def get_announce_channel(self, guild_id: int) -> Optional[int]:
+        """Fetches and returns the channel ID receiving broadcast announcements in the guild.
+        Returns None if the guild is not a broadcast target"""
+
+        return await self._get_guild_setting(guild_id, 'announce_channel', SQL_SELECT_ANNOUNCE_TARGET, 'channel_id')
 
     @requires_connection
     async def insert_reaction_role(self, guild_id: int, channel_id: int,
-        message_id: int, role_id: int, emoji_str: str):
+        message_id: int, role_id: int, emoji_str: str, exclusive: bool = False):
         """Inserts a reaction role into db"""
 
         async with self._pool.acquire() as conn:
             async with conn.cursor() as cur:        
                 await cur.execute(SQL_INSERT_REACT_ROLE,
-                    (guild_id, channel_id, message_id, role_id, emoji_str))
+                    (guild_id, channel_id, message_id, role_id, emoji_str, exclusive))
                 await conn.commit()
 
+        if self._reaction_roles is not None:
+            menu = self._reaction_roles.setdefault(message_id, (guild_id, channel_id, {}, exclusive))
+            menu[2][normalize_emoji(emoji_str)] = role_id
+
+    async def get_reaction_role_menus(self, guild_id: int) -> Dict[int, Tuple[int, Dict[str, int], bool]]:
+        """Returns the reaction role menus of a guild as {message_id: (channel_id, {emoji_str: role_id}, exclusive)}"""
+
+        if self._reaction_roles is None:
+            await self.load_reaction_roles()
+
+        return {message_id: (channel_id, _display_roles(roles), exclusive)
+            for message_id, (menu_guild_id, channel_id, roles, exclusive) in self._reaction_roles.items()
+            if menu_guild_id == guild_id}
+
+    async def get_exclusive_reaction_roles(self, message_id: int) -> Optional[Dict[str, int]]:
+        """Returns {emoji_str: role_id} of the menu if it is exclusive, None otherwise"""
+
+        if self._reaction_roles is None:
+            await self.load_reaction_roles()
+
+        menu = self._reaction_roles.get(message_id)
+        return _display_roles(menu[2]) if menu is not None and menu[3] else None
+
     @requires_connection
     async def get_role_for_reaction(self, guild_id, channel_id, message_id, emoji_str) -> Optional[int]:
         """Fetches and returns role id for given reaction parameters
         Returns None if the reaction has no role registered"""
 
+        emoji_str = normalize_emoji(emoji_str)
+        if self._reaction_roles is not None:
+            menu = self._reaction_roles.get(message_id)
+            return menu[2].get(emoji_str) if menu is not None else None
+
         async with self._pool.acquire() as conn:
             async with conn.cursor() as cur:
                 await cur.execute(SQL_SELECT_ROLE_ID_FOR_REACTION,
                     (guild_id, channel_id, message_id, emoji_str))
-                return (await cur.fetchone())['role_id'] if cur.rowcount > 0 else None
+                return (await cur.fetchone())[0] if cur.rowcount > 0 else None
 
     @requires_connection
     async def update_welcome_channel(self, guild_id: int, channel_id: int):
@@ -323,15 +796,14 @@ class Database:
                     dict(guild_id=guild_id, channel_id=channel_id))
                 await conn.commit()
 
+        self._set_guild_setting(guild_id, 'welcome_channel', channel_id)
+
     @requires_connection
     async def get_welcome_channel(self, guild_id):
         """Fetches and returns the welcome channel ID for given guild ID.
         Returns None if not set"""
 
-        async with self._pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(SQL_SELECT_WELCOME_CHANNEL, (guild_id,))
-                return None if cur.rowcount < 1 else (await cur.fetchone())['channel_id']
+        return await self._get_guild_setting(guild_id, 'welcome_channel', SQL_SELECT_WELCOME_CHANNEL, 'channel_id')
 
     @requires_connection
     async def update_verification_role(self, guild_id, role_id):
@@ -341,13 +813,168 @@ class Database:
             async with conn.cursor() as cur:
                 await cur.execute(SQL_UPDATE_VERIFICATION_ROLE, dict(guild_id=guild_id, role_id=role_id))
                 await conn.commit()
-                
 
+        self._set_guild_setting(guild_id, 'verification_role', role_id)
+
+    @requires_connection
     async def get_verification_role(self, guild_id):
         """Fetches and returns the role id set as verification role.
         Returns None if not set"""
 
+        return await self._get_guild_setting(guild_id, 'verification_role', SQL_SELECT_VERIFICATION_ROLE, 'role_id')
+
+    @requires_connection
+    async def insert_mod_cases(self, cases: Iterable[tuple]):
+        """Inserts a batch of moderation cases, each a tuple of
+        (guild_id, case_number, action, user_id, moderator_id, reason, created_at)"""
+
+        async with self._pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.executemany(SQL_INSERT_MOD_CASE, cases)
+                await conn.commit()
+
+    @requires_connection
+    async def get_last_case_numbers(self) -> Dict[int, int]:
+        """Fetches and returns the last case number used in each guild"""
+
+        async with self._pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(SQL_SELECT_LAST_CASE_NUMBERS)
+                return dict(await cur.fetchall())
+
+    @requires_connection
+    async def get_mod_cases(self, guild_id: int, user_id: int, limit: int = 10):
+        """Fetches and returns the latest moderation cases of a user in the guild, as tuples of
+        (guild_id, case_number, action, user_id, moderator_id, reason, created_at)"""
+
+        async with self._pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(SQL_SELECT_MOD_CASES_FOR_USER, (guild_id, user_id, limit))
+                return await cur.fetchall()
+
+    @requires_connection
+    async def insert_mod_expiry(self, guild_id: int, user_id: int, action: str, expires_at: int) -> int:
+        """Inserts the expiry of a temporary mute or ban and returns its row id"""
+
+        async with self._pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(SQL_INSERT_MOD_EXPIRY, (guild_id, user_id, action, expires_at))
+                await conn.commit()
+
+        return cur.lastrowid
+
+    @requires_connection
+    async def get_mod_expiries_before(self, timestamp: int, limit: int):
+        """Fetches and returns the earliest expiries due before the given timestamp,
+        as tuples of (id, guild_id, user_id, action, expires_at)"""
+
+        async with self._pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(SQL_SELECT_MOD_EXPIRIES_BEFORE, (timestamp, limit))
+                return await cur.fetchall()
+
+    @requires_connection
+    async def delete_mod_expiries(self, expiry_ids: Iterable[int]):
+        """Deletes the expiries with given ids in a single statement"""
+
+        expiry_ids = tuple(expiry_ids)
+        if not expiry_ids:
+            return
+
+        async with self._pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(SQL_DELETE_MOD_EXPIRIES.format(', '.join(['%s'] * len(expiry_ids))), expiry_ids)
+                await conn.commit()
+
+    @requires_connection
+    async def delete_mod_expiry_for_user(self, guild_id: int, user_id: int, action: str):
+        """Deletes the pending expiry of a user, used when the action is reverted by hand"""
+
+        async with self._pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(SQL_DELETE_MOD_EXPIRY_FOR_USER, (guild_id, user_id, action))
+                await conn.commit()
+
+    @requires_connection
+    async def update_antispam(self, guild_id: int, enabled: bool, messages: int,
+        per_seconds: int, duplicates: int, mute_seconds: int):
+        """Inserts or updates the anti-spam thresholds of a guild"""
+
+        settings = dict(enabled=enabled, messages=messages, per_seconds=per_seconds,
+            duplicates=duplicates, mute_seconds=mute_seconds)
+
+        async with self._pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(SQL_UPDATE_ANTISPAM, dict(guild_id=guild_id, **settings))
+                await conn.commit()
+
+        self._set_guild_setting(guild_id, 'antispam', settings)
+
+    @requires_connection
+    async def get_antispam(self, guild_id: int) -> Optional[Dict[str, int]]:
+        """Returns the anti-spam thresholds of a guild, None if not configured"""
+
+        return await self._get_guild_setting(guild_id, 'antispam', SQL_SELECT_ANTISPAM)
+
+    @requires_connection
+    async def upsert_player_counts(self, rows: Iterable[tuple]):
+        """Inserts or updates a batch of player count buckets, each a tuple of
+        (resolution, bucket, average, peak, samples)"""
+
+        async with self._pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.executemany(SQL_UPSERT_PLAYER_COUNT, rows)
+                await conn.commit()
+
+    @requires_connection
+    async def get_player_counts(self, resolution: int, since_bucket: int):
+        """Fetches and returns the player count buckets of a resolution from the given bucket on,
+        as tuples of (resolution, bucket, average, peak, samples)"""
+
+        async with self._pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(SQL_SELECT_PLAYER_COUNTS_SINCE, (resolution, since_bucket))
+                return await cur.fetchall()
+
+    @requires_connection
+    async def delete_player_counts_before(self, resolution: int, bucket: int):
+        """Deletes the player count buckets of a resolution older than the given bucket"""
+
+        async with self._pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(SQL_DELETE_PLAYER_COUNTS_BEFORE, (resolution, bucket))
+                await conn.commit()
+
+    @requires_connection
+    async def add_activity(self, rows: Iterable[tuple]):
+        """Adds a batch of message counts, each a tuple of (guild_id, user_id, messages, last_active)"""
+
+        async with self._pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.executemany(SQL_ADD_ACTIVITY, rows)
+                await conn.commit()
+
+    @requires_connection
+    async def get_activity_totals(self, keys: Iterable[Tuple[int, int]], chunk_size: int = 500):
+        """Fetches and returns the message totals of the given (guild_id, user_id) pairs
+        as (guild_id, user_id, messages) tuples"""
+
+        keys = list(keys)
+        totals = []
+        async with self._pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                for start in range(0, len(keys), chunk_size):
+                    chunk = keys[start:start + chunk_size]
+                    await cur.execute(SQL_SELECT_ACTIVITY_TOTALS.format(', '.join(['(%s, %s)'] * len(chunk))),
+                        [value for key in chunk for value in key])
+                    totals.extend(await cur.fetchall())
+        return totals
+
+    @requires_connection
+    async def get_top_activity(self, guild_id: int, limit: int):
+        """Fetches and returns the (user_id, messages) of the most active members of the guild"""
+
         async with self._pool.acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute(SQL_SELECT_VERIFICATION_ROLE, (guild_id,))
-                return (await cur.fetchone())['role_id'] if cur.rowcount > 0 else None
\ No newline at end of file
+                await cur.execute(SQL_SELECT_TOP_ACTIVITY, (guild_id, limit))
+                return list(await cur.fetchall())
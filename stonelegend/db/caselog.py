@@ -0,0 +1,144 @@
+from typing import Dict, List, Optional
+import aiomysql
+import asyncio
+import sys
+import time
+
+from . import Database
+
+
+# Errors after which writing the same cases again may work
+TRANSIENT_ERRORS = (aiomysql.OperationalError, aiomysql.InterfaceError, asyncio.CancelledError)
+
+
+class ModerationCaseLog:
+    """Numbers moderation cases in memory and writes them to the db in batches.
+
+    Cases are buffered and flushed with a single `executemany` every
+    `flush_interval` seconds, or as soon as `batch_size` cases are pending.
+    A batch which failed on a transient error is retried, other failures drop
+    it. At most `max_pending` cases are kept, the oldest are dropped first.
+
+    Case numbers follow the last ones in the db, so until those are loaded
+    (e.g. the table is not created yet) cases are numbered when written."""
+
+    def __init__(self, db: Database, flush_interval: float = 5.0, batch_size: int = 50,
+        max_pending: int = 5000):
+        self._db = db
+        self._flush_interval = flush_interval
+        self._batch_size = batch_size
+        self._max_pending = max_pending
+        self._last_case: Optional[Dict[int, int]] = None
+        self._pending: List[tuple] = []
+        self._flushing: List[tuple] = []
+        self._full = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.dropped = 0
+
+    async def start(self):
+        """Loads the last case numbers and starts the flusher"""
+
+        try:
+            self._last_case = await self._db.get_last_case_numbers()
+        except aiomysql.ProgrammingError:
+            # Table not created yet, see Admin.init_db. The flusher loads them later
+            pass
+        self._task = asyncio.ensure_future(self._flusher())
+
+    async def close(self):
+        """Stops the flusher and writes out the pending cases"""
+
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            self._drop(len(self._pending), f'{type(e).__name__}: {e}')
+
+    def record(self, guild_id: int, action: str, user_id: Optional[int],
+        moderator_id: int, reason: Optional[str] = None) -> Optional[int]:
+        """Logs a moderation action and returns its case number, None if the
+        case numbers are not loaded yet"""
+
+        case_number = None
+        if self._last_case is not None:
+            case_number = self._last_case.get(guild_id, 0) + 1
+            self._last_case[guild_id] = case_number
+        self._pending.append((guild_id, case_number, action, user_id, moderator_id,
+            reason[:512] if reason else reason, int(time.time())))
+
+        if len(self._pending) >= self._batch_size:
+            self._full.set()
+        self._trim()
+        return case_number
+
+    async def flush(self):
+        """Writes the pending cases to the db"""
+
+        if not self._pending:
+            return
+
+        if self._last_case is None:
+            self._last_case = await self._db.get_last_case_numbers()
+            self._number_pending()
+
+        batch, self._pending = self._pending, []
+        self._flushing = batch
+        try:
+            await self._db.insert_mod_cases(batch)
+        except TRANSIENT_ERRORS:
+            # Keep them for the next attempt
+            self._pending[:0] = batch
+            self._trim()
+            raise
+        except Exception as e:
+            # Duplicate case numbers and the like fail again on every attempt
+            self._drop(len(batch), f'{type(e).__name__}: {e}')
+        finally:
+            self._flushing = []
+
+    def _number_pending(self):
+        """Numbers the cases recorded before the last case numbers were loaded"""
+
+        for index, case in enumerate(self._pending):
+            if case[1] is None:
+                case_number = self._last_case.get(case[0], 0) + 1
+                self._last_case[case[0]] = case_number
+                self._pending[index] = (case[0], case_number) + case[2:]
+
+    def _trim(self):
+        """Drops the oldest pending cases above `max_pending`"""
+
+        if (excess := len(self._pending) - self._max_pending) > 0:
+            del self._pending[:excess]
+            self._drop(excess, 'too many cases pending')
+
+    def _drop(self, count: int, reason: str):
+        self.dropped += count
+        print(f'Dropped {count} moderation cases: {reason}', file=sys.stderr)
+
+    async def search(self, guild_id: int, user_id: int, limit: int = 10) -> List[tuple]:
+        """Returns the latest cases of a user, including ones not written yet, as tuples
+        in the order of `Database.insert_mod_cases`"""
+
+        pending = [case for case in reversed(self._flushing + self._pending)
+            if case[0] == guild_id and case[3] == user_id]
+        if len(pending) >= limit:
+            return pending[:limit]
+        return pending + list(await self._db.get_mod_cases(guild_id, user_id, limit - len(pending)))
+
+    async def _flusher(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout=self._flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+
+            try:
+                await self.flush()
+            except Exception:
+                # The db may be temporarily unavailable, retry on the next round
+                await asyncio.sleep(self._flush_interval)
@@ -0,0 +1,93 @@
+"""Rows kept in memory, built from tuple cursors.
+
+Polls, giveaways and guild settings stay in memory for as long as the bot runs,
+so they are slotted classes rather than dicts: there is no per-row hash table,
+and decoding is a single call with the row tuple. The pool hands out tuple
+cursors, the other rows are unpacked where they are used.
+The `COLUMNS` of a model are in the order its queries select them."""
+
+from typing import Any, Dict, Optional
+
+
+class Poll:
+
+    __slots__ = COLUMNS = ('id', 'guild_id', 'channel_id', 'message_id', 'finish_time',
+        'question', 'emoji1', 'emoji2')
+
+    def __init__(self, id: int, guild_id: Optional[int], channel_id: int, message_id: int,
+        finish_time: int, question: str, emoji1: str, emoji2: str):
+        self.id = id
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.message_id = message_id
+        self.finish_time = finish_time
+        self.question = question
+        self.emoji1 = emoji1
+        self.emoji2 = emoji2
+
+    def to_list(self) -> list:
+        """Returns the columns as a JSON friendly list, `Poll(*values)` builds it back"""
+
+        return [getattr(self, column) for column in self.COLUMNS]
+
+
+class Giveaway:
+
+    __slots__ = COLUMNS = ('id', 'guild_id', 'channel_id', 'message_id', 'finish_time',
+        'prize', 'author_id')
+
+    def __init__(self, id: int, guild_id: Optional[int], channel_id: int, message_id: int,
+        finish_time: int, prize: str, author_id: int):
+        self.id = id
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.message_id = message_id
+        self.finish_time = finish_time
+        self.prize = prize
+        self.author_id = author_id
+
+    def to_list(self) -> list:
+        """Returns the columns as a JSON friendly list, `Giveaway(*values)` builds it back"""
+
+        return [getattr(self, column) for column in self.COLUMNS]
+
+
+# Marks a guild setting which was not read from the db yet
+UNSET = object()
+
+
+class GuildSettings:
+    """The settings of a guild, each one is None if not set or UNSET if not known yet.
+    Single column settings are plain values, others are the row as a dict"""
+
+    __slots__ = ('announce_role', 'announce_channel', 'welcome_channel', 'verification_role', 'antispam')
+
+    def __init__(self):
+        self.announce_role = self.announce_channel = self.welcome_channel = UNSET
+        self.verification_role = self.antispam = UNSET
+
+    def get(self, name: str) -> Any:
+        return getattr(self, name)
+
+    def set(self, name: str, value: Any):
+        setattr(self, name, value)
+
+    def fill_unset(self):
+        """Marks the settings not read as not set, once every setting was loaded"""
+
+        for name in self.__slots__:
+            if getattr(self, name) is UNSET:
+                setattr(self, name, None)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Returns the known settings in a JSON friendly form"""
+
+        return {name: getattr(self, name) for name in self.__slots__ if getattr(self, name) is not UNSET}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'GuildSettings':
+        settings = cls()
+        for name, value in data.items():
+            if name in cls.__slots__:
+                setattr(settings, name, value)
+        return settings
@@ -1,5 +1,75 @@
 from discord import Embed, Color
-from discord.ext.commands import HelpCommand, Group, Command
+from discord.ext.commands import HelpCommand, Group, Command, Cog
+from collections import Counter
+from typing import Dict, List, Set
+
+
+def trigrams(word: str) -> Set[str]:
+    """Returns the set of trigrams of a word, padded so short words still match"""
+
+    padded = f'  {word.lower()} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class HelpIndex:
+    """Pre-rendered help embeds and a trigram index over command names and aliases.
+    Built once and thrown away by the bot whenever commands are added or removed."""
+
+    def __init__(self, help_command: 'CustomHelpCommand', bot):
+        self.bot_embed = help_command.build_bot_embed(bot)
+        self.cog_embeds: Dict[str, Embed] = {
+            name: help_command.build_cog_embed(cog) for name, cog in bot.cogs.items()
+        }
+        self.command_embeds: Dict[str, Embed] = {}
+
+        # name or alias -> qualified names of commands it refers to
+        self._names: Dict[str, Set[str]] = {}
+        # trigram -> names containing it
+        self._trigrams: Dict[str, Set[str]] = {}
+        self._trigram_counts: Dict[str, int] = {}
+
+        for command in bot.walk_commands():
+            if isinstance(command, Group):
+                embed = help_command.build_group_embed(command)
+            else:
+                embed = help_command.build_command_embed(command)
+            self.command_embeds[command.qualified_name] = embed
+
+            if command.hidden:
+                continue
+
+            parent = command.full_parent_name
+            for name in (command.name, *command.aliases):
+                self._add_name(f'{parent} {name}' if parent else name, command.qualified_name)
+
+    def _add_name(self, name: str, qualified_name: str):
+        self._names.setdefault(name, set()).add(qualified_name)
+        grams = trigrams(name)
+        self._trigram_counts[name] = len(grams)
+        for gram in grams:
+            self._trigrams.setdefault(gram, set()).add(name)
+
+    def suggest(self, query: str, limit: int = 3, threshold: float = 0.3) -> List[str]:
+        """Returns qualified names of the commands closest to `query`"""
+
+        query_grams = trigrams(query)
+        shared = Counter()
+        for gram in query_grams:
+            shared.update(self._trigrams.get(gram, ()))
+
+        scored = []
+        for name, count in shared.items():
+            score = count / (len(query_grams) + self._trigram_counts[name] - count)
+            if score >= threshold:
+                scored.append((score, name))
+        scored.sort(reverse=True)
+
+        suggestions = []
+        for _, name in scored:
+            for qualified_name in sorted(self._names[name]):
+                if qualified_name not in suggestions:
+                    suggestions.append(qualified_name)
+        return suggestions[:limit]
 
 
 class CustomHelpCommand(HelpCommand):
@@ -18,8 +88,20 @@ class CustomHelpCommand(HelpCommand):
         sig = (' ' + group.signature).rstrip()
         return f"/{group.name}{sig}"
 
+    def get_index(self) -> HelpIndex:
+        """Returns the help index of the bot, building it if commands changed"""
+
+        bot = self.context.bot
+        if bot.help_index is None:
+            bot.help_index = HelpIndex(self, bot)
+        return bot.help_index
+
     def command_not_found(self, string):
-        return f"No command called {string}!"
+        suggestions = self.get_index().suggest(string)
+        if not suggestions:
+            return f"No command called {string}!"
+        return f"No command called {string}! Did you mean " \
+            + ', '.join(f'`/{name}`' for name in suggestions) + '?'
 
     async def send_error_message(self, string):
         await self.get_destination().send(embed=Embed(
@@ -28,31 +110,30 @@ class CustomHelpCommand(HelpCommand):
             color=Color.orange()
         ))
 
-    async def send_bot_help(self, mapping):
+    def build_bot_embed(self, bot) -> Embed:
         embed = self.get_embed().set_author(name='List of categories and commands')
 
-        for cog, commands in mapping.items():
-            if cog is not None and (commands := [c for c in commands if not c.hidden]):
+        for cog in bot.cogs.values():
+            if commands := [c for c in cog.get_commands() if not c.hidden]:
                 embed.add_field(
                     name=cog.qualified_name,
                     value=', '.join(command.qualified_name for command in commands),
                     inline=False
                 )
 
-        await self.get_destination().send(embed=embed)
+        return embed
 
-    async def send_cog_help(self, cog):
+    def build_cog_embed(self, cog: Cog) -> Embed:
         commands = cog.get_commands()
 
-        embed = self.get_embed() \
+        return self.get_embed() \
             .set_author(name=f'{cog.qualified_name} category') \
             .add_field(name='Usage', value=cog.description, inline=False) \
             .add_field(name='Commands',
                 value=', '.join([command.name for command in commands]) if commands else '*No commands to show*',
                 inline=True)
-        await self.get_destination().send(embed=embed)
 
-    async def send_group_help(self, group: Group):
+    def build_group_embed(self, group: Group) -> Embed:
         embed = self.get_embed(title=self.get_group_signature(group),
             description=group.help)
 
@@ -60,9 +141,9 @@ class CustomHelpCommand(HelpCommand):
             embed.add_field(name=self.get_command_signature(command, group.name),
                 value=command.help)
 
-        await self.get_destination().send(embed=embed)
+        return embed
 
-    async def send_command_help(self, command: Command):
+    def build_command_embed(self, command: Command) -> Embed:
         embed = self.get_embed(title=self.get_command_signature(command),
             description=command.help) \
             .add_field(
@@ -70,7 +151,7 @@ class CustomHelpCommand(HelpCommand):
                 value=f'{command.cog_name} cog',
                 inline=False
             )
-        
+
         if command.aliases:
             embed.add_field(
                 name='Aliases',
@@ -78,4 +159,16 @@ class CustomHelpCommand(HelpCommand):
                 inline=False
             )
 
-        await self.get_destination().send(embed=embed)
\ No newline at end of file
+        return embed
+
+    async def send_bot_help(self, mapping):
+        await self.get_destination().send(embed=self.get_index().bot_embed)
+
+    async def send_cog_help(self, cog):
+        await self.get_destination().send(embed=self.get_index().cog_embeds[cog.qualified_name])
+
+    async def send_group_help(self, group: Group):
+        await self.get_destination().send(embed=self.get_index().command_embeds[group.qualified_name])
+
+    async def send_command_help(self, command: Command):
+        await self.get_destination().send(embed=self.get_index().command_embeds[command.qualified_name])
@@ -0,0 +1,208 @@
+"""Shared HTTP client for requests to services other than Discord"""
+
+from typing import Dict, Mapping, Optional
+from urllib.parse import urlsplit
+import asyncio
+import json
+import time
+
+import aiohttp
+
+from .cache import LRUCache
+from .tracing import tracer
+
+
+class HTTPResponse:
+    """A response whose body has been read completely, so that its connection is released"""
+
+    __slots__ = ('url', 'status', 'headers', 'body')
+
+    def __init__(self, url: str, status: int, headers: Mapping[str, str], body: bytes):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    @property
+    def ok(self) -> bool:
+        return 200 <= self.status < 300
+
+    def text(self, encoding: str = 'utf-8') -> str:
+        return self.body.decode(encoding)
+
+    def json(self):
+        return json.loads(self.body)
+
+
+class _CacheEntry:
+    __slots__ = ('response', 'expires_at', 'etag', 'last_modified')
+
+    def __init__(self, response: HTTPResponse, expires_at: float):
+        self.response = response
+        self.expires_at = expires_at
+        self.etag = response.headers.get('ETag')
+        self.last_modified = response.headers.get('Last-Modified')
+
+
+class HostMetrics:
+    """Request counters and latencies of a single host"""
+
+    __slots__ = ('requests', 'errors', 'cache_hits', 'revalidated', 'total_time', 'max_time')
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.cache_hits = 0
+        self.revalidated = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def record(self, elapsed: float, error: bool):
+        self.requests += 1
+        self.errors += error
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+
+    def as_dict(self) -> Dict[str, float]:
+        return dict(requests=self.requests, errors=self.errors, cache_hits=self.cache_hits,
+            revalidated=self.revalidated, max_ms=round(self.max_time * 1000),
+            avg_ms=round(self.total_time * 1000 / self.requests) if self.requests else 0)
+
+
+def parse_cache_control(value: Optional[str]) -> Dict[str, Optional[str]]:
+    """Parses a Cache-Control header into a dict of lowercased directives"""
+
+    directives = {}
+    for part in (value or '').split(','):
+        name, _, argument = part.strip().partition('=')
+        if name:
+            directives[name.lower()] = argument.strip('"') or None
+    return directives
+
+
+class HTTPClient:
+    """Wraps an aiohttp session with bounded connection pools, timeouts, a small
+    response cache honoring Cache-Control and ETag/Last-Modified, and per-host metrics.
+
+    Only GET responses without extra headers are cached, keyed by their URL."""
+
+    def __init__(self, limit: int = 100, limit_per_host: int = 10, dns_cache_ttl: int = 300,
+        timeout: float = 15.0, connect_timeout: float = 5.0, cache_size: int = 128,
+        cache_max_body: int = 1024 * 1024):
+        self._limit = limit
+        self._limit_per_host = limit_per_host
+        self._dns_cache_ttl = dns_cache_ttl
+        self._timeout = aiohttp.ClientTimeout(total=timeout, connect=connect_timeout)
+        self._cache: LRUCache[str, _CacheEntry] = LRUCache(cache_size)
+        self._cache_max_body = cache_max_body
+        self._metrics: Dict[str, HostMetrics] = {}
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def start(self):
+        """Creates the session, must be called from within the running loop"""
+
+        connector = aiohttp.TCPConnector(limit=self._limit, limit_per_host=self._limit_per_host,
+            ttl_dns_cache=self._dns_cache_ttl)
+
+        # Every request of the session, including direct uses of it, is a span of the current trace
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(self._on_request_start)
+        trace_config.on_request_end.append(self._on_request_end)
+        trace_config.on_request_exception.append(self._on_request_exception)
+
+        self._session = aiohttp.ClientSession(connector=connector, timeout=self._timeout,
+            trace_configs=[trace_config])
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None:
+            raise RuntimeError('HTTPClient is not started')
+        return self._session
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Returns the metrics of every host contacted so far"""
+
+        return {host: metrics.as_dict() for host, metrics in self._metrics.items()}
+
+    async def _on_request_start(self, session, context, params):
+        context.span = tracer.start_span(f'http {params.method} {params.url.host}', url=str(params.url))
+
+    async def _on_request_end(self, session, context, params):
+        tracer.finish(context.span, status=params.response.status)
+
+    async def _on_request_exception(self, session, context, params):
+        tracer.finish(context.span, error=type(params.exception).__name__)
+
+    def _host_metrics(self, url: str) -> HostMetrics:
+        host = urlsplit(url).hostname or ''
+        metrics = self._metrics.get(host)
+        if metrics is None:
+            metrics = self._metrics[host] = HostMetrics()
+        return metrics
+
+    def _expires_at(self, headers: Mapping[str, str], now: float) -> Optional[float]:
+        """Returns when a response stops being fresh, or None if it must not be stored"""
+
+        directives = parse_cache_control(headers.get('Cache-Control'))
+        if 'no-store' in directives:
+            return None
+        if 'no-cache' in directives:
+            return now
+        try:
+            return now + int(directives.get('max-age') or 0)
+        except ValueError:
+            return now
+
+    async def get(self, url: str, *, headers: Optional[Mapping[str, str]] = None) -> HTTPResponse:
+        """Sends a GET request, or answers it from the cache while fresh.
+        Stale cached responses are revalidated with their ETag or Last-Modified"""
+
+        metrics = self._host_metrics(url)
+        now = time.monotonic()
+        cacheable = headers is None
+
+        entry = self._cache.get(url) if cacheable else None
+        if entry is not None and now < entry.expires_at:
+            metrics.cache_hits += 1
+            return entry.response
+
+        request_headers = dict(headers or {})
+        if entry is not None:
+            if entry.etag is not None:
+                request_headers['If-None-Match'] = entry.etag
+            if entry.last_modified is not None:
+                request_headers['If-Modified-Since'] = entry.last_modified
+
+        started = time.perf_counter()
+        try:
+            async with self.session.get(url, headers=request_headers) as resp:
+                body = await resp.read()
+                response = HTTPResponse(url, resp.status, resp.headers, body)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            metrics.record(time.perf_counter() - started, error=True)
+            raise
+        metrics.record(time.perf_counter() - started, error=response.status >= 500)
+
+        if response.status == 304 and entry is not None:
+            metrics.revalidated += 1
+            expires_at = self._expires_at(response.headers, now)
+            entry.expires_at = expires_at if expires_at is not None else now
+            return entry.response
+
+        if cacheable and response.status == 200 and len(body) <= self._cache_max_body:
+            expires_at = self._expires_at(response.headers, now)
+            if expires_at is None:
+                self._cache.pop(url)
+            elif expires_at > now or 'ETag' in response.headers or 'Last-Modified' in response.headers:
+                self._cache.put(url, _CacheEntry(response, expires_at))
+        return response
+
+    async def get_json(self, url: str, **kwargs):
+        """Sends a GET request and returns the decoded JSON body"""
+
+        return (await self.get(url, **kwargs)).json()
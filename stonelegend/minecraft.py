@@ -0,0 +1,288 @@
+"""Bridge from the Minecraft server log to batched chat messages.
+
+Lines come from the server log file, followed like `tail -F`, or from clients
+writing to a local socket. Chat, join, leave and death lines are turned into
+events, buffered in a bounded queue and sent in batches: bursts of joins and
+repeated chat lines are coalesced and the batch is cut into messages fitting
+the message size limit. A full buffer pauses the readers (the log file simply
+waits to be read, socket clients are throttled by TCP), and a batch larger
+than a few messages is cut short so the bridge never falls behind.
+
+Nothing here depends on Discord, run `python -m stonelegend.minecraft <log file>`
+to print the messages that would be sent for a local log file."""
+
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+import asyncio
+import os
+import re
+import sys
+
+
+# "[12:34:56] [Server thread/INFO]: ..." (vanilla) or "[12:34:56 INFO]: ..." (Paper/Spigot)
+LOG_LINE_PATTERN = re.compile(
+    r"^\[\d\d:\d\d:\d\d(?: INFO\]|\] \[[^\]]*/INFO\])(?: \[[^\]]*\])?: (?P<message>.*)$")
+CHAT_PATTERN = re.compile(r"^(?:\[Not Secure\] )?<(?P<player>[^>]+)> (?P<text>.*)$")
+JOIN_PATTERN = re.compile(r"^(?P<player>\w{3,16}) joined the game$")
+LEAVE_PATTERN = re.compile(r"^(?P<player>\w{3,16}) left the game$")
+DEATH_PATTERN = re.compile(r"^(?P<player>\w{3,16}) (?P<text>(?:was |walked |drowned|experienced |blew up"
+    r"|hit the ground|fell |went |burned |tried to swim|discovered |froze |starved|suffocated"
+    r"|withered away|died|didn't want to live|left the confines).*)$")
+FORMATTING_CODE_PATTERN = re.compile(r"\u00a7[0-9a-fk-or]", re.IGNORECASE)
+MARKDOWN_PATTERN = re.compile(r"([\\*_~`|>])")
+
+# Largest message Discord accepts
+MESSAGE_LIMIT = 2000
+# Room kept in each message for the note about skipped lines
+SKIP_NOTE_RESERVE = 50
+# Players named in a line about a burst of joins or leaves
+MAX_LISTED_PLAYERS = 5
+
+
+class LogEvent:
+    """A chat message, join, leave or death parsed from the server log"""
+
+    __slots__ = ('kind', 'player', 'text')
+
+    def __init__(self, kind: str, player: str, text: Optional[str] = None):
+        self.kind = kind
+        self.player = player
+        self.text = text
+
+
+def parse_line(line: str) -> Optional[LogEvent]:
+    """Parses a line of the server log, returns None if it is not a bridged event"""
+
+    if (match := LOG_LINE_PATTERN.match(line.rstrip('\r\n'))) is None:
+        return None
+    message = FORMATTING_CODE_PATTERN.sub('', match['message'])
+
+    if (match := CHAT_PATTERN.match(message)) is not None:
+        return LogEvent('chat', match['player'], match['text'])
+    if (match := JOIN_PATTERN.match(message)) is not None:
+        return LogEvent('join', match['player'])
+    if (match := LEAVE_PATTERN.match(message)) is not None:
+        return LogEvent('leave', match['player'])
+    if (match := DEATH_PATTERN.match(message)) is not None:
+        return LogEvent('death', match['player'], match['text'])
+    return None
+
+
+def escape(text: str) -> str:
+    return MARKDOWN_PATTERN.sub(r'\\\1', text)
+
+
+def _list_players(players: List[str]) -> str:
+    names = [escape(player) for player in players[:MAX_LISTED_PLAYERS]]
+    if len(players) > MAX_LISTED_PLAYERS:
+        return ', '.join(names) + f' and {len(players) - MAX_LISTED_PLAYERS} others'
+    if len(names) == 1:
+        return names[0]
+    return ', '.join(names[:-1]) + ' and ' + names[-1]
+
+
+def coalesce(events: List[LogEvent]) -> List[str]:
+    """Formats a batch of events into lines. Consecutive joins or leaves become a
+    single line, and a chat message repeated by the same player is counted"""
+
+    lines = []
+    run_kind, run_players = None, []
+    last_chat, repeats = None, 0
+
+    def flush_run():
+        if run_players:
+            verb = 'joined' if run_kind == 'join' else 'left'
+            lines.append(f'*{_list_players(run_players)} {verb} the game*')
+            run_players.clear()
+
+    def flush_chat():
+        if last_chat is not None and repeats > 1:
+            lines[-1] += f' (x{repeats})'
+
+    for event in events:
+        if event.kind in ('join', 'leave'):
+            if event.kind != run_kind:
+                flush_run()
+                run_kind = event.kind
+            flush_chat()
+            last_chat, repeats = None, 0
+            run_players.append(event.player)
+            continue
+
+        flush_run()
+        run_kind = None
+
+        if event.kind == 'chat':
+            key = (event.player, event.text)
+            if key == last_chat:
+                repeats += 1
+                continue
+            flush_chat()
+            last_chat, repeats = key, 1
+            lines.append(f'**{escape(event.player)}**: {escape(event.text)}')
+        else:
+            flush_chat()
+            last_chat, repeats = None, 0
+            lines.append(f'*{escape(event.player)} {escape(event.text)}*')
+
+    flush_run()
+    flush_chat()
+    return lines
+
+
+def chunk_lines(lines: List[str], limit: int = MESSAGE_LIMIT,
+    max_chunks: Optional[int] = None) -> Tuple[List[str], int]:
+    """Packs lines into as few messages of at most `limit` characters as possible.
+    Returns the messages and how many lines were left out to stay within `max_chunks`"""
+
+    chunks, current, size = [], [], 0
+    for index, line in enumerate(lines):
+        if len(line) > limit:
+            line = line[:limit - 1] + '\u2026'
+
+        if current and size + len(line) > limit:
+            chunks.append('\n'.join(current))
+            current, size = [], 0
+            if max_chunks is not None and len(chunks) >= max_chunks:
+                return chunks, len(lines) - index
+
+        current.append(line)
+        size += len(line) + 1
+
+    if current:
+        chunks.append('\n'.join(current))
+    return chunks, 0
+
+
+async def tail_file(path: str, poll_interval: float = 0.5, from_start: bool = False,
+    read_size: int = 65536) -> AsyncIterator[str]:
+    """Yields the lines appended to a file, following it when it is rotated or truncated
+    (the server moves latest.log away on restart). Waits for the file if it does not exist"""
+
+    fp = None
+    partial = ''
+    try:
+        while True:
+            if fp is None:
+                try:
+                    fp = open(path, encoding='utf-8', errors='replace')
+                except FileNotFoundError:
+                    await asyncio.sleep(poll_interval)
+                    continue
+                if not from_start:
+                    fp.seek(0, os.SEEK_END)
+                # Files showing up later are new logs, read them whole
+                from_start = True
+
+            data = fp.read(read_size)
+            if data:
+                lines = (partial + data).split('\n')
+                partial = lines.pop()
+                for line in lines:
+                    yield line
+                continue
+
+            # Nothing new, check whether the file was replaced or truncated
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                stat = None
+            if stat is None or stat.st_ino != os.fstat(fp.fileno()).st_ino or stat.st_size < fp.tell():
+                fp.close()
+                fp, partial = None, ''
+                continue
+
+            await asyncio.sleep(poll_interval)
+    finally:
+        if fp is not None:
+            fp.close()
+
+
+class Bridge:
+    """Buffers parsed events and sends them in batches through `send`.
+
+    `send` should only return once the message is out, so that a slow destination
+    slows down the batches and, once the buffer is full, the readers."""
+
+    def __init__(self, send: Callable[[str], Awaitable], buffer_size: int = 5000,
+        batch_window: float = 1.0, max_messages_per_batch: int = 3, message_limit: int = MESSAGE_LIMIT):
+        self._send = send
+        self._queue: asyncio.Queue = asyncio.Queue(buffer_size)
+        self._batch_window = batch_window
+        self._max_messages = max_messages_per_batch
+        self._message_limit = message_limit
+
+        self.events = 0
+        self.batches = 0
+        self.messages = 0
+        self.skipped = 0
+
+    def stats(self) -> Dict[str, int]:
+        return dict(buffered=self._queue.qsize(), events=self.events, batches=self.batches,
+            messages=self.messages, skipped=self.skipped)
+
+    async def feed(self, lines: AsyncIterator[str]):
+        """Parses lines into the buffer, waiting while it is full"""
+
+        async for line in lines:
+            if (event := parse_line(line)) is not None:
+                self.events += 1
+                await self._queue.put(event)
+
+    async def serve(self, host: str, port: int):
+        """Accepts log lines from clients connecting to a local TCP socket"""
+
+        async def read_lines(reader: asyncio.StreamReader):
+            while line := await reader.readline():
+                yield line.decode('utf-8', errors='replace')
+
+        async def handle_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            try:
+                await self.feed(read_lines(reader))
+            finally:
+                writer.close()
+
+        server = await asyncio.start_server(handle_client, host, port)
+        async with server:
+            await server.serve_forever()
+
+    async def next_batch(self) -> List[str]:
+        """Waits for events, lets a burst gather for the batch window and
+        returns the messages for everything buffered by then"""
+
+        events = [await self._queue.get()]
+        await asyncio.sleep(self._batch_window)
+        while not self._queue.empty():
+            events.append(self._queue.get_nowait())
+
+        messages, skipped = chunk_lines(coalesce(events), self._message_limit - SKIP_NOTE_RESERVE,
+            self._max_messages)
+        if skipped:
+            # Catching up matters more than relaying every line of a flood
+            self.skipped += skipped
+            messages[-1] += f'\n*... {skipped} more lines skipped*'
+        return messages
+
+    async def run(self):
+        """Sends batches until cancelled"""
+
+        while True:
+            messages = await self.next_batch()
+            self.batches += 1
+            for message in messages:
+                await self._send(message)
+                self.messages += 1
+
+
+async def _print_log(path: str):
+    async def send(message: str):
+        print(message, end='\n\n', flush=True)
+
+    bridge = Bridge(send)
+    await asyncio.gather(bridge.feed(tail_file(path, from_start=True)), bridge.run())
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.get_event_loop().run_until_complete(_print_log(sys.argv[1]))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,92 @@
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import Deque, Dict, Hashable, Tuple
+
+
+class IdleEvicting(ABC):
+    """Base for per-key state which is dropped once a key has been idle for `idle_after` seconds.
+    Eviction is amortized: a sweep runs at most once every `idle_after` seconds."""
+
+    def __init__(self, idle_after: float):
+        self.idle_after = idle_after
+        self._last_sweep = 0.0
+
+    def _maybe_sweep(self, now: float):
+        if now - self._last_sweep >= self.idle_after:
+            self._last_sweep = now
+            self.evict_idle(now)
+
+    @abstractmethod
+    def evict_idle(self, now: float):
+        """Drops the state of the keys idle for `idle_after` seconds at `now`"""
+
+
+class TokenBuckets(IdleEvicting):
+    """A token bucket per key, stored as a (tokens, last update) tuple"""
+
+    def __init__(self, idle_after: float = 300.0):
+        super().__init__(idle_after)
+        self._buckets: Dict[Hashable, Tuple[float, float]] = {}
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def consume(self, key: Hashable, now: float, rate: float, capacity: float, cost: float = 1.0) -> bool:
+        """Takes `cost` tokens from the bucket of `key`, refilled at `rate` tokens per second
+        up to `capacity`. Returns False (and takes nothing) if there are not enough tokens"""
+
+        self._maybe_sweep(now)
+
+        tokens, last = self._buckets.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - last) * rate)
+
+        if tokens < cost:
+            self._buckets[key] = (tokens, now)
+            return False
+
+        self._buckets[key] = (tokens - cost, now)
+        return True
+
+    def reset(self, key: Hashable):
+        self._buckets.pop(key, None)
+
+    def evict_idle(self, now: float):
+        # An idle bucket is full again, so forgetting it changes nothing
+        self._buckets = {key: bucket for key, bucket in self._buckets.items()
+            if now - bucket[1] < self.idle_after}
+
+
+class DuplicateTracker(IdleEvicting):
+    """Remembers the hashes of the last few messages of each key to count repeats
+    within a sliding window"""
+
+    def __init__(self, history: int = 10, idle_after: float = 300.0):
+        super().__init__(idle_after)
+        self._history = history
+        self._seen: Dict[Hashable, Deque[Tuple[float, int]]] = {}
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
+    def add(self, key: Hashable, now: float, content_hash: int, window: float) -> int:
+        """Records a message and returns how many times the same content was
+        seen from `key` within the last `window` seconds, this one included"""
+
+        self._maybe_sweep(now)
+
+        seen = self._seen.get(key)
+        if seen is None:
+            seen = self._seen[key] = deque(maxlen=self._history)
+
+        while seen and now - seen[0][0] > window:
+            seen.popleft()
+        seen.append((now, content_hash))
+
+        return sum(1 for _, seen_hash in seen if seen_hash == content_hash)
+
+    def reset(self, key: Hashable):
+        self._seen.pop(key, None)
+
+    def evict_idle(self, now: float):
+        self._seen = {key: seen for key, seen in self._seen.items()
+            if seen and now - seen[-1][0] < self.idle_after}
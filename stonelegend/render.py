@@ -0,0 +1,182 @@
+"""Image rendering: welcome banners and charts.
+
+`render_svg` fills the SVG template and rasterizes it with CairoSVG. `render_pillow`
+composites the same layout with Pillow from layers prepared once per process by
+`init_pillow_worker`, which is meant to be used as a process pool initializer.
+`render_player_chart` draws the player count history with Pillow."""
+
+from base64 import b64encode
+from collections import OrderedDict
+from datetime import datetime
+from functools import lru_cache
+from hashlib import blake2b
+from io import BytesIO
+from typing import List, Optional, Tuple
+
+from PIL import Image, ImageDraw, ImageFont
+
+
+BANNER_SIZE = (500, 250)
+# Bounding box of the circular avatar
+AVATAR_BOX = (185, 20, 315, 150)
+# Horizontal center and baseline of the texts
+TEXT_CENTER_X = 250
+WELCOME_BASELINE = 198
+USERNAME_BASELINE = 227
+WELCOME_FONT_SIZE = 40
+USERNAME_FONT_SIZE = 20
+# Fills the background or the avatar when it could not be downloaded
+PLAIN_COLOR = (47, 49, 54)
+
+# Decoded backgrounds kept per worker, keyed by the hash of their data
+BACKGROUND_CACHE_SIZE = 8
+
+CHART_SIZE = (700, 300)
+# Left, top, right and bottom margins around the plot
+CHART_MARGINS = (40, 30, 15, 25)
+CHART_BACKGROUND = (47, 49, 54)
+CHART_GRID = (70, 73, 80)
+CHART_TEXT = (220, 221, 222)
+CHART_PEAK = (88, 101, 242, 90)
+CHART_AVERAGE = (87, 242, 135)
+
+
+def load_font(font_path: Optional[str], size: int):
+    if font_path is not None:
+        return ImageFont.truetype(font_path, size)
+    try:
+        return ImageFont.truetype('DejaVuSans.ttf', size)
+    except OSError:
+        return ImageFont.load_default()
+
+
+@lru_cache(maxsize=None)
+def plain_image(size: Tuple[int, int]) -> bytes:
+    """Returns a PNG of PLAIN_COLOR, used in place of images which could not be downloaded"""
+
+    result = BytesIO()
+    Image.new('RGB', size, PLAIN_COLOR).save(result, format='PNG')
+    return result.getvalue()
+
+
+def render_svg(template_svg: str, pfp_data: bytes, bg_data: bytes, username: str) -> BytesIO:
+    """Renders the banner by rasterizing the filled in SVG template"""
+
+    import cairosvg
+
+    svg = template_svg % dict(pfp=b64encode(pfp_data).decode('utf-8'),
+        bg=b64encode(bg_data).decode('utf-8'), username=username)
+    result = BytesIO()
+    cairosvg.svg2png(svg, write_to=result)
+    result.seek(0)
+    return result
+
+
+class _PillowLayers:
+    """Static parts of the banner, prepared once"""
+
+    def __init__(self, font_path: Optional[str]):
+        self.username_font = load_font(font_path, USERNAME_FONT_SIZE)
+        welcome_font = load_font(font_path, WELCOME_FONT_SIZE)
+
+        # The "Welcome" text never changes, so it is drawn once onto a transparent layer
+        self.overlay = Image.new('RGBA', BANNER_SIZE, (0, 0, 0, 0))
+        ImageDraw.Draw(self.overlay).text((TEXT_CENTER_X, WELCOME_BASELINE), 'Welcome',
+            font=welcome_font, fill='white', anchor='ms')
+
+        # Circular mask, supersampled for smooth edges
+        size = AVATAR_BOX[2] - AVATAR_BOX[0]
+        mask = Image.new('L', (size * 4, size * 4), 0)
+        ImageDraw.Draw(mask).ellipse((0, 0, size * 4 - 1, size * 4 - 1), fill=255)
+        self.avatar_mask = mask.resize((size, size), Image.LANCZOS)
+
+        self.backgrounds: 'OrderedDict[bytes, Image.Image]' = OrderedDict()
+
+    def background(self, bg_data: bytes) -> Image.Image:
+        key = blake2b(bg_data, digest_size=16).digest()
+        if (image := self.backgrounds.get(key)) is not None:
+            self.backgrounds.move_to_end(key)
+            return image
+
+        with Image.open(BytesIO(bg_data)) as bg:
+            image = bg.convert('RGB').resize(BANNER_SIZE, Image.BILINEAR)
+
+        self.backgrounds[key] = image
+        if len(self.backgrounds) > BACKGROUND_CACHE_SIZE:
+            self.backgrounds.popitem(last=False)
+        return image
+
+
+_layers: Optional[_PillowLayers] = None
+
+
+def init_pillow_worker(font_path: Optional[str] = None):
+    """Prepares the static layers of the current process"""
+
+    global _layers
+    _layers = _PillowLayers(font_path)
+
+
+def render_pillow(pfp_data: bytes, bg_data: bytes, username: str) -> BytesIO:
+    """Renders the banner by compositing the avatar and texts onto the background"""
+
+    if _layers is None:
+        init_pillow_worker()
+
+    banner = _layers.background(bg_data).copy()
+
+    size = AVATAR_BOX[2] - AVATAR_BOX[0]
+    with Image.open(BytesIO(pfp_data)) as pfp:
+        avatar = pfp.convert('RGB').resize((size, size), Image.BILINEAR)
+    banner.paste(avatar, AVATAR_BOX[:2], _layers.avatar_mask)
+
+    banner.paste(_layers.overlay, (0, 0), _layers.overlay)
+    ImageDraw.Draw(banner).text((TEXT_CENTER_X, USERNAME_BASELINE), username,
+        font=_layers.username_font, fill='white', anchor='ms')
+
+    result = BytesIO()
+    banner.save(result, format='PNG', compress_level=1)
+    result.seek(0)
+    return result
+
+
+def render_player_chart(points: List[Tuple[int, float, int]], title: str,
+    font_path: Optional[str] = None) -> BytesIO:
+    """Draws the average and peak of (timestamp, average, peak) points as a PNG chart"""
+
+    chart = Image.new('RGB', CHART_SIZE, CHART_BACKGROUND)
+    draw = ImageDraw.Draw(chart, 'RGBA')
+    font = load_font(font_path, 12)
+
+    left, top = CHART_MARGINS[0], CHART_MARGINS[1]
+    right, bottom = CHART_SIZE[0] - CHART_MARGINS[2], CHART_SIZE[1] - CHART_MARGINS[3]
+    draw.text((left, top // 2), title, font=font, fill=CHART_TEXT, anchor='lm')
+
+    start, end = points[0][0], points[-1][0]
+    highest = max(1, max(peak for _, _, peak in points))
+
+    def x(timestamp: int) -> float:
+        return left + (right - left) * ((timestamp - start) / (end - start) if end > start else 0.5)
+
+    def y(value: float) -> float:
+        return bottom - (bottom - top) * value / highest
+
+    for step in range(5):
+        value = highest * step / 4
+        draw.line((left, y(value), right, y(value)), fill=CHART_GRID)
+        draw.text((left - 5, y(value)), f'{value:.0f}', font=font, fill=CHART_TEXT, anchor='rm')
+
+    draw.polygon([(x(start), bottom)] + [(x(timestamp), y(peak)) for timestamp, _, peak in points]
+        + [(x(end), bottom)], fill=CHART_PEAK)
+    draw.line([(x(timestamp), y(average)) for timestamp, average, _ in points], fill=CHART_AVERAGE, width=2)
+
+    time_format = '%Y-%m-%d' if end - start > 2 * 86400 else '%Y-%m-%d %H:%M'
+    draw.text((left, bottom + 5), datetime.utcfromtimestamp(start).strftime(time_format),
+        font=font, fill=CHART_TEXT, anchor='la')
+    draw.text((right, bottom + 5), datetime.utcfromtimestamp(end).strftime(time_format) + ' UTC',
+        font=font, fill=CHART_TEXT, anchor='ra')
+
+    result = BytesIO()
+    chart.save(result, format='PNG')
+    result.seek(0)
+    return result
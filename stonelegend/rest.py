@@ -0,0 +1,331 @@
+import asyncio
+import heapq
+import itertools
+from discord import HTTPException
+from enum import IntEnum
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterator, List, Optional, Tuple
+
+from .tracing import Span, tracer
+
+
+class Priority(IntEnum):
+    """Priority of an outbound request, lower values are sent first"""
+
+    MODERATION = 0
+    MESSAGE = 1
+    COSMETIC = 2
+
+
+# Minimum seconds between two requests in the same bucket, by bucket kind.
+# A bucket is a tuple whose first item is its kind, e.g. ('channel', channel_id)
+DEFAULT_BUCKET_INTERVALS = {
+    'channel': 1.0,
+    'dm': 0.5,
+    'reaction': 0.25,
+    'guild': 0.1,
+}
+
+
+class RequestDropped(HTTPException):
+    """Set on the future of a request which was never sent, because the queue
+    was full or closed. It is an HTTPException so that callers handling failed
+    requests handle it too, rather than getting a CancelledError they did not ask for"""
+
+    def __init__(self, reason: str):
+        # There is no response to read the status from
+        self.response = None
+        self.status = 0
+        self.code = 0
+        self.text = reason
+        Exception.__init__(self, f'Request dropped: {reason}')
+
+
+_Entry = Tuple[int, int, '_Job']
+
+
+class _Job:
+    __slots__ = ('priority', 'factory', 'bucket', 'key', 'future', 'taken', 'span', 'queued_at',
+        'entry', 'deferred')
+
+    def __init__(self, priority: Priority, factory: Callable[[], Awaitable],
+        bucket: Optional[Tuple], key: Optional[Hashable], future: asyncio.Future):
+        self.priority = priority
+        self.factory = factory
+        self.bucket = bucket
+        self.key = key
+        self.future = future
+        self.taken = False
+        # The live heap entry of the job, entries left behind by a priority raise are skipped
+        self.entry: Optional[_Entry] = None
+        # Whether the entry is in the heap of its bucket rather than the main heap
+        self.deferred = False
+        # Span of the trace which submitted the request, the request is recorded under it
+        self.span: Optional[Span] = tracer.current()
+        self.queued_at = asyncio.get_event_loop().time()
+
+
+class RequestScheduler:
+    """Prioritized queue for outbound Discord REST requests.
+
+    Requests are submitted as coroutine factories. Pending requests sharing a
+    coalescing key are merged so that only the latest one is sent, and requests
+    in the same bucket are paced. When the queue is full, the least important
+    pending request is dropped (its future gets a RequestDropped).
+
+    A job whose bucket is not ready moves from the heap to a heap of its bucket.
+    When the bucket gets ready, only its most important job goes back to the
+    main heap, so waking up does not touch the jobs of the other buckets."""
+
+    def __init__(self, workers: int = 4, max_queue: int = 1000,
+        bucket_intervals: Dict[str, float] = None):
+        self._worker_count = workers
+        self._max_queue = max_queue
+        self._intervals = dict(DEFAULT_BUCKET_INTERVALS, **(bucket_intervals or {}))
+
+        self._heap: List[_Entry] = []
+        # Jobs waiting for their bucket, and when each of those buckets is ready next.
+        # A bucket with deferred jobs either has a time in `_ready_at`, or is in
+        # `_released` with its most important job back in the main heap
+        self._deferred: Dict[Tuple, List[_Entry]] = {}
+        self._ready_at: List[Tuple[float, Tuple]] = []
+        self._released: Dict[Tuple, _Job] = {}
+        self._counter = itertools.count()
+        self._pending = 0
+        self._by_key: Dict[Hashable, _Job] = {}
+        self._next_slot: Dict[Tuple, float] = {}
+        self._wakeup = asyncio.Event()
+        self._workers: List[asyncio.Task] = []
+
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.coalesced = 0
+
+    def start(self):
+        """Starts the worker tasks, must be called from within the running loop"""
+
+        if not self._workers:
+            self._workers = [asyncio.ensure_future(self._worker()) for _ in range(self._worker_count)]
+
+    async def close(self):
+        """Stops the workers and fails the requests still pending with RequestDropped"""
+
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+        for _, _, job in self._entries():
+            if not job.taken:
+                job.taken = True
+                self._drop(job, 'the queue was closed')
+        self._heap.clear()
+        self._deferred.clear()
+        self._ready_at.clear()
+        self._released.clear()
+        self._by_key.clear()
+        self._pending = 0
+
+    def submit(self, factory: Callable[[], Awaitable], *, priority: Priority = Priority.MESSAGE,
+        bucket: Tuple = None, key: Hashable = None) -> asyncio.Future:
+        """Queues a request and returns a future for its result.
+
+        `factory` is called with no arguments to create the coroutine when the
+        request is sent. If a request with the same `key` is still pending,
+        it is replaced by this one and both callers get the same future."""
+
+        if key is not None and (job := self._by_key.get(key)) is not None:
+            job.factory = factory
+            self.coalesced += 1
+            if priority < job.priority:
+                # The job moves within the heap it is in, so a deferred job still waits for its bucket
+                job.priority = priority
+                job.entry = (priority, next(self._counter), job)
+                heapq.heappush(self._deferred[job.bucket] if job.deferred else self._heap, job.entry)
+            return job.future
+
+        future = asyncio.get_event_loop().create_future()
+        job = _Job(priority, factory, bucket, key, future)
+
+        if self._pending >= self._max_queue and not self._evict(priority):
+            self.dropped += 1
+            self._drop(job, 'the queue is full')
+            return future
+
+        job.entry = (priority, next(self._counter), job)
+        heapq.heappush(self._heap, job.entry)
+        self._pending += 1
+        if key is not None:
+            self._by_key[key] = job
+        self._wakeup.set()
+        return future
+
+    async def run(self, factory: Callable[[], Awaitable], **kwargs) -> Any:
+        """Shortcut for submitting a request and waiting for its result"""
+
+        return await self.submit(factory, **kwargs)
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns the current queue depth by priority and the counters"""
+
+        depth = {priority.name.lower(): 0 for priority in Priority}
+        for _, _, job in self._entries():
+            depth[job.priority.name.lower()] += 1
+
+        return dict(depth=depth, pending=self._pending, sent=self.sent,
+            failed=self.failed, dropped=self.dropped, coalesced=self.coalesced)
+
+    def _evict(self, priority: Priority) -> bool:
+        """Drops the newest pending job less important than `priority`.
+        Returns False if there is no such job"""
+
+        victim = None
+        for entry in self._entries():
+            job = entry[2]
+            if job.priority <= priority:
+                continue
+            if victim is None or (job.priority, entry[1]) > (victim[2].priority, victim[1]):
+                victim = entry
+
+        if victim is None:
+            return False
+
+        self._take(victim[2])
+        self._drop(victim[2], 'a more important request needed its place')
+        self.dropped += 1
+        return True
+
+    @staticmethod
+    def _drop(job: _Job, reason: str):
+        if not job.future.done():
+            job.future.set_exception(RequestDropped(reason))
+
+    def _entries(self) -> Iterator[_Entry]:
+        """Iterates over the live entries of the main heap and of the deferred buckets"""
+
+        for heap in (self._heap, *self._deferred.values()):
+            for entry in heap:
+                if not self._is_stale(entry):
+                    yield entry
+
+    @staticmethod
+    def _is_stale(entry: _Entry) -> bool:
+        return entry[2].taken or entry is not entry[2].entry
+
+    def _pop_stale(self, heap: List[_Entry]):
+        while heap and self._is_stale(heap[0]):
+            heapq.heappop(heap)
+
+    def _take(self, job: _Job):
+        job.taken = True
+        self._pending -= 1
+        if job.key is not None and self._by_key.get(job.key) is job:
+            del self._by_key[job.key]
+        if job.bucket is not None and self._released.get(job.bucket) is job:
+            # The other deferred jobs of the bucket wait for its next slot
+            del self._released[job.bucket]
+            self._schedule_bucket(job.bucket)
+
+    def _schedule_bucket(self, bucket: Tuple):
+        heapq.heappush(self._ready_at, (self._next_slot.get(bucket, 0), bucket))
+
+    def _defer(self, entry: _Entry):
+        """Moves a job whose bucket is not ready to the heap of its bucket"""
+
+        job = entry[2]
+        job.deferred = True
+        deferred = self._deferred.get(job.bucket)
+        if deferred is None:
+            self._deferred[job.bucket] = [entry]
+            self._schedule_bucket(job.bucket)
+            return
+
+        heapq.heappush(deferred, entry)
+        if self._released.get(job.bucket) is job:
+            # Another job of the bucket took the slot it was released for
+            del self._released[job.bucket]
+            self._schedule_bucket(job.bucket)
+
+    def _release(self, bucket: Tuple):
+        """Puts the most important deferred job of a bucket which got ready back in the heap"""
+
+        deferred = self._deferred[bucket]
+        self._pop_stale(deferred)
+        if not deferred:
+            del self._deferred[bucket]
+            return
+
+        entry = heapq.heappop(deferred)
+        entry[2].deferred = False
+        heapq.heappush(self._heap, entry)
+        self._pop_stale(deferred)
+        if deferred:
+            self._released[bucket] = entry[2]
+        else:
+            del self._deferred[bucket]
+
+    def _next_job(self) -> Tuple[Optional[_Job], Optional[float]]:
+        """Pops the most important job whose bucket is ready to send.
+        Returns (None, delay) if every pending job has to wait for its bucket"""
+
+        loop = asyncio.get_event_loop()
+        now = loop.time()
+        found = None
+
+        while self._ready_at and self._ready_at[0][0] <= now:
+            self._release(heapq.heappop(self._ready_at)[1])
+
+        while self._heap:
+            entry = heapq.heappop(self._heap)
+            job = entry[2]
+            if self._is_stale(entry):
+                continue
+
+            if job.bucket is not None and self._next_slot.get(job.bucket, 0) > now:
+                self._defer(entry)
+                continue
+
+            found = job
+            break
+
+        if found is not None:
+            if found.bucket is not None:
+                interval = self._intervals.get(found.bucket[0], 0)
+                self._next_slot[found.bucket] = now + interval
+            self._take(found)
+            if len(self._next_slot) > 4 * self._max_queue:
+                self._next_slot = {bucket: slot for bucket, slot in self._next_slot.items() if slot > now}
+
+        return found, (self._ready_at[0][0] - now if self._ready_at else None)
+
+    async def _worker(self):
+        while True:
+            job, delay = self._next_job()
+
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            if job.future.done():
+                # The caller stopped waiting for it
+                continue
+
+            try:
+                with tracer.span('rest ' + job.priority.name.lower(), parent=job.span,
+                    queued_ms=round((asyncio.get_event_loop().time() - job.queued_at) * 1000, 3)):
+                    result = await job.factory()
+            except asyncio.CancelledError:
+                self._drop(job, 'the queue was closed')
+                raise
+            except Exception as e:
+                self.failed += 1
+                if not job.future.done():
+                    job.future.set_exception(e)
+            else:
+                self.sent += 1
+                if not job.future.done():
+                    job.future.set_result(result)
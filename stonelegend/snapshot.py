@@ -0,0 +1,34 @@
+from typing import Any, Dict, Optional
+import gzip
+import json
+import os
+import time
+
+
+# Bump whenever the layout of the snapshot data changes
+SNAPSHOT_VERSION = 1
+
+
+def dump(path: str, data: Dict[str, Any]):
+    """Writes a compressed snapshot of the caches to `path`, replacing it atomically"""
+
+    tmp_path = path + '.tmp'
+    with gzip.open(tmp_path, 'wt', encoding='utf-8') as fp:
+        json.dump(dict(version=SNAPSHOT_VERSION, created=time.time(), data=data),
+            fp, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+
+def load(path: str) -> Optional[Dict[str, Any]]:
+    """Reads a snapshot written by `dump`.
+    Returns None if there is none or it was written by another version"""
+
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as fp:
+            snapshot = json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+    if snapshot.get('version') != SNAPSHOT_VERSION:
+        return None
+    return snapshot['data']
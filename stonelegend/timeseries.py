@@ -0,0 +1,144 @@
+"""Compact in-memory history of a sampled value, like the player count of the server.
+
+Samples are folded into fixed size ring buffers at several resolutions (minute,
+hour, day by default). Each slot of a buffer holds the bucket it belongs to and
+the running average, peak and sample count of that bucket in typed arrays, so a
+year of daily points and weeks of minute points take a few hundred kilobytes.
+Queries read the finest buffer covering the period in a bounded number of points,
+never raw samples."""
+
+from array import array
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+
+# A point of a series: (bucket start timestamp, average, peak)
+Point = Tuple[int, float, int]
+# A row as persisted: (resolution, bucket, average, peak, samples)
+Row = Tuple[int, int, float, int, int]
+
+MAX_SAMPLES = 0xFFFF
+
+
+class Series:
+    """Ring buffer of aggregated buckets of `resolution` seconds, keeping the last `capacity` buckets"""
+
+    def __init__(self, resolution: int, capacity: int):
+        self.resolution = resolution
+        self.capacity = capacity
+        # Bucket held by each slot (timestamp // resolution), -1 when empty
+        self._buckets = array('q', [-1]) * capacity
+        self._averages = array('f', [0.0]) * capacity
+        self._peaks = array('H', [0]) * capacity
+        self._samples = array('H', [0]) * capacity
+        self._dirty: Set[int] = set()
+        self._last_bucket = -1
+
+    @property
+    def retention(self) -> int:
+        """Seconds of history kept"""
+
+        return self.resolution * self.capacity
+
+    def nbytes(self) -> int:
+        return sum(a.itemsize * len(a) for a in (self._buckets, self._averages, self._peaks, self._samples))
+
+    def add(self, timestamp: int, value: int):
+        bucket = timestamp // self.resolution
+        slot = bucket % self.capacity
+        value = min(value, MAX_SAMPLES)
+
+        if self._buckets[slot] != bucket:
+            self._buckets[slot] = bucket
+            self._averages[slot] = value
+            self._peaks[slot] = value
+            self._samples[slot] = 1
+        else:
+            samples = self._samples[slot] + 1
+            self._averages[slot] += (value - self._averages[slot]) / samples
+            self._peaks[slot] = max(self._peaks[slot], value)
+            self._samples[slot] = min(samples, MAX_SAMPLES)
+
+        self._dirty.add(slot)
+        self._last_bucket = max(self._last_bucket, bucket)
+
+    def latest(self) -> Optional[Point]:
+        """Returns the point of the most recent bucket"""
+
+        slot = self._last_bucket % self.capacity
+        if self._last_bucket < 0 or self._buckets[slot] != self._last_bucket:
+            return None
+        return self._last_bucket * self.resolution, self._averages[slot], self._peaks[slot]
+
+    def points(self, since: int, until: int) -> List[Point]:
+        """Returns the points of the buckets between the two timestamps, skipping empty ones"""
+
+        first = max(since // self.resolution, until // self.resolution - self.capacity + 1)
+        result = []
+        for bucket in range(first, until // self.resolution + 1):
+            slot = bucket % self.capacity
+            if self._buckets[slot] == bucket:
+                result.append((bucket * self.resolution, self._averages[slot], self._peaks[slot]))
+        return result
+
+    def load(self, bucket: int, average: float, peak: int, samples: int):
+        """Restores a persisted bucket, unless a newer one took its slot"""
+
+        slot = bucket % self.capacity
+        if self._buckets[slot] <= bucket:
+            self._buckets[slot] = bucket
+            self._averages[slot] = average
+            self._peaks[slot] = min(peak, MAX_SAMPLES)
+            self._samples[slot] = min(samples, MAX_SAMPLES)
+            self._last_bucket = max(self._last_bucket, bucket)
+
+    def drain_dirty(self) -> List[Row]:
+        """Returns the buckets changed since the last call, to be persisted"""
+
+        rows = [(self.resolution, self._buckets[slot], self._averages[slot], self._peaks[slot],
+            self._samples[slot]) for slot in sorted(self._dirty)]
+        self._dirty.clear()
+        return rows
+
+
+class History:
+    """The same samples kept at several resolutions"""
+
+    def __init__(self, capacities: Dict[int, int]):
+        # Finest resolution first
+        self.series = [Series(resolution, capacity) for resolution, capacity in sorted(capacities.items())]
+        self._by_resolution = {series.resolution: series for series in self.series}
+
+    def nbytes(self) -> int:
+        return sum(series.nbytes() for series in self.series)
+
+    def add(self, timestamp: int, value: int):
+        for series in self.series:
+            series.add(timestamp, value)
+
+    def load(self, rows: Iterable[Row]):
+        for resolution, bucket, average, peak, samples in rows:
+            if (series := self._by_resolution.get(resolution)) is not None:
+                series.load(bucket, average, peak, samples)
+
+    def drain_dirty(self) -> List[Row]:
+        return [row for series in self.series for row in series.drain_dirty()]
+
+    def pick_series(self, since: int, until: int, max_points: int) -> Series:
+        """Returns the finest series covering the period in at most `max_points` points,
+        or the coarsest one if none does"""
+
+        for series in self.series:
+            if until - since <= series.retention and (until - since) // series.resolution <= max_points:
+                return series
+        return self.series[-1]
+
+    def query(self, since: int, until: int, max_points: int = 300) -> Tuple[int, List[Point]]:
+        """Returns the resolution used and the points of the period"""
+
+        series = self.pick_series(since, until, max_points)
+        return series.resolution, series.points(since, until)
+
+    def latest(self) -> Optional[Point]:
+        """Returns the finest point of the last sample"""
+
+        return self.series[0].latest()
@@ -0,0 +1,177 @@
+"""Lightweight tracing of commands and listeners.
+
+A trace starts with a root span (a command invocation or a listener call) and
+collects child spans for the work done on its behalf: db queries, HTTP requests
+and Discord REST calls. The decision to record a trace is made once at its root,
+so unsampled traces cost a context variable lookup per span.
+
+Finished spans are written as JSON lines to a rotating file from a background
+thread. Each line has the trace, span and parent ids, so the spans can be put
+back together into call stacks, e.g. for a flame graph."""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Any, Dict, Optional, Union
+import itertools
+import json
+import logging
+import os
+import queue
+import random
+import time
+
+
+class Span:
+    """A timed operation within a trace"""
+
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'attrs', 'start', 'start_time')
+
+    def __init__(self, trace_id: str, span_id: int, parent_id: Optional[int], name: str,
+        attrs: Dict[str, Any], start: float, start_time: float):
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.name = name
+        self.attrs = attrs
+        # perf_counter() and wall clock time when the span started
+        self.start = start
+        self.start_time = start_time
+
+
+# Marks the context of a trace which was not sampled, so that its spans are skipped
+_UNSAMPLED = object()
+
+_current: ContextVar[Union[Span, object, None]] = ContextVar('current_span', default=None)
+
+
+class Tracer:
+    """Records spans of sampled traces and exports them to a file"""
+
+    def __init__(self):
+        self.enabled = False
+        self.sample_rate = 0.0
+        self._ids = itertools.count(1)
+        self._logger = logging.getLogger(__name__)
+        self._logger.propagate = False
+        self._listener: Optional[QueueListener] = None
+
+    def configure(self, enabled: bool = False, sample_rate: float = 0.05, file: str = 'traces.jsonl',
+        max_bytes: int = 10 * 1024 * 1024, backup_count: int = 5):
+        """Enables the tracer and starts the thread writing to `file`"""
+
+        self.close()
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        if not enabled:
+            return
+
+        records = queue.SimpleQueue()
+        self._logger.handlers = [QueueHandler(records)]
+        self._logger.setLevel(logging.INFO)
+        file_handler = RotatingFileHandler(file, maxBytes=max_bytes, backupCount=backup_count)
+        self._listener = QueueListener(records, file_handler)
+        self._listener.start()
+
+    def close(self):
+        """Stops the export thread after writing the spans already finished"""
+
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+        self._logger.handlers = []
+        self.enabled = False
+
+    def current(self) -> Optional[Span]:
+        """Returns the active span, None outside of a sampled trace"""
+
+        span = _current.get()
+        return span if isinstance(span, Span) else None
+
+    def start_span(self, name: str, parent: Optional[Span] = None, start: Optional[float] = None,
+        start_time: Optional[float] = None, **attrs) -> Optional[Span]:
+        """Creates a child span of `parent` (the active span by default) without activating it.
+        Returns None outside of a sampled trace. The span must be ended with `finish`"""
+
+        if parent is None:
+            parent = self.current()
+            if parent is None:
+                return None
+
+        return Span(parent.trace_id, next(self._ids), parent.span_id, name, attrs,
+            time.perf_counter() if start is None else start,
+            time.time() if start_time is None else start_time)
+
+    def finish(self, span: Optional[Span], **attrs):
+        """Ends a span created with `start_span` and exports it"""
+
+        if span is None:
+            return
+
+        duration = time.perf_counter() - span.start
+        record = dict(trace=span.trace_id, span=span.span_id, parent=span.parent_id, name=span.name,
+            start=round(span.start_time, 6), duration_ms=round(duration * 1000, 3))
+        record.update(span.attrs)
+        record.update(attrs)
+        self._logger.info(json.dumps(record, default=str))
+
+    @contextmanager
+    def span(self, name: str, parent: Optional[Span] = None, **attrs):
+        """Records the enclosed block as a child of `parent` (the active span by default)
+        and makes it the active span. Does nothing outside of a sampled trace"""
+
+        span = self.start_span(name, parent, **attrs)
+        if span is None:
+            yield None
+            return
+
+        token = _current.set(span)
+        error = None
+        try:
+            yield span
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            _current.reset(token)
+            if error is None:
+                self.finish(span)
+            else:
+                self.finish(span, error=error)
+
+    @contextmanager
+    def trace(self, name: str, **attrs):
+        """Starts a trace around the enclosed block, if sampled. Inside of another trace
+        the block is recorded as a span of it instead"""
+
+        if not self.enabled or _current.get() is not None:
+            with self.span(name, **attrs) as span:
+                yield span
+            return
+
+        if random.random() >= self.sample_rate:
+            token = _current.set(_UNSAMPLED)
+            try:
+                yield None
+            finally:
+                _current.reset(token)
+            return
+
+        root = Span(os.urandom(8).hex(), next(self._ids), None, name, attrs, time.perf_counter(), time.time())
+        token = _current.set(root)
+        error = None
+        try:
+            yield root
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            _current.reset(token)
+            if error is None:
+                self.finish(root)
+            else:
+                self.finish(root, error=error)
+
+
+# The tracer of the bot, set up by StoneLegendBot from the 'tracing' config
+tracer = Tracer()